@@ -3,35 +3,115 @@ import os
 import pathlib
 import json
 import io
+import difflib
+import hashlib
+import hmac
+import importlib
+import itertools
+import multiprocessing
+import random
+import re
+import secrets
+import shutil
+import socket
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+from bisect import bisect_left, insort
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
 from functools import wraps
 from flask import (
     Flask, render_template, request, redirect, url_for, flash,
-    session, send_file, jsonify, abort
+    session, send_file, jsonify, abort, make_response, g, has_request_context
 )
+from flask.templating import Environment as FlaskEnvironment
 from flask_sqlalchemy import SQLAlchemy
+from jinja2 import FileSystemBytecodeCache
+import click
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
 
-import pandas as pd
-from fpdf import FPDF
 
+# pandas (+numpy) costs every worker ~0.5s and tens of MB at boot, yet only the
+# export/import/reconcile pages need it: load it on first attribute access.
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            started = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            bump_metric(f"lazy_import_ms.{self._name}", int((time.perf_counter() - started) * 1000))
+        return getattr(self._module, attr)
+
+pd = LazyModule("pandas")
 from urllib.parse import quote
 
-from sqlalchemy import func, or_
+from sqlalchemy import func, or_, text, event, literal_column, inspect, bindparam
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
 
 # --- Global for recent delete cache (only holds 1 most recent deleted record) ---
 recently_deleted_submission = None
 recently_edited_submission = None  # <-- NEW: stores (subid, previous_data)
 
 
+# ---- TEMPLATES: compiled once, shared through a bytecode cache ----
+# admin.html/register.html are big; a fresh worker would otherwise compile
+# them on the first hit after every deploy or scale-up.
+class TimedEnvironment(FlaskEnvironment):
+    def compile(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().compile(*args, **kwargs)
+        finally:
+            bump_metric("jinja.compiles")
+            bump_metric("jinja.compile_ms", int((time.perf_counter() - started) * 1000))
+
+class CountingBytecodeCache(FileSystemBytecodeCache):
+    def load_bytecode(self, bucket):
+        super().load_bytecode(bucket)
+        bump_metric("jinja.bytecode_hits" if bucket.code is not None else "jinja.bytecode_misses")
+
+JINJA_CACHE_DIR = os.environ.get(
+    "JINJA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ghostfest-jinja-cache"))
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "ghostfest2025")
+# Render's proxy appends the caller's address to X-Forwarded-For; only that
+# hop is trusted, anything further left was sent by the client itself
+PROXY_HOPS = int(os.environ.get("PROXY_HOPS", 1))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
+app.jinja_environment = TimedEnvironment
+app.jinja_options = {**app.jinja_options, "bytecode_cache": CountingBytecodeCache(JINJA_CACHE_DIR)}
+
+def warm_templates():
+    # load every template into this process (and the bytecode cache)
+    started = time.perf_counter()
+    names = app.jinja_env.list_templates(extensions=["html"])
+    for name in names:
+        app.jinja_env.get_template(name)
+    bump_metric("jinja.warmup_ms", int((time.perf_counter() - started) * 1000))
+    return names
 
 # ─── Determine DB path ───────────────────────────────────────────
 # if RENDER=true (set in Render’s Environment), use the persistent /data disk,
 # otherwise fall back to a local ghostfest.db in your project root.
+# DB_FILE points somewhere else entirely (the tests use a temp directory).
 use_render = os.environ.get("RENDER", "").lower() == "true"
 db_file   = "/data/ghostfest.db" if use_render else pathlib.Path(__file__).parent / "ghostfest.db"
+db_file   = os.environ.get("DB_FILE") or db_file
 
 # ensure the directory exists (especially /data on Render)
 os.makedirs(os.path.dirname(str(db_file)), exist_ok=True)
@@ -40,25 +120,59 @@ print(f"👉 Using SQLite DB at: {db_file}")
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_file}"
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# several gunicorn workers/threads share one SQLite file: wait for the write
+# lock instead of failing straight away with "database is locked"
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {"connect_args": {"timeout": 15}}
+# read-only snapshot of ghostfest.db for exports/reports (see READ REPLICA);
+# a new file replaces it on every sync, so it is opened immutable (no
+# locking at all) and never pooled
+REPLICA_ENABLED = os.environ.get("REPLICA", "1").lower() in ("1", "true")
+REPLICA_FILE = os.environ.get("REPLICA_FILE", os.path.join(os.path.dirname(os.path.abspath(str(db_file))),
+                                                           "ghostfest-replica.db"))
+app.config['SQLALCHEMY_BINDS'] = {
+    "replica": {"url": f"sqlite:///file:{REPLICA_FILE}?mode=ro&immutable=1&uri=true", "poolclass": NullPool},
+}
 db = SQLAlchemy(app)
 
 print("Running app.py from:", os.path.abspath(__file__))
 
 # ---- MODELS ----
+class Event(db.Model):
+    # One festival (year); submissions and logs belong to exactly one
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64))
+    created_at = db.Column(db.DateTime, default=lambda: now_utc8())
+    archive_file = db.Column(db.String(256))  # set once detached to its own SQLite file
+
 class SysState(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     pause = db.Column(db.Boolean, default=False)
+    data_version = db.Column(db.Integer, default=0)  # bumped on every Submission write
+    edit_version = db.Column(db.Integer, default=0)  # bumped when an existing Submission changes or goes
+    order_seq = db.Column(db.Integer, default=0)     # order codes issued so far
+    order_code_scheme = db.Column(db.Integer, default=1)  # 0: codes from the old guessable sequence
+    active_event_id = db.Column(db.Integer)          # the event the site and dashboard serve
 
 class AdminLog(db.Model):
+    __table_args__ = (
+        db.Index("ix_admin_log_event_ts", "event_id", "ts"),
+    )
     id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.Integer)
     action = db.Column(db.String(128))
     user = db.Column(db.String(32))
     detail = db.Column(db.Text)
     ts = db.Column(db.DateTime, default=lambda: now_utc8())
 
 class Submission(db.Model):
+    __table_args__ = (
+        # /review?oid=&phone= lookups, newest first
+        db.Index("ix_submission_event_order_phone", "event_id", "order_id", "phone", "date"),
+    )
     id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.Integer)
     order_id = db.Column(db.String(8))
+    order_code = db.Column(db.String(8), unique=True, index=True)  # public, collision-free
     date = db.Column(db.DateTime, default=lambda: now_utc8())
     boat = db.Column(db.String(8))
     gender = db.Column(db.String(8))
@@ -79,43 +193,302 @@ class Owner(db.Model):
     password_hash = db.Column(db.String(128))
     role = db.Column(db.String(16))
 
+class Lease(db.Model):
+    # Cross-worker mutex: whoever holds an unexpired row does the work
+    name = db.Column(db.String(64), primary_key=True)
+    holder = db.Column(db.String(64))
+    expires = db.Column(db.Float, default=0)
+
+class SummaryCache(db.Model):
+    # Last computed dashboard summary / duplicate scan, shared by all gunicorn workers
+    key = db.Column(db.String(32), primary_key=True)
+    payload = db.Column(db.Text)
+    data_version = db.Column(db.Integer)
+    computed_at = db.Column(db.DateTime)
+    stale_since = db.Column(db.Float)  # when a worker first saw data_version move past this row
+
+class FormToken(db.Model):
+    # One row per submitted register form; replays get the same redirect
+    token = db.Column(db.String(64), primary_key=True)
+    redirect_url = db.Column(db.String(200))
+    created = db.Column(db.Float, index=True)
+
+class Outbox(db.Model):
+    # One outgoing WhatsApp message; the background sender drains them in id order
+    __table_args__ = (
+        db.Index("ix_outbox_event_status_id", "event_id", "status", "id"),
+        db.Index("ix_outbox_phone_created", "phone", "created"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.Integer)
+    campaign = db.Column(db.String(64))
+    phone = db.Column(db.String(24))                     # digits only, as wa.me wants them
+    body = db.Column(db.Text)
+    status = db.Column(db.String(12), default="queued")  # queued / sending / sent / failed / cancelled
+    attempts = db.Column(db.Integer, default=0)
+    created = db.Column(db.Float)
+    sent_at = db.Column(db.Float)
+    error = db.Column(db.String(200))
+
+class Capacity(db.Model):
+    # Places taken per event for "boat" and each "option:<name>"; cap NULL = no limit
+    event_id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(32), primary_key=True)
+    cap = db.Column(db.Integer)
+    used = db.Column(db.Integer, default=0)
+
+
+# ── SCHEMA UPGRADES: add columns that db.create_all() won't add to old tables ──
+EXTRA_COLUMNS = {
+    "sys_state": {"data_version": "INTEGER DEFAULT 0", "order_seq": "INTEGER DEFAULT 0",
+                  "active_event_id": "INTEGER", "edit_version": "INTEGER DEFAULT 0",
+                  "order_code_scheme": "INTEGER DEFAULT 0"},
+    "submission": {"order_code": "VARCHAR(8)", "event_id": "INTEGER"},
+    "admin_log": {"event_id": "INTEGER"},
+    "summary_cache": {"stale_since": "FLOAT"},
+}
+EXTRA_INDEXES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_submission_order_code ON submission (order_code)",
+    # every per-event query leads with event_id; the pre-event versions go
+    "DROP INDEX IF EXISTS ix_submission_order_phone",
+    "DROP INDEX IF EXISTS ix_submission_date",
+    "DROP INDEX IF EXISTS ix_submission_sort_option",
+    "DROP INDEX IF EXISTS ix_submission_sort_deceased",
+    "DROP INDEX IF EXISTS ix_submission_sort_paid",
+    "DROP INDEX IF EXISTS ix_submission_sort_method",
+    "CREATE INDEX IF NOT EXISTS ix_submission_event_order_phone ON submission (event_id, order_id, phone, date)",
+    "CREATE INDEX IF NOT EXISTS ix_admin_log_event_ts ON admin_log (event_id, ts)",
+    # orders-list sorts (see ORDER_SORTS): each walks an index, no temp B-tree.
+    # Every column runs the same way, so one index serves both directions
+    # (the tie-breakers follow the first sort key); the mixed-direction
+    # versions and the plain name index they replace go
+    "DROP INDEX IF EXISTS ix_submission_event_name",
+    "DROP INDEX IF EXISTS ix_submission_event_option",
+    "DROP INDEX IF EXISTS ix_submission_event_deceased",
+    "DROP INDEX IF EXISTS ix_submission_event_paid",
+    "DROP INDEX IF EXISTS ix_submission_event_method",
+    "CREATE INDEX IF NOT EXISTS ix_submission_event_date ON submission (event_id, date DESC, id DESC)",
+    "CREATE INDEX IF NOT EXISTS ix_submission_event_option_date ON submission "
+    "(event_id, json_extract(entries, '$[0].option'), date, id)",
+    "CREATE INDEX IF NOT EXISTS ix_submission_event_deceased_date ON submission "
+    "(event_id, json_extract(entries, '$[0].name_cn'), date, id)",
+    "CREATE INDEX IF NOT EXISTS ix_submission_event_paid_date ON submission (event_id, paid, date, id)",
+    "CREATE INDEX IF NOT EXISTS ix_submission_event_method_date ON submission "
+    "(event_id, payment_method, date, id)",
+    "CREATE INDEX IF NOT EXISTS ix_submission_event_name_date ON submission (event_id, name_cn, date, id)",
+    "CREATE INDEX IF NOT EXISTS ix_submission_event_total_date ON submission (event_id, total, date, id)",
+    # the sender and the cancel button only touch the active event's queue
+    "DROP INDEX IF EXISTS ix_outbox_status_id",
+    "CREATE INDEX IF NOT EXISTS ix_outbox_event_status_id ON outbox (event_id, status, id)",
+]
+
+def upgrade_schema():
+    with db.engine.begin() as conn:
+        for table, columns in EXTRA_COLUMNS.items():
+            existing = {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+            for name, ddl in columns.items():
+                if name not in existing:
+                    conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+        if conn.exec_driver_sql("SELECT COUNT(*) FROM sys_state WHERE order_code_scheme = 0").scalar():
+            # codes from the old sequence could be walked one by one: replace them all once
+            conn.exec_driver_sql("UPDATE submission SET order_code = NULL")
+            conn.exec_driver_sql("UPDATE sys_state SET order_code_scheme = 1")
+        # give rows created before order codes existed a code of their own
+        missing = [r[0] for r in conn.exec_driver_sql(
+            "SELECT id FROM submission WHERE order_code IS NULL ORDER BY id")]
+        if missing and conn.exec_driver_sql("SELECT COUNT(*) FROM sys_state").scalar():
+            codes = allocate_order_codes(conn, len(missing))
+            conn.exec_driver_sql("UPDATE submission SET order_code = ? WHERE id = ?",
+                                 list(zip(codes, missing)))
+        for ddl in EXTRA_INDEXES:
+            conn.exec_driver_sql(ddl)
+
+
+# ── ORDER CODES ──────────────────────────────────────────────────────────
+# order_id is just the last 4 phone digits, so it collides.  Every new row
+# also gets an order code: 5 random Crockford base32 characters plus a check
+# character.  A code opens /review on its own, so it must not be guessable
+# from its neighbours; SysState.order_seq only counts the codes issued.
+CODE_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+CODE_LOOKUP_BATCH = 500
+
+def _code_check(digits):
+    # odd weights are invertible mod 32, so any single mistyped char is caught
+    return sum((2 * i + 1) * d for i, d in enumerate(digits)) % 32
+
+def random_order_code():
+    digits = [secrets.randbelow(32) for _ in range(5)]
+    return "".join(CODE_ALPHABET[d] for d in digits + [_code_check(digits)])
+
+def normalize_order_code(raw):
+    # returns the canonical code, or None if raw can't be a valid code
+    code = (raw or "").strip().upper().replace("-", "").replace(" ", "")
+    code = code.replace("O", "0").replace("I", "1").replace("L", "1")
+    if len(code) != 6 or any(ch not in CODE_ALPHABET for ch in code):
+        return None
+    digits = [CODE_ALPHABET.index(ch) for ch in code]
+    return code if _code_check(digits[:5]) == digits[5] else None
+
+def allocate_order_codes(conn, n=1):
+    # bumping the counter takes the write lock first, so no other writer can
+    # insert between the clash check below and the caller's insert
+    conn.exec_driver_sql("UPDATE sys_state SET order_seq = COALESCE(order_seq, 0) + ?", (n,))
+    codes = []
+    while len(codes) < n:
+        fresh = list({random_order_code() for _ in range(n - len(codes))} - set(codes))
+        taken = set()
+        for start in range(0, len(fresh), CODE_LOOKUP_BATCH):
+            batch = fresh[start:start + CODE_LOOKUP_BATCH]
+            taken.update(r[0] for r in conn.exec_driver_sql(
+                f"SELECT order_code FROM submission WHERE order_code IN ({','.join('?' * len(batch))})",
+                tuple(batch)))
+        # a clash with an existing code just means drawing that one again
+        codes += [code for code in fresh if code not in taken]
+    return codes
+
+@event.listens_for(Submission, "before_insert")
+def assign_order_code(mapper, connection, target):
+    if not target.order_code:
+        target.order_code = allocate_order_codes(connection)[0]
+
+
+# ── EVENTS ───────────────────────────────────────────────────────────────
+# Each year's festival is an Event.  Submissions and admin logs carry its id,
+# SysState.active_event_id picks the one the site serves, and every query
+# goes through event_submissions() so it only touches that event's rows.
+DEFAULT_EVENT_NAME = os.environ.get("DEFAULT_EVENT_NAME", "2025 Ghost Festival")
+
+def active_event_id(conn=None):
+    # read once per request; background threads and CLI commands read it fresh
+    if has_request_context() and "event_id" in g:
+        return g.event_id
+    if conn is not None:
+        event_id = conn.exec_driver_sql("SELECT active_event_id FROM sys_state LIMIT 1").scalar()
+    else:
+        event_id = db.session.query(SysState.active_event_id).limit(1).scalar()
+    if has_request_context():
+        g.event_id = event_id
+    return event_id
+
+def active_event():
+    return db.session.get(Event, active_event_id())
+
+def event_submissions(session=None):
+    return (session or db.session).query(Submission).filter(Submission.event_id == active_event_id())
+
+def get_submission_or_404(subid):
+    return event_submissions().filter(Submission.id == subid).first_or_404()
+
+@event.listens_for(Submission, "before_insert")
+def assign_event(mapper, connection, target):
+    if target.event_id is None:
+        target.event_id = active_event_id(connection)
+
+@event.listens_for(AdminLog, "before_insert")
+def assign_log_event(mapper, connection, target):
+    if target.event_id is None:
+        target.event_id = active_event_id(connection)
+
 
 # ── INITIALIZATION: create all tables + seed initial data ─────────────────
 
+_bootstrap_state = {"done": False}
+
 def create_tables():
-    # create all tables
-    db.create_all()
+    # WAL lets readers keep going while a worker writes; it sticks to the file
+    with db.engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+
+    # create all tables (on the primary; the replica bind is a read-only copy)
+    db.create_all(bind_key=None)
+    upgrade_schema()
 
     # seed Owner/Admin accounts
-    if not Owner.query.filter_by(username="owner").first():
-        db.session.add(Owner(
-            username="owner",
-            password_hash=generate_password_hash("PrincessRF"),
-            role="owner"
-        ))
-    if not Owner.query.filter_by(username="Lily").first():
-        db.session.add(Owner(
-            username="Lily",
-            password_hash=generate_password_hash("1228247"),
-            role="admin"
-        ))
-    if not Owner.query.filter_by(username="Admin").first():
-        db.session.add(Owner(
-            username="Admin",
-            password_hash=generate_password_hash("994Admin"),
-            role="admin"
-        ))
+    seed_owners = [
+        ("owner", "PrincessRF", "owner"),
+        ("Lily", "1228247", "admin"),
+        ("Admin", "994Admin", "admin"),
+    ]
+    existing = {o.username for o in Owner.query.filter(Owner.username.in_([u for u, _, _ in seed_owners]))}
+    for username, password, role in seed_owners:
+        if username not in existing:
+            db.session.add(Owner(
+                username=username,
+                password_hash=generate_password_hash(password),
+                role=role
+            ))
 
     # seed the single SysState row
-    if not SysState.query.first():
-        db.session.add(SysState(pause=False))
+    state = SysState.query.first()
+    if not state:
+        state = SysState(pause=False)
+        db.session.add(state)
+
+    # rows from before events existed belong to the first event
+    if not state.active_event_id:
+        first = Event.query.order_by(Event.id).first()
+        if not first:
+            first = Event(name=DEFAULT_EVENT_NAME)
+            db.session.add(first)
+            db.session.flush()
+        state.active_event_id = first.id
+        Submission.query.filter(Submission.event_id.is_(None)).update({"event_id": first.id})
+        AdminLog.query.filter(AdminLog.event_id.is_(None)).update({"event_id": first.id})
+
+    # counters start from the rows already there
+    if not Capacity.query.filter_by(event_id=state.active_event_id).first():
+        recount_capacity(state.active_event_id)
 
     db.session.commit()
-
-# run on every import (so Gunicorn sees it too)
-with app.app_context():
-    create_tables()
-
+    _bootstrap_state["done"] = True
+
+@app.cli.command("bootstrap", help="Create/upgrade tables and seed accounts (once per deploy).")
+def bootstrap_command():
+    # importing app.py for the command may already have done it
+    if not _bootstrap_state["done"]:
+        create_tables()
+    print("✅ Database ready:", db_file)
+
+HEAVY_MODULES = ["pandas", "numpy", "fpdf", "xlsxwriter", "openpyxl"]
+
+@app.cli.command("diagnostics", help="Import the app in a fresh worker-like process and report time/memory.")
+@click.option("--top", default=15, help="How many of the slowest imports to list.")
+def diagnostics_command(top):
+    probe = (
+        "import json, resource, sys, time; t = time.perf_counter(); import app; "
+        "print(json.dumps({'ms': (time.perf_counter() - t) * 1000, "
+        "'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "
+        f"'heavy': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))"
+    )
+    env = dict(os.environ, SKIP_BOOTSTRAP="1")
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", probe],
+                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                          env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(proc.stderr[-2000:])
+        raise SystemExit(proc.returncode)
+    report = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    # "import time: self [us] | cumulative | imported package"; a package is
+    # printed after its children, two extra spaces per nesting level
+    timings, pending = [], []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            pending.append((int(cumulative) / 1000, name.strip()))
+        elif depth == 0:
+            if name.strip() == "app":
+                timings = pending
+            pending = []
+
+    print(f"Worker import: {report['ms']:.0f} ms, max RSS {report['rss_kb'] / 1024:.1f} MB")
+    print("Heavy modules loaded at startup:", ", ".join(report["heavy"]) or "none")
+    print("Slowest imports made by app.py (cumulative):")
+    for ms, name in sorted(timings, reverse=True)[:top]:
+        print(f"  {ms:8.1f} ms  {name}")
 
 # ---- HELPERS ----
 def now_utc8():
@@ -138,12 +511,15 @@ def login_required(view_func):
         return view_func(*args, **kwargs)
     return wrap
 
-def log_admin(action, user, detail=""):
+def log_admin(action, user, detail="", commit=True):
     db.session.add(AdminLog(action=action, user=user, detail=detail))
-    db.session.commit()
+    if commit:
+        db.session.commit()
 
 def send_whatsapp_reminder(phone, msg):
-    pass
+    # queue one message for the background sender; False if this number was
+    # already messaged within OUTBOX_DEDUPE_HOURS
+    return enqueue_messages({whatsapp_number(phone): msg}, campaign="single") == 1
 
 def label_date(entry):
     year = entry.get('year', '')
@@ -164,6 +540,15 @@ def label_date(entry):
             date_str += f"（{calendar}）"
     return date_str.strip()
 
+# Boat owners register up to 6 names free, every other name is RM38
+FREE_WITH_BOAT = 6
+PRICE_PER_ENTRY = 38
+
+def calc_total(boat, count):
+    free_count = FREE_WITH_BOAT if boat == "yes" else 0
+    chargeable = max(0, count - free_count)
+    return chargeable * PRICE_PER_ENTRY
+
 def extract_local_phone(phone):
     digits = ''.join(filter(str.isdigit, str(phone)))
     # Remove leading '60' (Malaysia) or '65' (Singapore)
@@ -176,40 +561,616 @@ def extract_local_phone(phone):
         digits = digits[1:]
     return digits
 
+# ---- FORM SCHEMA ----
+# What a registration may contain, shared by register(), admin_edit,
+# normalize_entry() and the spreadsheet import.  Forms are parsed in one
+# pass and rejected before any database work.
+MAX_ENTRIES = int(os.environ.get("MAX_ENTRIES", 20))
+VALID_OPTIONS = ["祖先", "冤亲债主", "无主孤魂", "婴灵", "狗狗"]
+GENDERS = ["male", "female"]
+CALENDARS = ["english", "lunar", ""]  # "" = not sure
+PAYMENT_METHODS = ["tng", "bank_transfer"]
+COUNTRY_CODES = ["+60", "+65"]
+
+SUBMISSION_SCHEMA = {
+    "boat": {"label": "Boat", "choices": ["yes", "no"]},
+    "gender": {"label": "Gender", "choices": GENDERS},
+    "name_cn": {"label": "Chinese name", "max_len": 24},
+    "name_en": {"label": "English name", "max_len": 32},
+    "phone": {"label": "Phone", "max_len": 24, "pattern": r"\+?\d{6,20}"},
+    "payment_method": {"label": "Payment method", "choices": PAYMENT_METHODS},
+}
+ENTRY_SCHEMA = {
+    "option": {"label": "Option", "choices": VALID_OPTIONS},
+    "name_cn": {"label": "Name", "max_len": 24},
+    "gender": {"label": "Gender", "choices": GENDERS},
+    "calendar": {"label": "Calendar", "choices": CALENDARS, "required": False,
+                 "aliases": {"not_sure": ""}},
+    "year": {"label": "Year", "pattern": r"\d{1,4}", "required": False},
+    "month": {"label": "Month", "pattern": r"\d{1,2}", "required": False},
+    "day": {"label": "Day", "pattern": r"\d{1,2}", "required": False},
+}
+
+def check_field(rule, raw, errors, prefix=""):
+    value = (raw or "").strip()
+    value = rule.get("aliases", {}).get(value, value)
+    label = prefix + rule["label"]
+    if not value:
+        if rule.get("required", True):
+            errors.append(f"{label} is required")
+    elif len(value) > rule.get("max_len", 16):
+        errors.append(f"{label} is too long")
+    elif "choices" in rule and value not in rule["choices"]:
+        errors.append(f"{label} is not a valid choice")
+    elif "pattern" in rule and not re.fullmatch(rule["pattern"], value):
+        errors.append(f"{label} has an invalid format")
+    return value
+
+def check_column(rule, values):
+    # check_field() for a whole pandas column at once:
+    # -> (cleaned values, mask of the rows check_field would reject)
+    values = values.fillna("").astype(str).str.strip().replace(rule.get("aliases", {}))
+    empty = values.eq("")
+    bad = empty & rule.get("required", True)
+    bad |= ~empty & values.str.len().gt(rule.get("max_len", 16))
+    if "choices" in rule:
+        bad |= ~empty & ~values.isin(rule["choices"])
+    if "pattern" in rule:
+        bad |= ~empty & ~values.str.fullmatch(rule["pattern"]).fillna(False).astype(bool)
+    return values, bad
+
+def parse_count(raw, errors):
+    try:
+        count = int(str(raw).strip())
+    except ValueError:
+        count = 0
+    if not 1 <= count <= MAX_ENTRIES:
+        errors.append(f"Count must be between 1 and {MAX_ENTRIES}")
+        return 0
+    return count
+
+def parse_entries(form, count, errors):
+    entries = []
+    for i in range(1, count + 1):
+        entry = {k: check_field(rule, form.get(f"d{i}_{k}"), errors, f"Entry {i}: ")
+                 for k, rule in ENTRY_SCHEMA.items()}
+        if not entry["calendar"] and (entry["year"] or entry["month"] or entry["day"]):
+            errors.append(f"Entry {i}: leave the date empty when not sure")
+        entries.append(entry)
+    return entries
+
+def parse_submission_form(form, aliases=None, partial=False):
+    # -> (fields, count, entries, errors); with partial=True only the fields
+    # present are checked and entries are None when the form carries none
+    aliases = aliases or {}
+    errors, fields = [], {}
+    for key, rule in SUBMISSION_SCHEMA.items():
+        name = aliases.get(key, key)
+        if partial and name not in form:
+            continue
+        fields[key] = check_field(rule, form.get(name), errors)
+    count, entries = None, None
+    if not partial or "count" in form or "d1_option" in form:
+        count = parse_count(form.get("count"), errors)
+        entries = parse_entries(form, count, errors)
+    return fields, count, entries, errors
+
+# ---- METRICS (per worker, in-memory) ----
+METRICS = Counter()
+
+def bump_metric(name, n=1):
+    METRICS[name] += n
+
+# ---- DATA VERSION ----
+# SysState.data_version goes up by one in the same transaction as any change
+# to a Submission, so caches in every worker can tell cheaply whether their
+# copy is still current.
+def current_data_version():
+    return db.session.execute(text("SELECT data_version FROM sys_state LIMIT 1")).scalar() or 0
+
+def bump_data_version(conn=None):
+    stmt = "UPDATE sys_state SET data_version = COALESCE(data_version, 0) + 1"
+    if conn is None:
+        db.session.execute(text(stmt))
+    else:
+        conn.exec_driver_sql(stmt)
+
+@event.listens_for(db.session, "before_flush")
+def track_submission_writes(session, flush_context, instances):
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    if any(isinstance(obj, Submission) for obj in changed):
+        bump_data_version(session.connection())
+    # edit_version stays put while rows are only added, so append-only
+    # caches (reports) know they can just fetch the new ids
+    if any(isinstance(obj, Submission) for obj in list(session.dirty) + list(session.deleted)):
+        session.connection().exec_driver_sql(
+            "UPDATE sys_state SET edit_version = COALESCE(edit_version, 0) + 1")
+
+# ---- CAPACITY QUOTAS ----
+# Owners may cap the boat owners and each option per event.  capacity.used
+# moves with every Submission insert/edit/delete in the same transaction
+# (flush hook below), so checking a cap never scans the entries: a guarded
+# UPDATE either takes the places or matches no row.  register() and
+# admin_edit set g.enforce_capacity; other writers only keep count.
+class CapacityError(ValueError):
+    pass
+
+def capacity_keys():
+    return ["boat"] + [f"option:{opt}" for opt in VALID_OPTIONS]
+
+def capacity_label(key):
+    return "Boat" if key == "boat" else key.split(":", 1)[1]
+
+def capacity_usage(boat, entries):
+    usage = Counter()
+    if boat == "yes":
+        usage["boat"] += 1
+    try:
+        entries = json.loads(entries or "[]")
+    except json.JSONDecodeError:
+        entries = []
+    for e in entries:
+        if e.get("option") in VALID_OPTIONS:
+            usage["option:" + e["option"]] += 1
+    return usage
+
+def take_capacity(conn, event_id, delta, enforce=False):
+    for key, n in sorted(delta.items()):
+        if not n:
+            continue
+        params = {"event_id": event_id, "key": key, "n": n}
+        guard = " AND (cap IS NULL OR used + :n <= cap)" if enforce and n > 0 else ""
+        taken = conn.execute(text("UPDATE capacity SET used = used + :n "
+                                  "WHERE event_id = :event_id AND key = :key" + guard), params).rowcount
+        if taken:
+            continue
+        row = conn.execute(text("SELECT cap, used FROM capacity WHERE event_id = :event_id AND key = :key"),
+                           params).first()
+        if row:
+            left = max(row.cap - row.used, 0)
+            raise CapacityError(f"{capacity_label(key)} is full" if not left else
+                                f"{capacity_label(key)} only has {left} place(s) left")
+        conn.execute(text("INSERT INTO capacity (event_id, key, used) VALUES (:event_id, :key, :n) "
+                          "ON CONFLICT (event_id, key) DO UPDATE SET used = used + excluded.used"), params)
+
+def recount_capacity(event_id):
+    # one full pass, for new events and as a repair tool
+    params = {"event_id": event_id}
+    used = dict(db.session.execute(text(
+        "SELECT 'option:' || json_extract(e.value, '$.option'), COUNT(*) "
+        "FROM submission s, json_each(s.entries) e "
+        "WHERE s.event_id = :event_id AND json_valid(s.entries) GROUP BY 1"), params).all())
+    used["boat"] = db.session.execute(text(
+        "SELECT COUNT(*) FROM submission WHERE event_id = :event_id AND boat = 'yes'"), params).scalar()
+    for key in capacity_keys():
+        db.session.execute(text(
+            "INSERT INTO capacity (event_id, key, used) VALUES (:event_id, :key, :used) "
+            "ON CONFLICT (event_id, key) DO UPDATE SET used = excluded.used"),
+            {"event_id": event_id, "key": key, "used": used.get(key, 0)})
+
+def capacity_remaining():
+    # {key: places left} for the capped keys of the active event
+    rows = Capacity.query.filter(Capacity.event_id == active_event_id(), Capacity.cap.isnot(None))
+    return {c.key: max(c.cap - c.used, 0) for c in rows}
+
+@event.listens_for(db.session, "before_flush")
+def track_capacity(session, flush_context, instances):
+    deltas = {}
+    def add(event_id, usage, sign):
+        delta = deltas.setdefault(event_id, Counter())
+        for key, n in usage.items():
+            delta[key] += sign * n
+
+    for obj in session.new:
+        if isinstance(obj, Submission):
+            add(obj.event_id or active_event_id(session.connection()), capacity_usage(obj.boat, obj.entries), 1)
+    for obj in session.deleted:
+        if isinstance(obj, Submission):
+            add(obj.event_id, capacity_usage(obj.boat, obj.entries), -1)
+    for obj in session.dirty:
+        if not isinstance(obj, Submission):
+            continue
+        attrs = inspect(obj).attrs
+        if not any(attrs[a].history.has_changes() for a in ("boat", "entries", "event_id")):
+            continue
+        before = {a: (attrs[a].history.deleted or attrs[a].history.unchanged or [None])[0]
+                  for a in ("boat", "entries", "event_id")}
+        add(before["event_id"], capacity_usage(before["boat"], before["entries"]), -1)
+        add(obj.event_id, capacity_usage(obj.boat, obj.entries), 1)
+
+    enforce = has_request_context() and g.get("enforce_capacity", False)
+    for event_id, delta in deltas.items():
+        take_capacity(session.connection(), event_id, delta, enforce)
+
+# ---- CROSS-WORKER LEASES ----
+HOSTNAME = socket.gethostname()
+
+def worker_id():
+    # not a constant: with preload_app the module is imported before the fork
+    return f"{HOSTNAME}:{os.getpid()}"
+
+def acquire_lease(name, ttl):
+    now = time.time()
+    db.session.execute(
+        text("INSERT OR IGNORE INTO lease (name, holder, expires) VALUES (:name, '', 0)"),
+        {"name": name})
+    res = db.session.execute(
+        text("UPDATE lease SET holder = :holder, expires = :expires "
+             "WHERE name = :name AND (expires < :now OR holder = :holder)"),
+        {"name": name, "holder": worker_id(), "expires": now + ttl, "now": now})
+    db.session.commit()
+    return res.rowcount == 1
+
+def release_lease(name):
+    db.session.execute(
+        text("UPDATE lease SET expires = 0 WHERE name = :name AND holder = :holder"),
+        {"name": name, "holder": worker_id()})
+    db.session.commit()
+
+
+# ---- READ REPLICA ----
+# Exports, reports and the full dashboard refresh read the whole event.  They
+# run against REPLICA_FILE, a snapshot that one worker (holding the "replica"
+# lease) re-takes with SQLite's online backup whenever data_version moved,
+# at most every REPLICA_SYNC_SECONDS.  The copy is written to a temp file and
+# renamed over the old one, so readers never see a half-written snapshot and
+# the primary only serves one short read per sync.  A snapshot older than
+# REPLICA_MAX_LAG that is also behind the primary is not used: those reads
+# go to ghostfest.db as before.
+REPLICA_SYNC_SECONDS = float(os.environ.get("REPLICA_SYNC_SECONDS", 5))
+REPLICA_MAX_LAG = float(os.environ.get("REPLICA_MAX_LAG", 30))
+_replica_lock = threading.Lock()
+_replica_state = {"pid": None}
+
+def replica_info():
+    # (synced_at, data_version) recorded inside the snapshot, or None
+    if not os.path.exists(REPLICA_FILE):
+        return None
+    try:
+        with db.engines["replica"].connect() as conn:
+            return conn.exec_driver_sql("SELECT synced_at, data_version FROM replica_info").first()
+    except SQLAlchemyError:
+        return None
+
+def replica_lag(info, version):
+    return 0.0 if info.data_version == version else time.time() - info.synced_at
+
+def sync_replica():
+    started = time.time()
+    partial = REPLICA_FILE + ".partial"
+    if os.path.exists(partial):
+        os.remove(partial)
+    src = sqlite3.connect(str(db_file), timeout=15)
+    dst = sqlite3.connect(partial)
+    try:
+        # one step: a consistent snapshot, and WAL lets writers carry on meanwhile
+        src.backup(dst)
+        dst.execute("PRAGMA journal_mode=DELETE")
+        dst.execute("CREATE TABLE replica_info (synced_at REAL, data_version INTEGER)")
+        dst.execute("INSERT INTO replica_info SELECT ?, data_version FROM sys_state LIMIT 1", (started,))
+        dst.commit()
+    finally:
+        dst.close()
+        src.close()
+    os.replace(partial, REPLICA_FILE)
+    bump_metric("replica.syncs")
+    bump_metric("replica.sync_ms", int((time.time() - started) * 1000))
+
+def _replica_loop():
+    with app.app_context():
+        while True:
+            try:
+                if acquire_lease("replica", REPLICA_SYNC_SECONDS * 3):
+                    info = replica_info()
+                    if info is None or info.data_version != current_data_version():
+                        sync_replica()
+            except Exception:
+                bump_metric("replica.errors")
+            finally:
+                db.session.remove()  # don't sit on a read snapshot between syncs
+            time.sleep(REPLICA_SYNC_SECONDS)
+
+def start_replica_sync():
+    # one thread per worker process (threads don't survive the preload fork),
+    # started from gunicorn's post_fork so the snapshot keeps up from boot;
+    # only the lease holder actually copies
+    if not REPLICA_ENABLED or _replica_state["pid"] == os.getpid():
+        return
+    with _replica_lock:
+        if _replica_state["pid"] == os.getpid():
+            return
+        _replica_state["pid"] = os.getpid()
+    threading.Thread(target=_replica_loop, daemon=True).start()
+
+@contextmanager
+def read_session():
+    # a Session on the replica when it is fresh enough, else on the primary;
+    # read only: anything written through it would be lost
+    start_replica_sync()  # for `flask run`, which has no post_fork
+    info = replica_info() if REPLICA_ENABLED else None
+    if info and replica_lag(info, current_data_version()) <= REPLICA_MAX_LAG:
+        engine = db.engines["replica"]
+        bump_metric("replica.reads")
+    else:
+        engine = db.engine
+        bump_metric("replica.fallbacks")
+    session = Session(engine)
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+# ---- ADMISSION CONTROL ----
+# Token buckets per (route, client IP), kept in a small SQLite file of their
+# own so every gunicorn worker sees the same buckets without adding writes
+# to ghostfest.db.  Each check is one atomic UPSERT; if the limiter file is
+# busy we let the request through rather than make it wait.
+RATELIMIT_DB = os.environ.get("RATELIMIT_DB", os.path.join(os.path.dirname(str(db_file)), "ratelimit.db"))
+RATE_LIMITS = {
+    # route: (tokens per minute, burst)
+    "register": (10, 5),
+    "check": (20, 10),
+    "select_entry": (20, 10),
+    "review": (20, 10),  # an order code alone opens the order
+}
+for _route in RATE_LIMITS:
+    # e.g. RATE_LIMIT_CHECK="30/15"
+    _env = os.environ.get(f"RATE_LIMIT_{_route.upper()}")
+    if _env:
+        _per_min, _burst = _env.split("/")
+        RATE_LIMITS[_route] = (float(_per_min), float(_burst))
+
+# Write routes: at most WRITE_CONCURRENCY requests per worker touch the DB
+# at once; the rest wait up to WRITE_GATE_WAIT seconds and then get a 503.
+WRITE_CONCURRENCY = int(os.environ.get("WRITE_CONCURRENCY", 4))
+WRITE_GATE_WAIT = float(os.environ.get("WRITE_GATE_WAIT", 0.5))
+_write_gate = threading.BoundedSemaphore(WRITE_CONCURRENCY)
+_ratelimit_local = threading.local()
+
+def ratelimit_conn():
+    conn = getattr(_ratelimit_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(RATELIMIT_DB, timeout=0.05, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+        _ratelimit_local.conn = conn
+    return conn
+
+def client_ip():
+    # ProxyFix has already put the trusted X-Forwarded-For hop here
+    return request.remote_addr or "unknown"
+
+def take_token(route, client):
+    # returns 0 if allowed, otherwise seconds until the next token
+    per_min, burst = RATE_LIMITS[route]
+    rate, now = per_min / 60.0, time.time()
+    try:
+        conn = ratelimit_conn()
+        tokens = conn.execute(
+            "INSERT INTO bucket (key, tokens, updated) VALUES (?, ? - 1, ?) "
+            "ON CONFLICT(key) DO UPDATE SET "
+            # refill, spend one; debt is capped so a blocked client recovers
+            "tokens = MAX(?, MIN(?, tokens + (excluded.updated - updated) * ?) - 1), "
+            "updated = excluded.updated "
+            "RETURNING tokens",
+            (f"{route}:{client}", burst, now, -burst, burst, rate)).fetchone()[0]
+        if random.random() < 0.001:
+            conn.execute("DELETE FROM bucket WHERE updated < ?", (now - 3600,))
+    except sqlite3.Error:
+        bump_metric("ratelimit.fail_open")
+        return 0
+    if tokens >= 0:
+        return 0
+    bump_metric(f"ratelimit.rejected.{route}")
+    return max(1, int(-tokens / rate + 0.999))
+
+def overloaded(status, retry_after):
+    msg = ("请求太频繁，请稍后再试。Too many requests, please try again shortly."
+           if status == 429 else
+           "系统繁忙，请稍后再试。The server is busy, please try again shortly.")
+    if request.accept_mimetypes.best == "application/json" or request.path.startswith("/admin"):
+        resp = jsonify({"ok": False, "error": msg})
+    else:
+        resp = make_response(msg)
+    resp.status_code = status
+    resp.headers["Retry-After"] = str(retry_after)
+    return resp
+
+def rate_limited(route, methods=("GET", "POST")):
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrap(*args, **kwargs):
+            if request.method in methods:
+                retry_after = take_token(route, client_ip())
+                if retry_after:
+                    return overloaded(429, retry_after)
+            return view_func(*args, **kwargs)
+        return wrap
+    return decorator
+
+def write_gated(view_func):
+    @wraps(view_func)
+    def wrap(*args, **kwargs):
+        if request.method != "POST":
+            return view_func(*args, **kwargs)
+        if not _write_gate.acquire(timeout=WRITE_GATE_WAIT):
+            bump_metric("write_gate.rejected")
+            return overloaded(503, 2)
+        try:
+            return view_func(*args, **kwargs)
+        finally:
+            _write_gate.release()
+    return wrap
+
+
+# ---- TRAFFIC CAPTURE (opt-in, for replay_traffic.py) ----
+# With TRAFFIC_CAPTURE=1 each request's shape goes to
+# TRAFFIC_DIR/traffic-<pid>.jsonl: route, params, entry count, status, size
+# and timing.  Enumerated values (options, sort keys, page numbers...) are
+# kept as-is, anything else becomes a salted hash plus its length, and
+# passwords are dropped.  Files rotate at TRAFFIC_MAX_MB and only the newest
+# TRAFFIC_KEEP_FILES rotated files stay.
+# The salt is random per run (the preloaded master makes it, so all workers
+# share it) and never written down: phone numbers are short enough to
+# brute-force against a known salt.  TRAFFIC_SALT may pin one instead, but
+# it must be long and must not be the app's secret key.
+TRAFFIC_CAPTURE = os.environ.get("TRAFFIC_CAPTURE", "").lower() in ("1", "true")
+TRAFFIC_DIR = os.environ.get("TRAFFIC_DIR", os.path.join(os.path.dirname(str(db_file)), "traffic"))
+TRAFFIC_MAX_BYTES = int(float(os.environ.get("TRAFFIC_MAX_MB", 20)) * 1024 * 1024)
+TRAFFIC_KEEP_FILES = int(os.environ.get("TRAFFIC_KEEP_FILES", 10))
+TRAFFIC_SALT = os.environ.get("TRAFFIC_SALT", "").encode() or secrets.token_bytes(32)
+if TRAFFIC_CAPTURE and (len(TRAFFIC_SALT) < 16 or TRAFFIC_SALT == app.secret_key.encode()):
+    print("⚠️ TRAFFIC_SALT must be at least 16 characters and differ from SECRET_KEY; traffic capture is off")
+    TRAFFIC_CAPTURE = False
+TRAFFIC_PLAIN_FIELDS = {
+    "page", "per_page", "sort", "filter_type", "type", "mode", "kind", "option", "action", "ids",
+    "keep", "accept", "event_id", "limit", "dry_run", "count", "boat", "gender", "your_gender",
+    "payment_method", "country_code", "confirm", "method",
+}
+TRAFFIC_PLAIN_VALUES = set(VALID_OPTIONS) | set(GENDERS) | set(PAYMENT_METHODS) | {"yes", "no", ""}
+TRAFFIC_PLAIN_ENTRY_RE = re.compile(r"d\d+_(option|gender|calendar)$")
+TRAFFIC_DROP_FIELDS = {"password"}
+TRAFFIC_ROTATED_RE = re.compile(r"traffic-\d+-\d{8}-\d{6}-\d{6}\.jsonl$")
+
+_traffic_lock = threading.Lock()
+_traffic_state = {"pid": None, "file": None, "path": None}
+
+def mask_value(key, value):
+    if key in TRAFFIC_PLAIN_FIELDS or TRAFFIC_PLAIN_ENTRY_RE.match(key) or value in TRAFFIC_PLAIN_VALUES:
+        return value
+    digest = hmac.new(TRAFFIC_SALT, value.encode(), hashlib.sha256).hexdigest()[:12]
+    return {"h": digest, "len": len(value), "digits": value.isdigit()}
+
+def mask_params(params):
+    return {k: [mask_value(k, v) for v in params.getlist(k)] for k in params if k not in TRAFFIC_DROP_FIELDS}
+
+def rotate_traffic_file():
+    _traffic_state["file"].close()
+    os.replace(_traffic_state["path"], _traffic_state["path"].replace(
+        ".jsonl", f"-{datetime.now():%Y%m%d-%H%M%S-%f}.jsonl"))
+    _traffic_state["file"] = None
+    rotated = sorted((os.path.join(TRAFFIC_DIR, n) for n in os.listdir(TRAFFIC_DIR) if TRAFFIC_ROTATED_RE.match(n)),
+                     key=os.path.getmtime)
+    for path in rotated[:-TRAFFIC_KEEP_FILES]:
+        os.remove(path)
+
+def write_traffic(record):
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with _traffic_lock:
+        if _traffic_state["file"] is None or _traffic_state["pid"] != os.getpid():
+            os.makedirs(TRAFFIC_DIR, exist_ok=True)
+            path = os.path.join(TRAFFIC_DIR, f"traffic-{os.getpid()}.jsonl")
+            _traffic_state.update(pid=os.getpid(), path=path, file=open(path, "a", encoding="utf-8"))
+        _traffic_state["file"].write(line)
+        _traffic_state["file"].flush()
+        if _traffic_state["file"].tell() >= TRAFFIC_MAX_BYTES:
+            rotate_traffic_file()
+
+def start_traffic_timer():
+    g.traffic_started = time.perf_counter()
+
+def capture_traffic(response):
+    if request.path.startswith("/static/") or "traffic_started" not in g:
+        return response
+    try:
+        write_traffic({
+            "t": round(time.time(), 3),
+            "method": request.method,
+            "route": request.url_rule.rule if request.url_rule else None,
+            "path": request.path,
+            "args": mask_params(request.args),
+            "form": mask_params(request.form),
+            "files": {k: f.content_length or 0 for k, f in request.files.items()},
+            "entries": sum(1 for k in request.form if k.endswith("_option")),
+            "role": session.get("role"),
+            "status": response.status_code,
+            "bytes": response.calculate_content_length(),
+            "ms": round((time.perf_counter() - g.traffic_started) * 1000, 2),
+        })
+        bump_metric("traffic.captured")
+    except Exception:
+        bump_metric("traffic.errors")  # capture must never break a request
+    return response
+
+if TRAFFIC_CAPTURE:
+    app.before_request(start_traffic_timer)
+    app.after_request(capture_traffic)
+
+# ---- FORM TOKENS (idempotent register submits) ----
+FORM_TOKEN_TTL = int(os.environ.get("FORM_TOKEN_TTL", 12 * 3600))
+FORM_TOKEN_RE = re.compile(r"[A-Za-z0-9_-]{16,64}")
+
+def new_form_token():
+    return secrets.token_urlsafe(24)
+
+def clean_form_token(raw):
+    raw = (raw or "").strip()
+    return raw if FORM_TOKEN_RE.fullmatch(raw) else ""
+
+def replayed_submit(token):
+    # redirect of an earlier POST with this token, if it is still fresh
+    if not token:
+        return None
+    row = db.session.get(FormToken, token)
+    if row and row.created > time.time() - FORM_TOKEN_TTL:
+        return row.redirect_url
+    return None
+
+def finish_submit(token, url):
+    # commit the pending submission together with its token; the PK makes
+    # a concurrent replay lose here and follow the winner instead
+    if token:
+        now = time.time()
+        if random.random() < 0.01:
+            FormToken.query.filter(FormToken.created < now - FORM_TOKEN_TTL).delete()
+        db.session.merge(FormToken(token=token, redirect_url=url, created=now))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        url = replayed_submit(token)
+        if not url:
+            raise
+        bump_metric("form_token.replayed")
+    return redirect(url)
+
 
 # ---- USER ROUTES ----
 @app.route("/", methods=["GET", "POST"])
+@rate_limited("register", methods=("POST",))
+@write_gated
 def register():
     sys_state = SysState.query.first()
     if sys_state and sys_state.pause:
         return render_template("closed.html")
     if request.method == "POST":
-        boat = request.form.get("boat", "")
-        gender = request.form.get("your_gender", "")
-        name_cn = request.form.get("name_cn", "")
-        name_en = request.form.get("name_en", "")
-        country_code = request.form.get("country_code", "")
-        phone = request.form.get("phone", "")
-        count = int(request.form.get("count", "1"))
-        payment_method = request.form.get("payment_method", "")
+        fields, count, entries, errors = parse_submission_form(request.form, aliases={"gender": "your_gender"})
+        country_code = check_field({"label": "Country code", "choices": COUNTRY_CODES},
+                                   request.form.get("country_code"), errors)
+        form_token = clean_form_token(request.form.get("form_token"))
+        if errors:
+            bump_metric("register.rejected")
+            return render_register(errors=errors, form_token=form_token), 400
+        g.enforce_capacity = True
+        done = replayed_submit(form_token)
+        if done:
+            bump_metric("form_token.replayed")
+            return redirect(done)
+        boat = fields["boat"]
+        gender = fields["gender"]
+        name_cn = fields["name_cn"]
+        name_en = fields["name_en"]
+        phone = fields["phone"]
+        payment_method = fields["payment_method"]
         confirm = request.form.get("confirm")
         dup_key = request.form.get("dup_key")
-        entries = []
-        for i in range(1, count + 1):
-            entries.append({
-                "option": request.form.get(f"d{i}_option", ""),
-                "name_cn": request.form.get(f"d{i}_name_cn", ""),
-                "gender": request.form.get(f"d{i}_gender", ""),
-                "calendar": request.form.get(f"d{i}_calendar", ""),
-                "year": request.form.get(f"d{i}_year", ""),
-                "month": request.form.get(f"d{i}_month", ""),
-                "day": request.form.get(f"d{i}_day", ""),
-            })
-        
+
         # ------- UPDATED DUPLICATE CHECK -------
         local_input = extract_local_phone(phone)
         exist = None
-        for sub in Submission.query.filter_by(name_cn=name_cn):
+        for sub in event_submissions().filter_by(name_cn=name_cn):
             local_db = extract_local_phone(sub.phone)
             if local_db == local_input:
                 exist = sub
@@ -223,13 +1184,14 @@ def register():
             exist.phone = country_code + phone
             exist.payment_method = payment_method
             exist.count = count
-            free_count = 6 if boat == "yes" else 0
-            chargeable = max(0, count - free_count)
-            exist.total = chargeable * 38
+            exist.total = calc_total(boat, count)
             exist.entries = json.dumps(entries)
             exist.date = now_utc8()
-            db.session.commit()
-            return redirect(url_for("review", oid=exist.order_id, phone=exist.phone))
+            try:
+                db.session.flush()
+            except CapacityError as e:
+                return capacity_rejected(e, form_token)
+            return finish_submit(form_token, url_for("review", code=exist.order_code))
 
         if exist and not confirm:
             form_data = {
@@ -240,16 +1202,12 @@ def register():
                 "country_code": country_code,
                 "phone": phone,
                 "count": count,
-                "payment_method": payment_method
+                "payment_method": payment_method,
+                "form_token": form_token or new_form_token()
             }
-            for i in range(1, count + 1):
-                form_data[f"d{i}_option"] = request.form.get(f"d{i}_option", "")
-                form_data[f"d{i}_name_cn"] = request.form.get(f"d{i}_name_cn", "")
-                form_data[f"d{i}_gender"] = request.form.get(f"d{i}_gender", "")
-                form_data[f"d{i}_calendar"] = request.form.get(f"d{i}_calendar", "")
-                form_data[f"d{i}_year"] = request.form.get(f"d{i}_year", "")
-                form_data[f"d{i}_month"] = request.form.get(f"d{i}_month", "")
-                form_data[f"d{i}_day"] = request.form.get(f"d{i}_day", "")
+            for i, e in enumerate(entries, 1):
+                for k in ENTRY_SCHEMA:
+                    form_data[f"d{i}_{k}"] = e[k]
             dup_key = name_cn + "_" + phone[-8:]
             return render_template(
                 "confirm.html",
@@ -258,9 +1216,7 @@ def register():
                 dup_key=dup_key
             )
 
-        free_count = 6 if boat == "yes" else 0
-        chargeable = max(0, count - free_count)
-        total = chargeable * 38
+        total = calc_total(boat, count)
         order_id = phone[-4:]
         sub = Submission(order_id=order_id,
                          boat=boat,
@@ -273,20 +1229,88 @@ def register():
                          total=total,
                          entries=json.dumps(entries))
         db.session.add(sub)
-        db.session.commit()
-        return redirect(url_for("review", oid=order_id, phone=country_code + phone))
-    return render_template("register.html")
+        try:
+            db.session.flush()
+        except CapacityError as e:
+            return capacity_rejected(e, form_token)
+        return finish_submit(form_token, url_for("review", code=sub.order_code))
+    return render_register()
+
+def render_register(errors=None, form_token=""):
+    return render_template("register.html", errors=errors, max_entries=MAX_ENTRIES,
+                           form_token=form_token or new_form_token(), remaining=capacity_remaining())
+
+def capacity_rejected(error, form_token):
+    db.session.rollback()
+    bump_metric("register.sold_out")
+    return render_register(errors=[str(error)], form_token=form_token), 409
+
+# ---- OFFLINE FORM (service worker) ----
+# /sw.js caches the form and its assets.  A register POST that fails to reach
+# us, times out, or gets a 429/5xx is kept in IndexedDB and re-sent with
+# backoff (static/offline-queue.js); the form_token makes every re-send
+# idempotent.  The worker's scope has to be "/", so it is served from the
+# root, and its text changes whenever one of the files it caches does.
+OFFLINE_FILES = ["templates/register.html", "templates/offline.html", "templates/sw.js",
+                 "static/offline-queue.js", "static/icon.svg"]
+OFFLINE_ASSETS = ["offline-queue.js", "icon.svg", "boats-list.png", "tng_qr_code.jpeg",
+                  "bank_transfer_qr_code.jpeg"]
+_offline_version = {}
+
+def offline_version():
+    if "v" not in _offline_version:
+        digest = hashlib.sha1()
+        for name in OFFLINE_FILES:
+            with open(os.path.join(app.root_path, name), "rb") as f:
+                digest.update(f.read())
+        _offline_version["v"] = digest.hexdigest()[:12]
+    return _offline_version["v"]
+
+@app.route("/sw.js")
+def service_worker():
+    resp = make_response(render_template(
+        "sw.js", version=offline_version(),
+        assets=[url_for("static", filename=name) for name in OFFLINE_ASSETS]))
+    resp.mimetype = "application/javascript"
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+@app.route("/manifest.webmanifest")
+def web_manifest():
+    manifest = {
+        "name": "中元节超渡登记表 / Ghost Festival Registration",
+        "short_name": "👻 Registration",
+        "start_url": url_for("register"),
+        "scope": "/",
+        "display": "standalone",
+        "background_color": "#f9fafc",
+        "theme_color": "#ffe066",
+        "icons": [{"src": url_for("static", filename="icon.svg"), "sizes": "any", "type": "image/svg+xml"}],
+    }
+    return app.response_class(json.dumps(manifest, ensure_ascii=False), mimetype="application/manifest+json")
+
+@app.route("/offline")
+def offline_queue():
+    # the worker sends queued submitters here; all the state is in the browser
+    return render_template("offline.html")
 
 @app.route("/review")
+@rate_limited("review")
 def review():
+    code = normalize_order_code(request.args.get("code"))
     oid = request.args.get("oid")
     phone = request.args.get("phone")
-    if not oid or not phone:
+    if code:
+        # unique index probe
+        sub = event_submissions().filter_by(order_code=code).first()
+    elif oid and phone:
+        # old links: (event_id, order_id, phone) index, newest first
+        sub = (event_submissions()
+               .filter_by(order_id=oid, phone=phone)
+               .order_by(Submission.date.desc())  # << Add this line
+               .first())
+    else:
         return redirect(url_for("register"))
-    sub = (Submission.query
-           .filter_by(order_id=oid, phone=phone)
-           .order_by(Submission.date.desc())  # << Add this line
-           .first())
     if not sub:
         flash("Submission not found.", "danger")
         return redirect(url_for("register"))
@@ -304,44 +1328,51 @@ def confirm():
     return render_template("confirm.html")
 
 @app.route("/check", methods=["GET", "POST"])
+@rate_limited("check", methods=("POST",))
 def check():
     error = None
     if request.method == "POST":
         order_id = request.form.get("order_id", "").strip()
+        code = normalize_order_code(order_id)
+        if code:
+            sub = event_submissions().filter_by(order_code=code).first()
+            if not sub:
+                return render_template("check.html", error=True)
+            return redirect(url_for("review", code=sub.order_code))
         if not order_id or not order_id.isdigit() or len(order_id) != 4:
             error = True
             return render_template("check.html", error=error)
-        results = Submission.query.filter(Submission.order_id == order_id).all()
+        results = event_submissions().filter(Submission.order_id == order_id).all()
         if not results:
             error = True
             return render_template("check.html", error=error)
         if len(results) == 1:
             sub = results[0]
-            return redirect(url_for("review", oid=sub.order_id, phone=sub.phone))
+            return redirect(url_for("review", code=sub.order_code))
         else:
             entries = [
-                {"name_cn": s.name_cn, "phone": s.phone}
+                {"name_cn": s.name_cn, "phone": s.phone, "order_code": s.order_code}
                 for s in results
             ]
             return render_template("select_entry.html", entries=entries, order_id=order_id)
     return render_template("check.html", error=error)
 
 @app.route("/select_entry", methods=["POST"])
+@rate_limited("select_entry")
 def select_entry():
     selected = request.form.get("select_name")
     if not selected:
         flash("Please select a record.", "danger")
         return redirect(url_for("check"))
-    try:
-        name_cn, phone = selected.split("|", 1)
-    except Exception:
+    code = normalize_order_code(selected)
+    if not code:
         flash("Invalid selection.", "danger")
         return redirect(url_for("check"))
-    sub = Submission.query.filter_by(name_cn=name_cn, phone=phone).first()
+    sub = event_submissions().filter_by(order_code=code).first()
     if not sub:
         flash("Record not found.", "danger")
         return redirect(url_for("check"))
-    return redirect(url_for("review", oid=sub.order_id, phone=sub.phone))
+    return redirect(url_for("review", code=sub.order_code))
 
 
 
@@ -356,113 +1387,254 @@ def now_utc8():
     return datetime.utcnow() + timedelta(hours=8)
 
 # -----------------------
-#     ADMIN DASHBOARD (UPDATED)
+#     DASHBOARD SUMMARY CACHE
 # -----------------------
-@app.route("/admin", methods=["GET", "POST"])
-@login_required
-def admin_dashboard():
-    page         = int(request.args.get("page", 1))
-    per_page     = int(request.args.get("per_page", 20))
-    search       = request.args.get("search", "").strip()
-    filter_type  = request.args.get("filter_type", "")
-    filter_value = request.args.get("filter_value", "").strip()
-    like = f"%{filter_value}%" if filter_value else "%"
-
-    # DEBUG: print some raw entries from the DB to check option values
-    print("DEBUG: Sample entries JSON:")
-    for (js,) in Submission.query.with_entities(Submission.entries).limit(5):
-        print(js, file=sys.stderr)  # print to stderr to not mix with normal logs
-
-    q = Submission.query
-
-    # Custom filter for 'option' with manual filtering and pagination
-    if filter_type and filter_value:
-        if filter_type == "option":
-            all_subs = q.order_by(Submission.date.desc()).all()
-            filtered_subs = []
-            for sub in all_subs:
-                try:
-                    entries = json.loads(sub.entries)
-                    if any(e.get("option") == filter_value for e in entries):
-                        filtered_subs.append(sub)
-                except Exception:
-                    pass
-
-            total_filtered = len(filtered_subs)
-            start = (page - 1) * per_page
-            end = start + per_page
-            orders = filtered_subs[start:end]
-
-            # Simple pagination class for template compatibility
-            class SimplePagination:
-                def __init__(self, page, per_page, total):
-                    self.page = page
-                    self.per_page = per_page
-                    self.total = total
-                    self.pages = (total + per_page - 1) // per_page
-                @property
-                def has_prev(self): return self.page > 1
-                @property
-                def has_next(self): return self.page < self.pages
-                @property
-                def prev_num(self): return self.page - 1
-                @property
-                def next_num(self): return self.page + 1
-                def iter_pages(self):
-                    return range(1, self.pages + 1)
-
-            pagination = SimplePagination(page, per_page, total_filtered)
-
-        elif filter_type == "paid":
-            # Filter by paid status
+# The stats cards scan the whole submission table, so they are computed
+# once and shared: a single flight per worker (thread lock) and
+# a lease in SQLite across workers.  While a refresh runs, the previous
+# summary is served as long as it has not been stale for longer than
+# SUMMARY_MAX_STALENESS seconds.
+SUMMARY_MAX_STALENESS = int(os.environ.get("SUMMARY_MAX_STALENESS", 30))
+SUMMARY_LEASE_SECONDS = 60
+
+_summary_lock = threading.Lock()
+_summary_flag_lock = threading.Lock()
+_summary_state = {"summary": None, "refreshing": False}
+
+def normalize_gender(raw_g):
+    rg = raw_g.strip().lower()
+    if "男" in raw_g or rg.startswith("m"):
+        return "male"
+    if "女" in raw_g or rg.startswith("f"):
+        return "female"
+    return "unknown"
+
+def compute_dashboard_summary():
+    current = Submission.event_id == active_event_id()
+    num_orders  = event_submissions().count()
+    total_paid  = db.session.query(db.func.sum(Submission.payment_amount)).filter(current, Submission.paid == True).scalar() or 0
+    total_order = db.session.query(db.func.sum(Submission.total)).filter(current).scalar() or 0
+
+    # One pass over every stored entry for the option/gender tally
+    tally = {}
+    for (js,) in event_submissions().with_entities(Submission.entries):
+        try:
+            entries = json.loads(js or "[]")
+        except json.JSONDecodeError:
+            continue
+        for e in entries:
+            raw_opt = e.get("option", "").strip()
+            stat = tally.setdefault(raw_opt, {"total": 0, "male": 0, "female": 0, "unknown": 0})
+            stat["total"] += 1
+            stat[normalize_gender(e.get("gender", ""))] += 1
+
+    # known labels sorted first, free-form/blank options after
+    option_stats = {label: tally[label] for label in sorted(l for l in tally if l)}
+    option_stats.update({label: stat for label, stat in tally.items() if not label})
+
+    return {
+        "event_id": active_event_id(),
+        "num_orders": num_orders,
+        "total_paid": total_paid,
+        "total_order": total_order,
+        "option_stats": option_stats,
+    }
+
+def _summary_from_row(row, version):
+    if row.data_version != version and row.stale_since is None:
+        # the first worker to notice stamps the row, so the bound holds across workers
+        db.session.execute(
+            text("UPDATE summary_cache SET stale_since = :now "
+                 "WHERE key = :key AND data_version = :v AND stale_since IS NULL"),
+            {"now": time.time(), "key": row.key, "v": row.data_version})
+        db.session.commit()
+        db.session.refresh(row)
+    summary = json.loads(row.payload)
+    summary["version"] = row.data_version
+    summary["computed_at"] = row.computed_at
+    summary["stale_since"] = None if row.data_version == version else (row.stale_since or time.time())
+    return summary
+
+def _refresh_summary(version):
+    row = db.session.get(SummaryCache, "dashboard")
+    if row and row.data_version == version:
+        # another worker already did the work
+        summary = _summary_from_row(row, version)
+    elif acquire_lease("dashboard_summary", SUMMARY_LEASE_SECONDS):
+        try:
+            bump_metric("summary_cache.recompute")
+            summary = compute_dashboard_summary()
+            computed_at = now_utc8()
+            row = row or SummaryCache(key="dashboard")
+            row.payload = json.dumps(summary)
+            row.data_version = version
+            row.computed_at = computed_at
+            row.stale_since = None
+            db.session.merge(row)
+            db.session.commit()
+            summary.update(version=version, computed_at=computed_at, stale_since=None)
+        finally:
+            release_lease("dashboard_summary")
+    else:
+        summary = None
+        if row and json.loads(row.payload).get("event_id") == active_event_id():
+            # someone else holds the lease: keep serving their last snapshot
+            # until it has been stale for too long, counted from when it went stale
+            summary = _summary_from_row(row, version)
+            if time.time() - summary["stale_since"] > SUMMARY_MAX_STALENESS:
+                summary = None
+        if summary is None:
+            bump_metric("summary_cache.recompute")
+            summary = compute_dashboard_summary()
+            summary.update(version=version, computed_at=now_utc8(), stale_since=None)
+    _summary_state["summary"] = summary
+    return summary
+
+def _refresh_summary_in_background():
+    try:
+        with app.app_context():
+            with _summary_lock:
+                _refresh_summary(current_data_version())
+    finally:
+        _summary_state["refreshing"] = False
+
+def get_dashboard_summary():
+    version = current_data_version()
+    summary = _summary_state["summary"]
+    if summary and summary["version"] == version:
+        bump_metric("summary_cache.hit")
+        return summary
+
+    if summary and summary.get("event_id") == active_event_id():
+        # stale numbers are fine for a few seconds, another event's are not
+        if summary["stale_since"] is None:
+            summary["stale_since"] = time.time()
+        if time.time() - summary["stale_since"] <= SUMMARY_MAX_STALENESS:
+            bump_metric("summary_cache.stale")
+            with _summary_flag_lock:
+                start = not _summary_state["refreshing"]
+                _summary_state["refreshing"] = True
+            if start:
+                threading.Thread(target=_refresh_summary_in_background, daemon=True).start()
+            return summary
+
+    bump_metric("summary_cache.miss")
+    with _summary_lock:
+        summary = _summary_state["summary"]
+        version = current_data_version()
+        if summary and summary["version"] == version:
+            return summary
+        return _refresh_summary(version)
+
+# ---- ORDERS QUERY (shared by the dashboard and its table fragment) ----
+# Simple pagination class for template compatibility (option filter pages in Python)
+class SimplePagination:
+    def __init__(self, page, per_page, total):
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.pages = (total + per_page - 1) // per_page
+    @property
+    def has_prev(self): return self.page > 1
+    @property
+    def has_next(self): return self.page < self.pages
+    @property
+    def prev_num(self): return self.page - 1
+    @property
+    def next_num(self): return self.page + 1
+    def iter_pages(self):
+        return range(1, self.pages + 1)
+
+def arg_int(args, name, default, lo=1, hi=None):
+    try:
+        value = int(args.get(name, default))
+    except (TypeError, ValueError):
+        value = default
+    value = max(lo, value)
+    return min(hi, value) if hi else value
+
+# ?sort=option,-date : comma-separated keys from this whitelist, "-" = descending.
+# The expressions must match EXTRA_INDEXES text for SQLite to use the index.
+ORDER_SORTS = {
+    "date": Submission.date,
+    "option": func.json_extract(Submission.entries, literal_column("'$[0].option'")),
+    "deceased": func.json_extract(Submission.entries, literal_column("'$[0].name_cn'")),
+    "paid": Submission.paid,
+    "payment_method": Submission.payment_method,
+    "name": Submission.name_cn,
+    "total": Submission.total,
+}
+MAX_SORT_KEYS = 3
+
+def order_clauses(sort):
+    # -> (ORDER BY clauses, normalized sort string); date then id break ties,
+    # running the same way as the first key (newest first by default) so the
+    # whole ORDER BY matches one of the sort indexes
+    clauses, keys = [], []
+    for raw in (sort or "").split(",")[:MAX_SORT_KEYS]:
+        raw = raw.strip()
+        key = raw.lstrip("-")
+        if key not in ORDER_SORTS or key in [k.lstrip("-") for k in keys]:
+            continue
+        clauses.append(ORDER_SORTS[key].desc() if raw.startswith("-") else ORDER_SORTS[key].asc())
+        keys.append(raw)
+    descending = not keys or keys[0].startswith("-")
+    if "date" not in [k.lstrip("-") for k in keys]:
+        clauses.append(Submission.date.desc() if descending else Submission.date.asc())
+    clauses.append(Submission.id.desc() if descending else Submission.id.asc())
+    return clauses, ",".join(keys)
+
+def query_orders(args):
+    page         = arg_int(args, "page", 1)
+    per_page     = arg_int(args, "per_page", 20, hi=100)
+    search       = args.get("search", "").strip()
+    filter_type  = args.get("filter_type", "")
+    filter_value = args.get("filter_value", "").strip()
+    ordering, sort = order_clauses(args.get("sort"))
+    like = f"%{filter_value}%"
+
+    q = event_submissions()
+    if filter_type == "option" and filter_value:
+        # Custom filter for 'option' with manual filtering and pagination
+        filtered_subs = []
+        for sub in q.order_by(*ordering):
+            try:
+                if any(e.get("option") == filter_value for e in json.loads(sub.entries)):
+                    filtered_subs.append(sub)
+            except Exception:
+                pass
+        start = (page - 1) * per_page
+        orders = filtered_subs[start:start + per_page]
+        pagination = SimplePagination(page, per_page, len(filtered_subs))
+    else:
+        if filter_type == "paid" and filter_value:
+            # Unknown values apply no filtering
             if filter_value.lower() == "paid":
                 q = q.filter(Submission.paid == True)
             elif filter_value.lower() == "unpaid":
                 q = q.filter(Submission.paid == False)
-            else:
-                # Unknown value, no filtering applied
-                pass
-            q = q.order_by(Submission.date.desc())
-            pagination = q.paginate(page=page, per_page=per_page, error_out=False)
-            orders = pagination.items
-
-        else:
-            like = f"%{filter_value}%"
-            if filter_type == "gender":
-                q = q.filter(Submission.gender == filter_value)
-            elif filter_type == "name":
-                q = q.filter(or_(
-                    Submission.name_cn.ilike(f"%{filter_value}%"),
-                    Submission.name_en.ilike(f"%{filter_value}%"),
-                    Submission.entries.like(f'%{filter_value}%')
-                ))
-            elif filter_type == "date":
-                q = q.filter(Submission.entries.like(f'%{filter_value}%'))
-            elif filter_type == "remarks":
-                 q = q.filter(Submission.remarks.ilike(f"%{filter_value}%"))
-            else:
-                q = q.filter(or_(
-                    Submission.order_id.ilike(like),
-                    Submission.name_cn.ilike(like),
-                    Submission.name_en.ilike(like),
-                    Submission.phone.ilike(like)
-                ))
-            q = q.order_by(Submission.date.desc())
-            pagination = q.paginate(page=page, per_page=per_page, error_out=False)
-            orders = pagination.items
-
-        # No filter or empty filter: normal pagination
-    else:
-        q = q.filter(or_(
-            Submission.order_id.ilike(like),
-            Submission.name_cn.ilike(like),
-            Submission.name_en.ilike(like),
-            Submission.phone.ilike(like)
-        ))
-
-        q = q.order_by(Submission.date.desc())
-        pagination = q.paginate(page=page, per_page=per_page, error_out=False)
-        orders     = pagination.items
+        elif filter_type == "gender" and filter_value:
+            q = q.filter(Submission.gender == filter_value)
+        elif filter_type == "name" and filter_value:
+            q = q.filter(or_(
+                Submission.name_cn.ilike(like),
+                Submission.name_en.ilike(like),
+                Submission.entries.like(like)
+            ))
+        elif filter_type == "date" and filter_value:
+            q = q.filter(Submission.entries.like(like))
+        elif filter_type == "remarks" and filter_value:
+            q = q.filter(Submission.remarks.ilike(like))
+        elif filter_value:
+            # Order ID, or a value without a type: search the main columns
+            q = q.filter(or_(
+                Submission.order_id.ilike(like),
+                Submission.name_cn.ilike(like),
+                Submission.name_en.ilike(like),
+                Submission.phone.ilike(like)
+            ))
+        pagination = q.order_by(*ordering).paginate(page=page, per_page=per_page, error_out=False)
+        orders = pagination.items
 
     # enrich each submission with formatted entry dates
     for o in orders:
@@ -471,99 +1643,69 @@ def admin_dashboard():
             for e in entries:
                 e["death_date_label"] = label_date(e)
             o.enriched_entries = entries
-        except:
+        except Exception:
             o.enriched_entries = []
 
-    num_orders  = Submission.query.count()
-    total_paid  = db.session.query(db.func.sum(Submission.payment_amount)).filter_by(paid=True).scalar() or 0
-    total_order = db.session.query(db.func.sum(Submission.total)).scalar() or 0
+    # pagination links keep the current filter
+    page_args = {k: v for k, v in args.items() if k != "page"}
+    return dict(orders=orders, pagination=pagination, per_page=per_page, page=page,
+                search=search, filter_type=filter_type, filter_value=filter_value,
+                sort=sort, page_args=page_args)
 
-    # — 1) Auto‑discover all option labels actually stored in the DB —
-    raw_labels = {
-        e.get("option", "").strip()
-        for (js,) in Submission.query.with_entities(Submission.entries)
-        for e in json.loads(js or "[]")
-        if e.get("option", "").strip()
-    }
-
-    # — helper to normalize ANY gender string —
-    def normalize_gender(raw_g):
-        rg = raw_g.strip().lower()
-        if "男" in raw_g or rg.startswith("m"):
-            return "male"
-        if "女" in raw_g or rg.startswith("f"):
-            return "female"
-        return "unknown"
-
-    # — 2) Initialize counters for each discovered option —
-    option_stats = {
-        label: {"total": 0, "male": 0, "female": 0, "unknown": 0}
-        for label in sorted(raw_labels)
-    }
 
-    # — 3) Tally up every stored entry —
-    for (entry_json,) in Submission.query.with_entities(Submission.entries):
-        try:
-            entries = json.loads(entry_json)
-        except json.JSONDecodeError:
-            continue
-
-        for e in entries:
-            raw_opt = e.get("option", "").strip()
-            # ensure even free‑form options get counted
-            option_stats.setdefault(raw_opt, {"total":0,"male":0,"female":0,"unknown":0})
-            stat = option_stats[raw_opt]
-            stat["total"] += 1
-
-            # use our normalizer instead of a static map
-            who = normalize_gender(e.get("gender", ""))
-            stat[who] += 1
-
-    filter_values = {
-        "order_id":       [r[0] for r in db.session.query(Submission.order_id).distinct()],
-        "boat":           [r[0] for r in db.session.query(Submission.boat).distinct()],
-        "gender":         [r[0] for r in db.session.query(Submission.gender).distinct()],
-        "name":           list({r[0] for r in db.session.query(Submission.name_cn).distinct()}) +
-                           list({r[0] for r in db.session.query(Submission.name_en).distinct()}),
-        "phone":          [r[0] for r in db.session.query(Submission.phone).distinct()],
-        "payment_method": [r[0] for r in db.session.query(Submission.payment_method).distinct()],
-        "option":         sorted({
-                              e.get("option","")
-                              for (js,) in db.session.query(Submission.entries)
-                              for e in json.loads(js or "[]")
-                            }),
-        "date":           sorted({
-                              e.get("death_date_label","Notsure")
-                              for (js,) in db.session.query(Submission.entries)
-                              for e in json.loads(js or "[]")
-                            }),
-    }
+# -----------------------
+#     ADMIN DASHBOARD (UPDATED)
+# -----------------------
+@app.route("/admin", methods=["GET", "POST"])
+@login_required
+def admin_dashboard():
+    ctx = query_orders(request.args)
+    summary = get_dashboard_summary()
+    event = active_event()
 
     return render_template("admin.html",
-        orders=orders,
-        pagination=pagination,
-        per_page=per_page,
-        page=page,
-        search=search,
-        filter_type=filter_type,
-        filter_value=filter_value,
-        filter_values=filter_values,
+        **ctx,
+        event_name=event.name if event else "",
         pause=SysState.query.first().pause,
-        num_orders=num_orders,
-        total_paid=total_paid,
-        total_order=total_order,
-        option_stats=option_stats,
-        last_updated=now_utc8().strftime("%Y-%m-%d %I:%M %p"),
+        num_orders=summary["num_orders"],
+        total_paid=summary["total_paid"],
+        total_order=summary["total_order"],
+        option_stats=summary["option_stats"],
+        last_updated=summary["computed_at"].strftime("%Y-%m-%d %I:%M %p"),
+        max_staleness=SUMMARY_MAX_STALENESS,
         is_owner=is_owner()
     )
 
+# -----------------------
+#     AJAX: DASHBOARD FRAGMENTS
+# -----------------------
+# Paging, filtering and "Refresh" swap in just the orders table (and, on their
+# own schedule, the summary cards) instead of re-rendering the whole page.
+@app.route("/admin/fragment/orders")
+@login_required
+def admin_fragment_orders():
+    return render_template("_orders_table.html", **query_orders(request.args), is_owner=is_owner())
+
+@app.route("/admin/fragment/summary")
+@login_required
+def admin_fragment_summary():
+    summary = get_dashboard_summary()
+    return render_template("_summary_cards.html",
+        num_orders=summary["num_orders"],
+        total_paid=summary["total_paid"],
+        total_order=summary["total_order"],
+        option_stats=summary["option_stats"],
+        last_updated=summary["computed_at"].strftime("%Y-%m-%d %I:%M %p"))
+
 # -----------------------
 #     AJAX: FULL DASHBOARD REFRESH
 # -----------------------
 @app.route("/admin/refresh", methods=["GET"])
 @login_required
 def admin_refresh():
-    q = Submission.query.order_by(Submission.date.desc()).all()
+    ordering, _ = order_clauses(request.args.get("sort"))
+    with read_session() as rs:
+        q = event_submissions(rs).order_by(*ordering).all()
     orders_data = []
 
     for o in q:
@@ -577,6 +1719,7 @@ def admin_refresh():
         orders_data.append({
             "id": o.id,
             "order_id": o.order_id,
+            "order_code": o.order_code,
             "name_cn": o.name_cn,
             "name_en": o.name_en,
             "gender": o.gender,
@@ -593,13 +1736,173 @@ def admin_refresh():
 
     return jsonify({"orders": orders_data})
 
+# -----------------------
+#     AJAX: FILTER SUGGESTIONS (TYPE-AHEAD)
+# -----------------------
+# Instead of shipping every distinct value with the page, each worker keeps a
+# sorted prefix index per filter type.  Local writes are applied as they
+# commit; rows inserted by other workers are picked up by id when the data
+# version moves, and the whole index is rebuilt every few minutes so edits
+# and deletes made elsewhere eventually drop out.
+SUGGEST_LIMIT = 10
+SUGGEST_REBUILD_SECONDS = int(os.environ.get("SUGGEST_REBUILD_SECONDS", 600))
+SUGGEST_TYPES = ("order_id", "boat", "gender", "name", "phone", "payment_method", "option", "date", "remarks")
+SUGGEST_ALIASES = {"order": "order_id"}
+
+def suggest_values(sub):
+    # filter type -> values this submission contributes to the index
+    try:
+        entries = json.loads(sub.entries or "[]")
+    except (TypeError, json.JSONDecodeError):
+        entries = []
+    return {
+        "order_id": [sub.order_id, sub.order_code],
+        "boat": [sub.boat],
+        "gender": [sub.gender],
+        "name": [sub.name_cn, sub.name_en] + [e.get("name_cn", "") for e in entries],
+        "phone": [sub.phone],
+        "payment_method": [sub.payment_method],
+        "option": [e.get("option", "") for e in entries],
+        "date": [e.get("death_date_label") or label_date(e) for e in entries],
+        "remarks": [sub.remarks],
+    }
+
+class SuggestIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = {t: [] for t in SUGGEST_TYPES}     # sorted casefolded values
+        self.values = {t: {} for t in SUGGEST_TYPES}   # casefolded -> {value: refcount}
+        self.rows = {}                                 # submission id -> suggest_values()
+        self.max_id = 0
+        self.version = None
+        self.event_id = None
+        self.built_at = 0
+
+    def _add(self, ftype, value):
+        key = value.casefold()
+        bucket = self.values[ftype].get(key)
+        if bucket is None:
+            bucket = self.values[ftype][key] = {}
+            insort(self.keys[ftype], key)
+        bucket[value] = bucket.get(value, 0) + 1
+
+    def _remove(self, ftype, value):
+        key = value.casefold()
+        bucket = self.values[ftype].get(key)
+        if not bucket or value not in bucket:
+            return
+        bucket[value] -= 1
+        if bucket[value] <= 0:
+            del bucket[value]
+        if not bucket:
+            del self.values[ftype][key]
+            keys = self.keys[ftype]
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                del keys[i]
+
+    def upsert(self, sub_id, values):
+        with self.lock:
+            self.discard(sub_id, locked=True)
+            values = {t: sorted({str(v).strip() for v in vs if v and str(v).strip()}) for t, vs in values.items()}
+            for ftype, vs in values.items():
+                for v in vs:
+                    self._add(ftype, v)
+            self.rows[sub_id] = values
+
+    def discard(self, sub_id, locked=False):
+        if not locked:
+            with self.lock:
+                return self.discard(sub_id, locked=True)
+        for ftype, vs in self.rows.pop(sub_id, {}).items():
+            for v in vs:
+                self._remove(ftype, v)
+
+    def search(self, ftype, prefix, limit):
+        prefix = prefix.casefold()
+        out = []
+        with self.lock:
+            keys = self.keys[ftype]
+            i = bisect_left(keys, prefix)
+            while i < len(keys) and keys[i].startswith(prefix) and len(out) < limit:
+                bucket = self.values[ftype][keys[i]]
+                out.append(max(bucket, key=bucket.get))
+                i += 1
+        return out
+
+_suggest_index = SuggestIndex()
+_suggest_build_lock = threading.Lock()
+
+def get_suggest_index():
+    global _suggest_index
+    version, event_id = current_data_version(), active_event_id()
+    index = _suggest_index
+    if (index.version == version and index.event_id == event_id
+            and time.time() - index.built_at < SUGGEST_REBUILD_SECONDS):
+        return index
+    with _suggest_build_lock:
+        index = _suggest_index
+        if time.time() - index.built_at >= SUGGEST_REBUILD_SECONDS or index.event_id != event_id:
+            index = SuggestIndex()
+            index.event_id = event_id
+            index.built_at = time.time()
+        # only rows the loader has not seen yet (local commits don't move
+        # max_id, so rows committed meanwhile by other workers aren't skipped)
+        for sub in event_submissions().filter(Submission.id > index.max_id).order_by(Submission.id):
+            index.upsert(sub.id, suggest_values(sub))
+            index.max_id = sub.id
+        index.version = version
+        _suggest_index = index
+    return index
+
+@event.listens_for(db.session, "after_flush")
+def collect_suggest_changes(session, flush_context):
+    pending = session.info.setdefault("suggest_changes", {})
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Submission) and obj.id is not None and obj.event_id == _suggest_index.event_id:
+            pending[obj.id] = suggest_values(obj)
+    for obj in session.deleted:
+        if isinstance(obj, Submission):
+            pending[obj.id] = None
+
+@event.listens_for(db.session, "after_commit")
+def apply_suggest_changes(session):
+    changes = session.info.pop("suggest_changes", {})
+    if not _suggest_index.built_at:
+        return  # nothing built yet; the first load will see these rows
+    for sub_id, values in changes.items():
+        if values is None:
+            _suggest_index.discard(sub_id)
+        else:
+            _suggest_index.upsert(sub_id, values)
+
+@event.listens_for(db.session, "after_rollback")
+def drop_suggest_changes(session):
+    session.info.pop("suggest_changes", None)
+
+@app.route("/admin/suggest")
+@login_required
+def admin_suggest():
+    ftype = request.args.get("type", "")
+    ftype = SUGGEST_ALIASES.get(ftype, ftype)
+    if ftype not in SUGGEST_TYPES:
+        return jsonify({"ok": False, "error": "Unknown filter type."}), 400
+    prefix = request.args.get("prefix", "").strip()
+    try:
+        limit = min(int(request.args.get("limit", SUGGEST_LIMIT)), 50)
+    except ValueError:
+        limit = SUGGEST_LIMIT
+    values = get_suggest_index().search(ftype, prefix, limit)
+    return jsonify({"ok": True, "type": ftype, "values": values})
+
 # -----------------------
 #     AJAX: MARK PAID with Total Update
 # -----------------------
 @app.route("/admin/paid/<int:subid>", methods=["POST"])
 @login_required
+@write_gated
 def admin_mark_paid(subid):
-    sub = Submission.query.get_or_404(subid)
+    sub = get_submission_or_404(subid)
 
     # 1. Get payment_amount from request if provided
     amt = request.form.get("payment_amount")
@@ -633,7 +1936,7 @@ def admin_mark_paid(subid):
     )
 
     # 4. Stats: Always sum payment_amount for paid
-    total_paid = db.session.query(db.func.sum(Submission.payment_amount)).filter_by(paid=True).scalar() or 0
+    total_paid = total_paid_amount()
 
     return jsonify({
         "ok": True,
@@ -645,10 +1948,9 @@ def admin_mark_paid(subid):
 # ---- HELPERS ----
 # Ensures all entry values are in canonical form for frontend dropdowns
 def normalize_entry(e):
-    valid_options = ["祖先", "冤亲债主", "无主孤魂", "婴灵", "狗狗"]
     # Option normalization
     opt = e.get("option", "")
-    if opt not in valid_options: opt = ""
+    if opt not in VALID_OPTIONS: opt = ""
     # Gender normalization
     g = (e.get("gender") or "").strip().lower()
     if g in ["男", "m", "male"]: g = "male"
@@ -683,11 +1985,22 @@ def is_admin():
 # -----------------------
 @app.route("/admin/edit/<int:subid>", methods=["GET", "POST"])
 @login_required
+@write_gated
 def admin_edit(subid):
     global recently_edited_submission
-    sub = Submission.query.get_or_404(subid)
+    sub = get_submission_or_404(subid)
 
     if request.method == "POST":
+        # Inline amount/remarks edits post only those keys; the modal posts everything
+        fields, count, ent, errors = parse_submission_form(request.form, partial=True)
+        try:
+            payment_amount = int(request.form.get("payment_amount") or sub.payment_amount or 0)
+        except ValueError:
+            payment_amount = -1
+        if payment_amount < 0:
+            errors.append("Payment amount must be a whole number of ringgit")
+        if errors:
+            return jsonify({"ok": False, "error": "; ".join(errors[:5])}), 400
 
         # Save current state BEFORE overwriting
         recently_edited_submission = {
@@ -709,37 +2022,26 @@ def admin_edit(subid):
         }
 
         # Update basic fields from form data
-        for field in ["boat", "gender", "name_cn", "name_en", "phone", "payment_method"]:
-            setattr(sub, field, request.form.get(field, getattr(sub, field)))
-
-        # Update count
-        sub.count = int(request.form.get("count", sub.count))
+        for field, value in fields.items():
+            setattr(sub, field, value)
 
         # Always recalculate total amount based on boat & count
-        boat = request.form.get("boat", sub.boat)
-        free_count = 6 if boat == "yes" else 0
-        chargeable = max(0, sub.count - free_count)
-        sub.total = chargeable * 38
+        if ent is not None:
+            sub.count = count
+            for entry in ent:
+                entry["death_date_label"] = label_date(entry)
+            sub.entries = json.dumps(ent)
+        sub.total = calc_total(sub.boat, sub.count)
 
         # Update other fields
-        sub.payment_amount = int(request.form.get("payment_amount", sub.payment_amount or 0))
+        sub.payment_amount = payment_amount
         sub.remarks = request.form.get("remarks", sub.remarks or "")
-
-        # Collect and validate entries
-        ent = []
-        for i in range(1, sub.count + 1):
-            entry = {
-                k: request.form.get(f"d{i}_{k}", "")
-                for k in ("option", "name_cn", "gender", "calendar", "year", "month", "day")
-            }
-            # Prevent blank option from being saved
-            if not entry['option']:
-                return jsonify({"ok": False, "error": f"Entry {i} option cannot be blank."}), 400
-            entry["death_date_label"] = label_date(entry)
-            ent.append(entry)
-
-        sub.entries = json.dumps(ent)
-        db.session.commit()
+        g.enforce_capacity = True
+        try:
+            db.session.commit()
+        except CapacityError as e:
+            db.session.rollback()
+            return jsonify({"ok": False, "error": str(e)}), 409
 
         # Log the edit action with the current username from session
         log_admin(
@@ -752,7 +2054,6 @@ def admin_edit(subid):
 
     # GET request: return current data for modal
     entries = [normalize_entry(e) for e in json.loads(sub.entries)] if sub.entries else []
-    print("DEBUG: Entries for modal edit:", entries, file=sys.stderr)
     return jsonify({
         **{f: getattr(sub, f) for f in ("boat", "gender", "name_cn", "name_en", "phone", "payment_method")},
         "count": sub.count,
@@ -768,7 +2069,7 @@ def admin_edit(subid):
 @app.route("/admin/send_reminder/<int:subid>", methods=["POST"])
 @login_required
 def admin_send_reminder(subid):
-    sub = Submission.query.get_or_404(subid)
+    sub = get_submission_or_404(subid)
     current_user = session.get('username', 'unknown')
 
     # If already paid, don't send
@@ -780,20 +2081,8 @@ def admin_send_reminder(subid):
         return jsonify({"ok": False, "msg": "No payment needed (FOC)."})
 
     # If unpaid and total > 0, allow sending WhatsApp reminder
-    # (if you want to add emoji in the message, you can! Just make sure WhatsApp displays it correctly.)
-    base_url = request.host_url.rstrip('/')
-    check_link = f"{base_url}/check"
-    msg = (
-        "您好。Hi. 👋🏻\n"
-        "请尽快结清。Kindly settle your payment as soon as possible.\n"
-        "To check your payment status and amount, please visit the link below:\n"
-        "\n"
-        f"{check_link}\n"
-        "\n"
-        f"Please enter your Order ID: {sub.order_id}\n"
-        "谢谢! Thank you! ☺️🙏"
-    )
-    number = sub.phone.replace("+", "").replace(" ", "")
+    msg = reminder_message([sub.order_code], request.host_url.rstrip('/'))
+    number = whatsapp_number(sub.phone)
     link = f"https://wa.me/{number}?text={quote(msg)}"
 
     log_admin(
@@ -804,6 +2093,172 @@ def admin_send_reminder(subid):
     return jsonify({"ok": True, "whatsapp_link": link})
 
 
+# -----------------------
+#     WHATSAPP CAMPAIGNS (OUTBOX)
+# -----------------------
+# A campaign renders one reminder per phone number for every unpaid, non-FOC
+# order and queues them in the outbox table.  A background thread drains the
+# queue at OUTBOX_RATE_PER_MIN through the configured gateway; a lease makes
+# sure only one worker sends at a time.  Numbers messaged within
+# OUTBOX_DEDUPE_HOURS are skipped.
+#
+# WHATSAPP_GATEWAY is "fake" (append to FAKE_WHATSAPP_LOG) or "module:Class";
+# the class takes no arguments and has send(phone, body), raising on failure.
+OUTBOX_RATE_PER_MIN = float(os.environ.get("OUTBOX_RATE_PER_MIN", 20))
+OUTBOX_DEDUPE_HOURS = float(os.environ.get("OUTBOX_DEDUPE_HOURS", 24))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 3))
+OUTBOX_LEASE_SECONDS = 60
+WHATSAPP_GATEWAY = os.environ.get("WHATSAPP_GATEWAY", "fake")
+FAKE_WHATSAPP_LOG = os.environ.get("FAKE_WHATSAPP_LOG", os.path.join(os.path.dirname(str(db_file)), "whatsapp-fake.jsonl"))
+
+_outbox_lock = threading.Lock()
+_outbox_state = {"running": False, "gateway": None}
+
+class FakeGateway:
+    def send(self, phone, body):
+        with open(FAKE_WHATSAPP_LOG, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"ts": time.time(), "to": phone, "body": body}, ensure_ascii=False) + "\n")
+
+def get_gateway():
+    if _outbox_state["gateway"] is None:
+        if WHATSAPP_GATEWAY == "fake":
+            gateway = FakeGateway()
+        else:
+            module, _, name = WHATSAPP_GATEWAY.partition(":")
+            gateway = getattr(importlib.import_module(module), name)()
+        _outbox_state["gateway"] = gateway
+    return _outbox_state["gateway"]
+
+def whatsapp_number(phone):
+    return re.sub(r"\D", "", phone or "")
+
+def reminder_message(order_codes, base_url):
+    return (
+        "您好。Hi. 👋🏻\n"
+        "请尽快结清。Kindly settle your payment as soon as possible.\n"
+        "To check your payment status and amount, please visit the link below:\n"
+        "\n"
+        f"{base_url}/check\n"
+        "\n"
+        f"Please enter your Order ID: {', '.join(order_codes)}\n"
+        "谢谢! Thank you! ☺️🙏"
+    )
+
+def recently_messaged(numbers):
+    since = time.time() - OUTBOX_DEDUPE_HOURS * 3600
+    rows = (db.session.query(Outbox.phone)
+            .filter(Outbox.phone.in_(numbers), Outbox.created >= since,
+                    Outbox.status.in_(("queued", "sending", "sent"))))
+    return {phone for (phone,) in rows}
+
+def campaign_candidates():
+    # {number: [unpaid order codes]}, oldest orders first; (event_id, paid) index
+    numbers = {}
+    unpaid = (event_submissions()
+              .filter(Submission.paid == False, Submission.total > 0)
+              .with_entities(Submission.phone, Submission.order_code)
+              .order_by(Submission.date))
+    for phone, code in unpaid:
+        number = whatsapp_number(phone)
+        if number:
+            numbers.setdefault(number, []).append(code)
+    return numbers
+
+def enqueue_messages(messages, campaign):
+    # messages: {number: body} -> how many were queued (the rest were deduped)
+    fresh = {n: body for n, body in messages.items() if n}
+    for number in recently_messaged(list(fresh)):
+        del fresh[number]
+    now, event_id = time.time(), active_event_id()
+    db.session.add_all([Outbox(event_id=event_id, campaign=campaign, phone=number, body=body,
+                               status="queued", created=now) for number, body in fresh.items()])
+    db.session.commit()
+    bump_metric("outbox.queued", len(fresh))
+    bump_metric("outbox.deduped", len(messages) - len(fresh))
+    if fresh:
+        kick_outbox()
+    return len(fresh)
+
+def kick_outbox():
+    with _outbox_lock:
+        if _outbox_state["running"]:
+            return
+        _outbox_state["running"] = True
+    threading.Thread(target=_drain_outbox, daemon=True).start()
+
+def _drain_outbox():
+    try:
+        with app.app_context():
+            if not acquire_lease("outbox", OUTBOX_LEASE_SECONDS):
+                return  # another worker is sending
+            try:
+                # a sender that died mid-send may have delivered: don't repeat it
+                Outbox.query.filter_by(event_id=active_event_id(), status="sending").update(
+                    {"status": "failed", "error": "Interrupted while sending"})
+                db.session.commit()
+                gateway = get_gateway()
+                while True:
+                    # re-read each time: a switched event stops sending the old one's queue
+                    msg = (Outbox.query.filter_by(event_id=active_event_id(), status="queued")
+                           .order_by(Outbox.id).first())
+                    if not msg:
+                        break
+                    msg.status = "sending"
+                    msg.attempts = (msg.attempts or 0) + 1
+                    db.session.commit()
+                    try:
+                        gateway.send(msg.phone, msg.body)
+                        msg.status, msg.sent_at, msg.error = "sent", time.time(), None
+                        bump_metric("outbox.sent")
+                    except Exception as e:
+                        msg.status = "queued" if msg.attempts < OUTBOX_MAX_ATTEMPTS else "failed"
+                        msg.error = str(e)[:200]
+                        bump_metric("outbox.errors")
+                    db.session.commit()
+                    time.sleep(60.0 / OUTBOX_RATE_PER_MIN)
+                    if not acquire_lease("outbox", OUTBOX_LEASE_SECONDS):
+                        break
+            finally:
+                release_lease("outbox")
+    finally:
+        _outbox_state["running"] = False
+
+@app.route("/admin/campaigns", methods=["GET", "POST"])
+@login_required
+def admin_campaigns():
+    current_user = session.get('username', 'unknown')
+    if request.method == "POST":
+        action = request.form.get("action")
+        if action == "start":
+            base_url = request.host_url.rstrip('/')
+            numbers = campaign_candidates()
+            campaign = f"Unpaid {now_utc8():%Y-%m-%d %H:%M}"
+            queued = enqueue_messages({n: reminder_message(codes, base_url) for n, codes in numbers.items()},
+                                      campaign)
+            log_admin("Start reminder campaign", current_user,
+                      f"{campaign}: queued {queued} of {len(numbers)} numbers")
+            flash(f"Queued {queued} reminders; {len(numbers) - queued} numbers were messaged recently.", "success")
+        elif action == "cancel":
+            cancelled = (Outbox.query.filter_by(event_id=active_event_id(), status="queued")
+                         .update({"status": "cancelled"}))
+            log_admin("Cancel reminders", current_user, f"Cancelled {cancelled} queued reminders")
+            flash(f"Cancelled {cancelled} queued reminders.", "warning")
+        return redirect(url_for("admin_campaigns"))
+
+    counts = dict(db.session.query(Outbox.status, func.count(Outbox.id))
+                  .filter(Outbox.event_id == active_event_id()).group_by(Outbox.status).all())
+    if counts.get("queued"):
+        kick_outbox()  # e.g. after a restart
+    numbers = campaign_candidates()
+    recent = recently_messaged(list(numbers))
+    messages = (Outbox.query.filter(Outbox.event_id == active_event_id())
+                .order_by(Outbox.id.desc()).limit(100).all())
+    return render_template("campaigns.html", counts=counts, messages=messages,
+                           eligible=len(numbers), recent=len(recent),
+                           orders=sum(len(codes) for codes in numbers.values()),
+                           rate=OUTBOX_RATE_PER_MIN, dedupe_hours=OUTBOX_DEDUPE_HOURS,
+                           gateway=WHATSAPP_GATEWAY)
+
 
 # -----------------------
 #     EXPORT EXCEL
@@ -811,7 +2266,8 @@ def admin_send_reminder(subid):
 @app.route("/admin/export/excel")
 @login_required
 def export_excel():
-    orders = Submission.query.all()
+    with read_session() as rs:
+        orders = event_submissions(rs).all()
     rows = []
     option_bilingual = {
         "祖先": "祖先 (Ancestor)",
@@ -841,6 +2297,7 @@ def export_excel():
         base = {
             "Timestamp": o.date.strftime("%Y-%m-%d %H:%M"),
             "Order ID": o.order_id,
+            "Order Code": o.order_code,
             "Boat": boat_val,
             "Gender": gender_val,
             "Chinese Name": o.name_cn,
@@ -863,9 +2320,19 @@ def export_excel():
         rows.append(base)
     
     df = pd.DataFrame(rows)
+    # problems found by the consistency scan go on a second sheet, so
+    # re-importing the first sheet is unaffected
+    checks = cached_consistency_scan()
+    problems = [{"Check": label, "Order ID": r["order_id"], "Count": r["count"],
+                 "Entries": r["n_entries"], "Total": r["total"], "Expected Total": r["expected_total"],
+                 "Paid": "Yes" if r["paid"] else "No", "Paid Amt": r["payment_amount"],
+                 "Unknown Options": r["unknown_options"]}
+                for check, label in CONSISTENCY_CHECKS.items() for r in checks["samples"].get(check, [])]
     buf = io.BytesIO()
     with pd.ExcelWriter(buf, engine='xlsxwriter') as w:
         df.to_excel(w, index=False)
+        if problems:
+            pd.DataFrame(problems).to_excel(w, sheet_name="Checks", index=False)
     buf.seek(0)
 
     # Log the export action
@@ -873,16 +2340,686 @@ def export_excel():
         action="Export Excel",
         user=session.get('username', 'unknown'),
         detail=f"Exported Excel report with {len(orders)} submissions"
+               + (f" ({sum(checks['counts'].values())} consistency problems)" if problems else "")
     )
 
     return send_file(
         buf,
         as_attachment=True,
-        download_name="2025 - Spirits.xlsx",
+        download_name=f"{export_basename()} - Spirits.xlsx",
         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
 
 
+# -----------------------
+#     PRINTING (TABLETS & RUN SHEETS)
+# -----------------------
+# Every deceased name becomes a tablet, and each option gets a numbered run
+# sheet.  Names are grouped per option and big options cut into shards of
+# PDF_SHARD_SIZE; printing.py renders the shards in a process pool and the
+# PDFs are bundled into one ZIP per (event, data version, kind, option).
+PDF_FONT_PATH = os.environ.get("PDF_FONT_PATH", os.path.join(app.root_path, "static", "NotoSansSC-Regular.ttf"))
+PDF_CACHE_DIR = os.environ.get("PDF_CACHE_DIR", os.path.join(os.path.dirname(str(db_file)), "pdf-cache"))
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", min(os.cpu_count() or 1, 4)))
+PDF_SHARD_SIZE = int(os.environ.get("PDF_SHARD_SIZE", 1000))
+PDF_KINDS = {"tablets": "Tablets", "runsheet": "Run Sheet"}
+printing = LazyModule("printing")
+
+def print_rows(option=""):
+    # {option: [row, ...]} in order-id order, for the active event
+    groups = {opt: [] for opt in VALID_OPTIONS if not option or opt == option}
+    query = (event_submissions()
+             .with_entities(Submission.order_id, Submission.name_cn, Submission.entries)
+             .order_by(Submission.order_id, Submission.id))
+    for order_id, sponsor, entries in query:
+        for e in json.loads(entries or "[]"):
+            rows = groups.get(e.get("option", ""))
+            if rows is not None:
+                rows.append({"option": e["option"], "order_id": order_id or "", "sponsor": sponsor or "",
+                             "name": e.get("name_cn", ""), "gender": normalize_entry(e)["gender"],
+                             "date": label_date(e)})
+    return {opt: rows for opt, rows in groups.items() if rows}
+
+def print_jobs(kind, groups, workdir):
+    jobs = []
+    for option, rows in groups.items():
+        starts = range(0, len(rows), PDF_SHARD_SIZE)
+        for part, start in enumerate(starts, 1):
+            suffix = f" ({part} of {len(starts)})" if len(starts) > 1 else ""
+            jobs.append({
+                "kind": kind, "title": f"{option} {PDF_KINDS[kind]}{suffix}",
+                "font": PDF_FONT_PATH, "font_cache": PDF_CACHE_DIR,
+                "start": start, "rows": rows[start:start + PDF_SHARD_SIZE],
+                "out": os.path.join(workdir, f"{option} {PDF_KINDS[kind]}{suffix}.pdf"),
+            })
+    return jobs
+
+def build_print_bundle(kind, option=""):
+    # -> path of the cached ZIP, or None when there is nothing to print
+    version, event_id = current_data_version(), active_event_id()
+    key = VALID_OPTIONS.index(option) if option else "all"
+    path = os.path.join(PDF_CACHE_DIR, f"e{event_id}-v{version}-{kind}-{key}.zip")
+    if os.path.exists(path):
+        bump_metric("pdf.cache_hits")
+        return path
+    bump_metric("pdf.cache_misses")
+    groups = print_rows(option)
+    if not groups:
+        return None
+
+    started = time.perf_counter()
+    os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+    printing.prepare_font(PDF_FONT_PATH, PDF_CACHE_DIR)
+    workdir = tempfile.mkdtemp(dir=PDF_CACHE_DIR)
+    try:
+        jobs = print_jobs(kind, groups, workdir)
+        if PDF_WORKERS > 1 and len(jobs) > 1:
+            # spawn, not fork: gunicorn workers run threads, and the children
+            # only need printing.py + fpdf
+            with ProcessPoolExecutor(min(PDF_WORKERS, len(jobs)),
+                                     mp_context=multiprocessing.get_context("spawn")) as pool:
+                drawn = sum(pool.map(printing.render_shard, jobs))
+        else:
+            drawn = sum(printing.render_shard(job) for job in jobs)
+        partial = os.path.join(workdir, "bundle.zip")
+        with zipfile.ZipFile(partial, "w", zipfile.ZIP_DEFLATED) as bundle:
+            for job in jobs:
+                bundle.write(job["out"], os.path.basename(job["out"]))
+        os.replace(partial, path)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # bundles of older data versions can never be served again
+    for name in os.listdir(PDF_CACHE_DIR):
+        if name.endswith(".zip") and not name.startswith(f"e{event_id}-v{version}-"):
+            os.remove(os.path.join(PDF_CACHE_DIR, name))
+    bump_metric("pdf.names", drawn)
+    bump_metric("pdf.render_ms", int((time.perf_counter() - started) * 1000))
+    return path
+
+@app.route("/admin/print")
+@login_required
+def admin_print():
+    return render_template("print.html", kinds=PDF_KINDS, options=VALID_OPTIONS,
+                           font_ok=os.path.exists(PDF_FONT_PATH), font_path=PDF_FONT_PATH,
+                           counts={opt: len(rows) for opt, rows in print_rows().items()})
+
+@app.route("/admin/print/download")
+@login_required
+def admin_print_download():
+    kind = request.args.get("kind", "")
+    option = request.args.get("option", "")
+    if kind not in PDF_KINDS or (option and option not in VALID_OPTIONS):
+        abort(400)
+    if not os.path.exists(PDF_FONT_PATH):
+        flash(f"No CJK font at {PDF_FONT_PATH}: set PDF_FONT_PATH to a .ttf with Chinese glyphs.", "danger")
+        return redirect(url_for("admin_print"))
+    try:
+        path = build_print_bundle(kind, option)
+    except RuntimeError as e:
+        # fpdf 1.7 only embeds TrueType outlines; CFF-based .otf files fail here
+        flash(f"Could not render with {PDF_FONT_PATH}: {e}", "danger")
+        return redirect(url_for("admin_print"))
+    if not path:
+        flash("Nothing to print yet.", "warning")
+        return redirect(url_for("admin_print"))
+
+    label = f"{PDF_KINDS[kind]} - {option}" if option else PDF_KINDS[kind]
+    log_admin(
+        action="Export PDF",
+        user=session.get('username', 'unknown'),
+        detail=f"Downloaded {label}"
+    )
+    return send_file(path, as_attachment=True, download_name=f"{export_basename()} - {label}.zip",
+                     mimetype="application/zip")
+
+
+# -----------------------
+#     REPORTS
+# -----------------------
+# Each worker keeps two columnar extracts of the active event -- one row per
+# order, one row per entry (SQLite's json_each unpacks the entries) -- and
+# the report tables are pandas pivots over them.  While only new orders
+# arrive (edit_version unchanged) just the new ids are read and appended;
+# any edit or delete reads the event again.
+REPORT_ORDER_SQL = """
+    SELECT id, date, boat, payment_method, count, total, paid, payment_amount
+    FROM submission WHERE event_id = :event_id AND id > :after
+"""
+REPORT_ENTRY_SQL = """
+    SELECT s.id AS submission_id, json_extract(e.value, '$.option') AS option,
+           json_extract(e.value, '$.gender') AS gender
+    FROM submission s, json_each(s.entries) e
+    WHERE s.event_id = :event_id AND s.id > :after AND json_valid(s.entries)
+"""
+AGING_BINS = [0, 1, 3, 7, 14, float("inf")]
+AGING_LABELS = ["< 1 day", "1-3 days", "3-7 days", "7-14 days", "14+ days"]
+
+_reports_lock = threading.Lock()
+_reports_state = {}
+
+def read_report_rows(conn, event_id, after=0):
+    params = {"event_id": event_id, "after": after}
+    orders = pd.read_sql_query(text(REPORT_ORDER_SQL), conn, params=params, parse_dates=["date"])
+    orders["paid"] = orders["paid"].fillna(0).astype(bool)
+    orders[["count", "total", "payment_amount"]] = orders[["count", "total", "payment_amount"]].fillna(0).astype(int)
+    orders[["boat", "payment_method"]] = orders[["boat", "payment_method"]].fillna("")
+
+    entries = pd.read_sql_query(text(REPORT_ENTRY_SQL), conn, params=params)
+    entries["option"] = entries["option"].fillna("").str.strip()
+    # same rules as normalize_gender(), a column at a time
+    raw = entries["gender"].fillna("").str.strip().str.lower()
+    gender = pd.Series("unknown", index=entries.index)
+    gender[raw.str.startswith("f") | raw.str.contains("女")] = "female"
+    gender[raw.str.startswith("m") | raw.str.contains("男")] = "male"
+    entries["gender"] = gender
+    return orders, entries
+
+def records(df):
+    return df.reset_index().to_dict("records")
+
+def compute_reports(orders, entries):
+    unpaid = ~orders["paid"]
+    per_day = (orders.groupby(orders["date"].dt.date.rename("day"))
+               .agg(orders=("id", "size"), entries=("count", "sum"), due=("total", "sum"))
+               .sort_index(ascending=False))
+    per_hour = orders["date"].dt.hour.value_counts().reindex(range(24), fill_value=0)
+    by_method = (orders.assign(received=orders["payment_amount"].where(orders["paid"], 0),
+                               unpaid=unpaid, outstanding=orders["total"].where(unpaid, 0))
+                 .groupby("payment_method")
+                 .agg(orders=("id", "size"), due=("total", "sum"), received=("received", "sum"),
+                      unpaid=("unpaid", "sum"), outstanding=("outstanding", "sum")))
+    boat = (orders.groupby("boat")
+            .agg(orders=("id", "size"), entries=("count", "sum"), avg_entries=("count", "mean"),
+                 due=("total", "sum")))
+    boat["share"] = boat["orders"] / max(len(orders), 1)
+    entries_per_order = orders["count"].value_counts().sort_index().rename_axis("entries").rename("orders")
+    options = (pd.crosstab(entries["option"], entries["gender"])
+               .reindex(columns=["male", "female", "unknown"], fill_value=0))
+    options["total"] = options.sum(axis=1)
+    # known options in form order, free-form/blank ones after
+    options = options.reindex([o for o in VALID_OPTIONS if o in options.index] +
+                              sorted(o for o in options.index if o not in VALID_OPTIONS))
+    return {
+        "per_day": records(per_day),
+        "per_hour": per_hour.tolist(),
+        "by_method": records(by_method),
+        "boat": records(boat),
+        "entries_per_order": records(entries_per_order),
+        "options": records(options),
+        "avg_entries": float(orders["count"].mean()) if len(orders) else 0.0,
+    }
+
+def unpaid_aging(orders, now):
+    # depends on the clock, so it is worked out per request (one vectorised cut)
+    unpaid = orders[~orders["paid"]]
+    age = ((now - unpaid["date"]).dt.total_seconds() / 86400).clip(lower=0)
+    buckets = pd.cut(age, AGING_BINS, labels=AGING_LABELS, right=False)
+    return records(unpaid.groupby(buckets, observed=False)
+                   .agg(orders=("id", "size"), outstanding=("total", "sum"))
+                   .rename_axis("age"))
+
+def get_reports():
+    with read_session() as rs, _reports_lock:
+        # versions come from the same database as the rows, replica or not
+        row = rs.query(SysState.data_version, SysState.edit_version).first()
+        version, edits = (row[0] or 0, row[1] or 0) if row else (0, 0)
+        event_id = active_event_id()
+        conn = rs.connection()
+        state = _reports_state
+        # >=: a lagging replica must not roll the reports back
+        if state.get("event_id") == event_id and state.get("version", -1) >= version:
+            bump_metric("reports.hit")
+            return state
+
+        orders = entries = None
+        if state.get("event_id") == event_id and state.get("edits") == edits:
+            new_orders, new_entries = read_report_rows(conn, event_id, after=state["max_id"])
+            orders, entries = state["orders"], state["entries"]
+            if len(new_orders):
+                orders = pd.concat([orders, new_orders], ignore_index=True)
+            if len(new_entries):
+                entries = pd.concat([entries, new_entries], ignore_index=True)
+            # an undone delete brings back an old id, which "id > max_id" can't see
+            if len(orders) == event_submissions(rs).count():
+                bump_metric("reports.append")
+            else:
+                orders = entries = None
+        if orders is None:
+            bump_metric("reports.rebuild")
+            orders, entries = read_report_rows(conn, event_id)
+
+        state.clear()
+        state.update(event_id=event_id, version=version, edits=edits,
+                     max_id=int(orders["id"].max()) if len(orders) else 0,
+                     orders=orders, entries=entries, reports=compute_reports(orders, entries),
+                     computed_at=now_utc8())
+        return state
+
+@app.route("/admin/reports")
+@login_required
+def admin_reports():
+    state = get_reports()
+    return render_template("reports.html", event_name=export_basename(), computed_at=state["computed_at"],
+                           num_orders=len(state["orders"]), aging=unpaid_aging(state["orders"], now_utc8()),
+                           **state["reports"])
+
+
+# -----------------------
+#     DUPLICATE DETECTION
+# -----------------------
+# register() only stops the exact same name + phone.  This scan finds the
+# near misses: each order gets blocking keys (local phone digits, normalised
+# Chinese/English name, each deceased name) and only orders that share a key
+# are scored against each other, so the work grows with the block sizes
+# rather than n².  Pairs above DUPLICATE_THRESHOLD are joined into clusters
+# (union-find); the last scan is kept in SummaryCache for the review page.
+DUPLICATE_THRESHOLD = float(os.environ.get("DUPLICATE_THRESHOLD", 0.6))
+DUPLICATE_MAX_BLOCK = int(os.environ.get("DUPLICATE_MAX_BLOCK", 50))  # skip keys shared by everyone (e.g. 无名)
+DUPLICATE_WEIGHTS = {"phone": 0.4, "name": 0.3, "deceased": 0.3}
+
+def normalize_name(raw):
+    return re.sub(r"[\W_]+", "", str(raw or "")).lower()
+
+def duplicate_profile(subid, name_cn, name_en, phone, entries):
+    try:
+        entries = json.loads(entries or "[]")
+    except json.JSONDecodeError:
+        entries = []
+    return {
+        "id": subid,
+        "phone": extract_local_phone(phone or "")[-8:],
+        "name_cn": normalize_name(name_cn),
+        "name_en": " ".join(sorted(re.findall(r"\w+", str(name_en or "").lower()))),
+        "deceased": {normalize_name(e.get("name_cn")) for e in entries} - {""},
+    }
+
+def blocking_keys(p):
+    keys = {"d:" + name for name in p["deceased"]}
+    if len(p["phone"]) >= 7:
+        keys.add("p:" + p["phone"])
+    if p["name_cn"]:
+        keys.add("n:" + p["name_cn"])
+    if p["name_en"]:
+        keys.add("e:" + p["name_en"])
+    return keys
+
+def name_similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return 1.0 if a == b else difflib.SequenceMatcher(None, a, b).ratio()
+
+def duplicate_score(a, b, floor=0.0):
+    # -> (score, parts), or None when even identical names couldn't reach floor
+    both = a["deceased"] | b["deceased"]
+    parts = {
+        "phone": 1.0 if a["phone"] and a["phone"] == b["phone"] else 0.0,
+        "deceased": len(a["deceased"] & b["deceased"]) / len(both) if both else 0.0,
+    }
+    partial = sum(DUPLICATE_WEIGHTS[k] * v for k, v in parts.items())
+    if partial + DUPLICATE_WEIGHTS["name"] < floor:
+        return None
+    # SequenceMatcher is the expensive part, so it runs last
+    parts["name"] = max(name_similarity(a["name_cn"], b["name_cn"]), name_similarity(a["name_en"], b["name_en"]))
+    return partial + DUPLICATE_WEIGHTS["name"] * parts["name"], parts
+
+def cluster_key(ids):
+    return ",".join(str(i) for i in sorted(ids))
+
+def load_cached_payload(key, default):
+    row = db.session.get(SummaryCache, key)
+    return (json.loads(row.payload) if row else default), row
+
+def find_duplicates():
+    started = time.perf_counter()
+    rows = event_submissions().with_entities(
+        Submission.id, Submission.name_cn, Submission.name_en, Submission.phone, Submission.entries)
+    profiles = [duplicate_profile(*row) for row in rows]
+
+    blocks = {}
+    for i, p in enumerate(profiles):
+        for key in blocking_keys(p):
+            blocks.setdefault(key, []).append(i)
+    pairs, skipped = set(), 0
+    for members in blocks.values():
+        if len(members) > DUPLICATE_MAX_BLOCK:
+            skipped += 1
+        else:
+            pairs.update(itertools.combinations(members, 2))
+
+    parent = list(range(len(profiles)))
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    matches = []
+    for i, j in pairs:
+        scored = duplicate_score(profiles[i], profiles[j], DUPLICATE_THRESHOLD)
+        if scored and scored[0] >= DUPLICATE_THRESHOLD:
+            parent[root(i)] = root(j)
+            matches.append((i, j) + scored)
+
+    clusters = {}
+    for i, j, score, parts in matches:
+        c = clusters.setdefault(root(i), {"ids": set(), "score": 0.0, "reasons": set()})
+        c["ids"].update((profiles[i]["id"], profiles[j]["id"]))
+        c["score"] = max(c["score"], score)
+        c["reasons"].update(k for k, v in parts.items() if v >= 0.8)
+
+    dismissed = set(load_cached_payload("duplicates.dismissed", [])[0])
+    found = [{"ids": sorted(c["ids"]), "score": round(c["score"], 2), "reasons": sorted(c["reasons"])}
+             for c in clusters.values() if cluster_key(c["ids"]) not in dismissed]
+    found.sort(key=lambda c: (-c["score"], c["ids"]))
+    return {
+        "event_id": active_event_id(),
+        "clusters": found,
+        "orders": len(profiles),
+        "blocks": len(blocks),
+        "skipped_blocks": skipped,
+        "pairs": len(pairs),
+        "elapsed_ms": int((time.perf_counter() - started) * 1000),
+    }
+
+def run_duplicate_scan():
+    result = find_duplicates()
+    db.session.merge(SummaryCache(key="duplicates", payload=json.dumps(result),
+                                  data_version=current_data_version(), computed_at=now_utc8()))
+    db.session.commit()
+    bump_metric("duplicates.scans")
+    return result
+
+def merge_submissions(keep, others):
+    # fold the others' deceased names into `keep`, then delete the others
+    entries = json.loads(keep.entries or "[]")
+    seen = {(e.get("option"), normalize_name(e.get("name_cn"))) for e in entries}
+    for other in others:
+        for e in json.loads(other.entries or "[]"):
+            key = (e.get("option"), normalize_name(e.get("name_cn")))
+            if key not in seen:
+                seen.add(key)
+                entries.append(e)
+    if len(entries) > MAX_ENTRIES:
+        raise ValueError(f"Merged order would have {len(entries)} entries (max {MAX_ENTRIES}).")
+    members = [keep] + others
+    keep.entries = json.dumps(entries)
+    keep.count = len(entries)
+    keep.total = calc_total(keep.boat, keep.count)
+    # paid only if every member was; otherwise the amount stays 0 (as for any
+    # unpaid order) and what was already paid is kept in the remarks
+    keep.paid = all(s.paid for s in members)
+    paid_amounts = [(s, s.payment_amount or 0) for s in members if s.paid]
+    keep.payment_amount = sum(amount for _, amount in paid_amounts) if keep.paid else 0
+    note = "Merged " + ", ".join(f"#{s.order_id}" for s in others)
+    if paid_amounts and not keep.paid:
+        note += "; already paid " + ", ".join(f"RM {amount} on #{s.order_id}" for s, amount in paid_amounts)
+    keep.remarks = f"{keep.remarks}; {note}" if keep.remarks else note
+    for other in others:
+        db.session.delete(other)
+
+@app.cli.command("find-duplicates", help="Scan the active event for near-duplicate registrations.")
+def find_duplicates_command():
+    result = run_duplicate_scan()
+    print(f"✅ {result['orders']} orders, {result['pairs']} pairs compared in {result['elapsed_ms']} ms: "
+          f"{len(result['clusters'])} possible duplicate groups")
+
+@app.route("/admin/duplicates")
+@login_required
+def admin_duplicates():
+    result, row = load_cached_payload("duplicates", None)
+    if result and result.get("event_id") != active_event_id():
+        result = None
+    clusters = []
+    if result:
+        ids = [i for c in result["clusters"] for i in c["ids"]]
+        subs = {s.id: s for s in event_submissions().filter(Submission.id.in_(ids))} if ids else {}
+        dismissed = set(load_cached_payload("duplicates.dismissed", [])[0])
+        for c in result["clusters"]:
+            # merged/deleted since the scan: show what is left
+            members = [subs[i] for i in c["ids"] if i in subs]
+            if len(members) > 1 and cluster_key(c["ids"]) not in dismissed:
+                for s in members:
+                    s.enriched_entries = json.loads(s.entries or "[]")
+                clusters.append({**c, "members": members})
+    return render_template("duplicates.html", result=result, clusters=clusters,
+                           computed_at=row.computed_at if result else None,
+                           stale=bool(result) and row.data_version != current_data_version(),
+                           is_owner=is_owner())
+
+@app.route("/admin/duplicates/scan", methods=["POST"])
+@login_required
+def admin_duplicates_scan():
+    result = run_duplicate_scan()
+    flash(f"Scanned {result['orders']} orders ({result['pairs']} pairs) in {result['elapsed_ms']} ms: "
+          f"{len(result['clusters'])} possible duplicate groups.", "success")
+    return redirect(url_for("admin_duplicates"))
+
+@app.route("/admin/duplicates/merge", methods=["POST"])
+@login_required
+@write_gated
+def admin_duplicates_merge():
+    if not is_owner():
+        flash("Only the owner can merge orders.", "danger")
+        return redirect(url_for("admin_duplicates"))
+    keep_id = request.form.get("keep", type=int)
+    ids = {int(i) for i in request.form.getlist("ids") if i.isdigit()}
+    subs = {s.id: s for s in event_submissions().filter(Submission.id.in_(ids))} if ids else {}
+    if keep_id not in subs or len(subs) < 2:
+        flash("Pick the order to keep from a group that still exists.", "danger")
+        return redirect(url_for("admin_duplicates"))
+    keep = subs.pop(keep_id)
+    others = sorted(subs.values(), key=lambda s: s.id)
+    try:
+        merge_submissions(keep, others)
+    except ValueError as e:
+        db.session.rollback()
+        flash(str(e), "danger")
+        return redirect(url_for("admin_duplicates"))
+    log_admin(
+        action="Merge duplicates",
+        user=session.get('username', 'unknown'),
+        detail=f"Merged {', '.join(s.order_id for s in others)} into Order ID: {keep.order_id}, Name: {keep.name_cn}"
+    )
+    flash(f"Merged into #{keep.order_id}.", "success")
+    return redirect(url_for("admin_duplicates"))
+
+@app.route("/admin/duplicates/dismiss", methods=["POST"])
+@login_required
+def admin_duplicates_dismiss():
+    ids = [int(i) for i in request.form.getlist("ids") if i.isdigit()]
+    if len(ids) > 1:
+        dismissed, _ = load_cached_payload("duplicates.dismissed", [])
+        dismissed = sorted(set(dismissed) | {cluster_key(ids)})
+        db.session.merge(SummaryCache(key="duplicates.dismissed", payload=json.dumps(dismissed),
+                                      computed_at=now_utc8()))
+        log_admin(
+            action="Dismiss duplicates",
+            user=session.get('username', 'unknown'),
+            detail=f"Marked submissions {cluster_key(ids)} as not duplicates"
+        )
+    return redirect(url_for("admin_duplicates"))
+
+
+# -----------------------
+#     CONSISTENCY CHECKS
+# -----------------------
+# count/total/paid/payment_amount are written by register, admin_edit, undo,
+# imports and merges, so they can drift apart.  The scan reads the event in
+# id-ordered chunks of plain columns and tests each rule on a whole chunk at
+# once.  Fixes go through the ORM in batches, so data_version, edit_version
+# and the capacity counters follow, and each row is re-checked first.
+CONSISTENCY_CHUNK = int(os.environ.get("CONSISTENCY_CHUNK", 20000))
+CONSISTENCY_FIX_BATCH = 500
+CONSISTENCY_SAMPLE = 100  # rows kept per check; the counts are exact
+CONSISTENCY_CHECKS = {
+    "bad_entries": "Entries are not a JSON list",
+    "count": "Count differs from the number of entries",
+    "total": "Total differs from the price of the entries",
+    "unpaid_amount": "Unpaid order has a payment amount",
+    "paid_no_amount": "Paid order has no payment amount",
+    "unknown_option": "Entry option is not on the form",
+}
+CONSISTENCY_FIXABLE = ["count", "total", "unpaid_amount"]
+# one pass over the JSON per row: SQLite counts the entries and lists any
+# option that is not on the form ("(blank)" for a missing one).  The unary +
+# keeps SQLite walking the rowid range instead of sorting the whole event
+# out of an event_id index for every chunk.
+CONSISTENCY_SQL = text("""
+    SELECT id, order_id, boat, count, total, paid, payment_amount,
+           CASE WHEN is_list THEN json_array_length(entries) END AS n_entries,
+           CASE WHEN is_list THEN (
+               SELECT group_concat(DISTINCT coalesce(option, '(blank)')) FROM (
+                   SELECT CASE WHEN e.type = 'object' THEN json_extract(e.value, '$.option') END AS option
+                   FROM json_each(entries) e)
+               WHERE option IS NULL OR option NOT IN :valid) END AS unknown_options
+    FROM (SELECT *, CASE WHEN json_valid(entries) THEN json_type(entries) = 'array' END AS is_list FROM submission
+          WHERE +event_id = :event_id AND id > :after ORDER BY id LIMIT :limit)
+    ORDER BY id
+""").bindparams(bindparam("valid", expanding=True))
+
+def consistency_flags(chunk):
+    paid = chunk["paid"].fillna(0).astype(bool)
+    amount = chunk["payment_amount"].fillna(0)
+    valid = chunk["n_entries"].notna()
+    n = chunk["n_entries"].fillna(0).astype(int)
+    # calc_total(), a column at a time
+    expected = (n - chunk["boat"].eq("yes") * FREE_WITH_BOAT).clip(lower=0) * PRICE_PER_ENTRY
+    chunk["expected_total"] = expected.where(valid).astype("Int64")
+    chunk["n_entries"] = chunk["n_entries"].astype("Int64")
+    return {
+        "bad_entries": ~valid,
+        "count": valid & chunk["count"].ne(n),
+        "total": valid & chunk["total"].ne(expected),
+        "unpaid_amount": ~paid & amount.ne(0),
+        "paid_no_amount": valid & paid & expected.gt(0) & amount.le(0),
+        "unknown_option": chunk["unknown_options"].notna(),
+    }
+
+def scan_consistency():
+    started = time.perf_counter()
+    event_id = active_event_id()
+    conn = db.session.connection()
+    counts = dict.fromkeys(CONSISTENCY_CHECKS, 0)
+    samples = {check: [] for check in CONSISTENCY_CHECKS}
+    fixable, scanned, after = [], 0, 0
+    while True:
+        chunk = pd.read_sql_query(CONSISTENCY_SQL, conn, params={
+            "event_id": event_id, "after": after, "limit": CONSISTENCY_CHUNK, "valid": VALID_OPTIONS})
+        if chunk.empty:
+            break
+        after = int(chunk["id"].iloc[-1])
+        scanned += len(chunk)
+        flags = consistency_flags(chunk)
+        for check, mask in flags.items():
+            counts[check] += int(mask.sum())
+            room = CONSISTENCY_SAMPLE - len(samples[check])
+            if room > 0 and mask.any():
+                samples[check].extend(json.loads(chunk[mask].head(room).to_json(orient="records")))
+        fix_mask = pd.concat([flags[check] for check in CONSISTENCY_FIXABLE], axis=1).any(axis=1)
+        fixable.extend(int(i) for i in chunk.loc[fix_mask, "id"])
+    return {
+        "event_id": event_id,
+        "orders": scanned,
+        "counts": counts,
+        "samples": samples,
+        "fixable": fixable,
+        "elapsed_ms": int((time.perf_counter() - started) * 1000),
+    }
+
+def run_consistency_scan():
+    result = scan_consistency()
+    db.session.merge(SummaryCache(key="consistency", payload=json.dumps(result),
+                                  data_version=current_data_version(), computed_at=now_utc8()))
+    db.session.commit()
+    bump_metric("consistency.scans")
+    return result
+
+def cached_consistency_scan():
+    # exports call this: rescan only when orders changed since the last scan
+    result, row = load_cached_payload("consistency", None)
+    if result and result.get("event_id") == active_event_id() and row.data_version == current_data_version():
+        return result
+    return run_consistency_scan()
+
+def repair_submission(sub):
+    try:
+        entries = json.loads(sub.entries or "[]")
+    except ValueError:
+        return False
+    if not isinstance(entries, list):
+        return False
+    before = (sub.count, sub.total, sub.paid, sub.payment_amount)
+    sub.count = len(entries)
+    sub.total = calc_total(sub.boat, sub.count)
+    if not sub.paid:
+        sub.payment_amount = 0
+    return (sub.count, sub.total, sub.paid, sub.payment_amount) != before
+
+def fix_consistency(ids, user):
+    fixed = 0
+    for start in range(0, len(ids), CONSISTENCY_FIX_BATCH):
+        batch = event_submissions().filter(Submission.id.in_(ids[start:start + CONSISTENCY_FIX_BATCH])).all()
+        changed = [sub.order_id for sub in batch if repair_submission(sub)]
+        if changed:
+            log_admin(
+                action="Consistency fix",
+                user=user,
+                detail=f"Recomputed count/total/paid for {len(changed)} orders: " + ", ".join(changed),
+                commit=False
+            )
+        db.session.commit()
+        fixed += len(changed)
+    return fixed
+
+@app.cli.command("check-consistency", help="Check the active event's orders for drifted totals/counts/payments.")
+@click.option("--fix", is_flag=True, help="Recompute count, total and paid state where they disagree.")
+def check_consistency_command(fix):
+    result = run_consistency_scan()
+    print(f"✅ {result['orders']} orders checked in {result['elapsed_ms']} ms")
+    for check, label in CONSISTENCY_CHECKS.items():
+        if result["counts"][check]:
+            print(f"  {label}: {result['counts'][check]}")
+    if fix and result["fixable"]:
+        fixed = fix_consistency(result["fixable"], user="cli")
+        run_consistency_scan()
+        print(f"🔧 Fixed {fixed} orders")
+
+@app.route("/admin/consistency")
+@login_required
+def admin_consistency():
+    result, row = load_cached_payload("consistency", None)
+    if result and result.get("event_id") != active_event_id():
+        result = None
+    return render_template("consistency.html", result=result, checks=CONSISTENCY_CHECKS,
+                           fixable_checks=CONSISTENCY_FIXABLE,
+                           computed_at=row.computed_at if result else None,
+                           stale=bool(result) and row.data_version != current_data_version(),
+                           is_owner=is_owner())
+
+@app.route("/admin/consistency/scan", methods=["POST"])
+@login_required
+def admin_consistency_scan():
+    result = run_consistency_scan()
+    flash(f"Checked {result['orders']} orders in {result['elapsed_ms']} ms: "
+          f"{sum(result['counts'].values())} problems found.", "success")
+    return redirect(url_for("admin_consistency"))
+
+@app.route("/admin/consistency/fix", methods=["POST"])
+@login_required
+@write_gated
+def admin_consistency_fix():
+    if not is_owner():
+        flash("Only the owner can repair orders.", "danger")
+        return redirect(url_for("admin_consistency"))
+    # scan again so the fix never works from a stale list
+    result = run_consistency_scan()
+    fixed = fix_consistency(result["fixable"], user=session.get('username', 'unknown'))
+    run_consistency_scan()
+    flash(f"Recomputed {fixed} orders.", "success")
+    return redirect(url_for("admin_consistency"))
+
+
 # -----------------------
 #     OTHER ROUTES
 # -----------------------
@@ -1005,7 +3142,7 @@ def admin_undo_edit():
     if not recently_edited_submission:
         return jsonify({"ok": False, "error": "No recent edit to undo."})
 
-    sub = Submission.query.get(recently_edited_submission["id"])
+    sub = event_submissions().filter(Submission.id == recently_edited_submission["id"]).first()
     if not sub:
         return jsonify({"ok": False, "error": "Record not found for undo."})
 
@@ -1035,11 +3172,14 @@ def admin_undo():
     global recently_deleted_submission
     if recently_deleted_submission is None:
         return jsonify({"ok": False, "error": "No recent deletion to undo."})
-    existing = Submission.query.filter_by(order_id=recently_deleted_submission["order_id"]).first()
+    # order codes are unique across events, so this check is not event-scoped
+    existing = Submission.query.filter_by(order_code=recently_deleted_submission["order_code"]).first()
     if existing:
         return jsonify({"ok": False, "error": "Order ID already exists, cannot undo."})
     sub = Submission(
+        event_id = recently_deleted_submission["event_id"],
         order_id = recently_deleted_submission["order_id"],
+        order_code = recently_deleted_submission["order_code"],
         date = recently_deleted_submission["date"],
         boat = recently_deleted_submission["boat"],
         gender = recently_deleted_submission["gender"],
@@ -1085,11 +3225,13 @@ def admin_delete(subid):
     global recently_deleted_submission
     if not is_owner():
         return jsonify({"ok": False, "error": "Only the owner can delete. Ask owner for approval."}), 403
-    sub = Submission.query.get_or_404(subid)   # <-- THIS WAS MISSING
+    sub = get_submission_or_404(subid)   # <-- THIS WAS MISSING
     # Save deleted record in cache
     recently_deleted_submission = {
         "id": sub.id,
+        "event_id": sub.event_id,
         "order_id": sub.order_id,
+        "order_code": sub.order_code,
         "date": sub.date,
         "boat": sub.boat,
         "gender": sub.gender,
@@ -1126,7 +3268,7 @@ def admin_request_delete_approval(subid):
         flash("Owner can delete directly.", "danger")
         return redirect(url_for("admin_dashboard"))
 
-    sub = Submission.query.get_or_404(subid)
+    sub = get_submission_or_404(subid)
     current_user = session.get('username', 'unknown')
     owner_phone = '60165207048'
 
@@ -1146,13 +3288,680 @@ def admin_request_delete_approval(subid):
     return jsonify({"ok": True, "whatsapp_link": wa_link})
 
 
+# -----------------------
+#     BULK OPERATIONS
+# -----------------------
+# Each bulk endpoint takes a list of submission ids (JSON body {"ids": [...]}
+# or repeated "ids" form fields), applies every change in one transaction
+# with a single audit entry, and answers with a result per id.
+
+def bulk_request_data():
+    data = request.get_json(silent=True)
+    if data is None:
+        data = request.form.to_dict()
+        data["ids"] = request.form.getlist("ids")
+    ids = []
+    for raw in data.get("ids") or []:
+        try:
+            ids.append(int(raw))
+        except (TypeError, ValueError):
+            pass
+    return data, list(dict.fromkeys(ids))
+
+def load_submissions(ids):
+    return {s.id: s for s in event_submissions().filter(Submission.id.in_(ids))} if ids else {}
+
+def total_paid_amount():
+    return (db.session.query(db.func.sum(Submission.payment_amount))
+            .filter(Submission.event_id == active_event_id(), Submission.paid == True).scalar() or 0)
+
+def apply_paid_updates(updates, user, action, note=""):
+    # updates: list of (subid, paid, amount or None); amount None means the order total
+    subs = load_submissions([u[0] for u in updates])
+    results, changed = {}, []
+    for subid, paid, amount in updates:
+        sub = subs.get(subid)
+        if not sub:
+            results[subid] = {"ok": False, "error": "Record not found."}
+            continue
+        if sub.total == 0:
+            # FOC orders are always paid, amount stays as entered (or 0)
+            sub.paid = True
+            sub.payment_amount = sub.payment_amount or 0
+        elif paid:
+            sub.paid = True
+            sub.payment_amount = sub.total if amount is None else amount
+        else:
+            sub.paid = False
+            sub.payment_amount = 0
+        results[subid] = {"ok": True, "paid": sub.paid, "payment_amount": sub.payment_amount}
+        changed.append(f"{sub.order_id}:{sub.payment_amount if sub.paid else 'unpaid'}")
+    if changed:
+        log_admin(
+            action=action,
+            user=user,
+            detail=f"{note}{len(changed)} orders: " + ", ".join(changed),
+            commit=False
+        )
+    db.session.commit()
+    return results, total_paid_amount()
+
+@app.route("/admin/bulk/paid", methods=["POST"])
+@login_required
+@write_gated
+def admin_bulk_paid():
+    data, ids = bulk_request_data()
+    if not ids:
+        return jsonify({"ok": False, "error": "No orders selected."}), 400
+    paid = str(data.get("paid", "true")).lower() in ("1", "true", "yes", "paid")
+    amounts = data.get("amounts") or {}
+    updates = []
+    for subid in ids:
+        amt = amounts.get(str(subid), amounts.get(subid)) if isinstance(amounts, dict) else None
+        if amt is not None:
+            try:
+                amt = max(0, int(amt))
+            except (TypeError, ValueError):
+                amt = None
+        updates.append((subid, paid, amt))
+    results, total_paid = apply_paid_updates(
+        updates,
+        user=session.get('username', 'unknown'),
+        action="Bulk mark paid" if paid else "Bulk mark unpaid"
+    )
+    return jsonify({"ok": True, "results": results, "total_paid": total_paid})
+
+def bulk_set_field(field, value, action):
+    data, ids = bulk_request_data()
+    if not ids:
+        return jsonify({"ok": False, "error": "No orders selected."}), 400
+    subs = load_submissions(ids)
+    results = {}
+    for subid in ids:
+        sub = subs.get(subid)
+        if not sub:
+            results[subid] = {"ok": False, "error": "Record not found."}
+            continue
+        setattr(sub, field, value)
+        results[subid] = {"ok": True}
+    log_admin(
+        action=action,
+        user=session.get('username', 'unknown'),
+        detail=f"Set {field} to '{value}' for {len(subs)} orders: " +
+               ", ".join(s.order_id or str(s.id) for s in subs.values()),
+        commit=False
+    )
+    db.session.commit()
+    return jsonify({"ok": True, "results": results})
+
+@app.route("/admin/bulk/remarks", methods=["POST"])
+@login_required
+@write_gated
+def admin_bulk_remarks():
+    data, _ = bulk_request_data()
+    return bulk_set_field("remarks", (data.get("remarks") or "").strip(), "Bulk set remarks")
+
+@app.route("/admin/bulk/payment_method", methods=["POST"])
+@login_required
+@write_gated
+def admin_bulk_payment_method():
+    data, _ = bulk_request_data()
+    method = (data.get("payment_method") or "").strip().lower()
+    if method not in PAYMENT_METHODS:
+        return jsonify({"ok": False, "error": "Unknown payment method."}), 400
+    return bulk_set_field("payment_method", method, "Bulk set payment method")
+
+@app.route("/admin/bulk/delete", methods=["POST"])
+@login_required
+@write_gated
+def admin_bulk_delete():
+    if not is_owner():
+        return jsonify({"ok": False, "error": "Only the owner can delete. Ask owner for approval."}), 403
+    _, ids = bulk_request_data()
+    if not ids:
+        return jsonify({"ok": False, "error": "No orders selected."}), 400
+    subs = load_submissions(ids)
+    results = {}
+    for subid in ids:
+        sub = subs.get(subid)
+        if not sub:
+            results[subid] = {"ok": False, "error": "Record not found."}
+            continue
+        db.session.delete(sub)
+        results[subid] = {"ok": True}
+    # bulk deletes are not undoable; keep the single-record undo cache as is
+    log_admin(
+        action="Bulk delete submissions",
+        user=session.get('username', 'unknown'),
+        detail=f"Deleted {len(subs)} submissions: " +
+               ", ".join(f"{s.order_id} {s.name_cn}" for s in subs.values()),
+        commit=False
+    )
+    db.session.commit()
+    return jsonify({"ok": True, "results": results, "total_paid": total_paid_amount()})
+
+# -----------------------
+#     STATEMENT RECONCILIATION
+# -----------------------
+# Admins upload a TNG / bank statement (CSV or XLSX).  Unpaid orders are
+# indexed by amount, order id, order code and local phone digits, every
+# credit line is matched against those indexes, and the admin confirms the
+# proposed matches before they are applied through apply_paid_updates().
+STATEMENT_AMOUNT_COLUMNS = ["amount", "amount (rm)", "credit", "credit amount", "deposit", "money in", "cr", "in"]
+STATEMENT_DATE_COLUMNS = ["date", "transaction date", "date/time", "datetime", "time", "posting date"]
+# only these are searched for order codes, ids and phones (not balances or
+# running totals); STATEMENT_DESCRIPTION_COLUMNS="col a,col b" replaces the list
+STATEMENT_DESCRIPTION_COLUMNS = [c.strip().lower() for c in os.environ.get(
+    "STATEMENT_DESCRIPTION_COLUMNS",
+    "description,transaction description,details,transaction details,particulars,narrative,"
+    "reference,ref,reference no,reference 1,reference 2,recipient reference,payment details,"
+    "other payment details,remarks,memo,sender,sender name,from").split(",") if c.strip()]
+
+def read_uploaded_table(upload):
+    # CSV or XLSX upload -> DataFrame of strings
+    filename = (upload.filename or "").lower()
+    raw = upload.read()
+    if filename.endswith((".xlsx", ".xls")):
+        return pd.read_excel(io.BytesIO(raw), dtype=str).fillna("")
+    return pd.read_csv(io.BytesIO(raw), dtype=str, encoding_errors="replace").fillna("")
+
+def parse_amount(raw):
+    cleaned = re.sub(r"[^\d.\-]", "", str(raw).replace(",", ""))
+    try:
+        value = float(cleaned)
+    except ValueError:
+        return None
+    return int(round(value)) if value > 0 else None
+
+def parse_statement(df):
+    columns = {str(c).strip().lower(): c for c in df.columns}
+    amount_col = next((columns[c] for c in STATEMENT_AMOUNT_COLUMNS if c in columns), None)
+    if amount_col is None:
+        raise ValueError("No amount/credit column found in the statement.")
+    date_col = next((columns[c] for c in STATEMENT_DATE_COLUMNS if c in columns), None)
+    text_cols = [columns[c] for c in STATEMENT_DESCRIPTION_COLUMNS if c in columns]
+    amounts = [parse_amount(v) for v in df[amount_col]]
+    descriptions = df[text_cols].astype(str).agg(" ".join, axis=1) if text_cols else pd.Series([""] * len(df))
+    dates = df[date_col] if date_col is not None else pd.Series([""] * len(df))
+    return [
+        {"line": i + 2, "date": d, "description": desc.strip(), "amount": amt}
+        for i, (d, desc, amt) in enumerate(zip(dates, descriptions, amounts))
+        if amt  # skip debits, blanks and header repeats
+    ]
+
+def build_unpaid_indexes():
+    by_amount, by_order, by_phone, by_code = {}, {}, {}, {}
+    unpaid = event_submissions().filter(Submission.paid == False, Submission.total > 0).all()
+    for sub in unpaid:
+        by_amount.setdefault(sub.total, []).append(sub)
+        by_order.setdefault(sub.order_id, []).append(sub)
+        by_phone.setdefault(extract_local_phone(sub.phone), []).append(sub)
+        if sub.order_code:
+            by_code[sub.order_code] = sub
+    return by_amount, by_order, by_phone, by_code
+
+# six Crockford characters, optionally split "ABC-DEF"; normalize_order_code()
+# folds O/I/L and rejects anything whose check character doesn't fit
+# (a lookahead, so "ref ABC-DEF" tries both "ref ABC" and "ABC-DEF")
+ORDER_CODE_RE = re.compile(r"(?<![0-9A-Za-z])(?=([0-9A-Za-z]{3}[\s\-]?[0-9A-Za-z]{3})(?![0-9A-Za-z]))")
+
+def order_code_candidates(desc):
+    return {code for code in map(normalize_order_code, ORDER_CODE_RE.findall(desc)) if code}
+
+def phone_candidates(desc):
+    # digit groups like "012-345 6789" may be split by spaces or dashes
+    found = set()
+    for run in re.findall(r"\+?\d+(?:[\s\-]\d+)*", desc):
+        parts = re.split(r"[\s\-]", run.lstrip("+"))
+        for i in range(len(parts)):
+            for j in range(i + 1, len(parts) + 1):
+                digits = "".join(parts[i:j])
+                if 8 <= len(digits) <= 13:
+                    found.add(extract_local_phone(digits))
+    return found
+
+def match_transactions(transactions, method=""):
+    by_amount, by_order, by_phone, by_code = build_unpaid_indexes()
+    proposals = []
+    for tx in transactions:
+        desc = tx["description"]
+        scores = {}
+        for code in order_code_candidates(desc):
+            # codes are unique and check-summed, so one is enough on its own
+            sub = by_code.get(code)
+            if sub:
+                scores[sub.id] = scores.get(sub.id, 0) + 4
+        for local in phone_candidates(desc):
+            for sub in by_phone.get(local, []):
+                scores[sub.id] = scores.get(sub.id, 0) + 3
+        for token in re.findall(r"(?<!\d)\d{4}(?!\d)", desc):
+            for sub in by_order.get(token, []):
+                scores[sub.id] = scores.get(sub.id, 0) + 2
+        amount_ids = {sub.id for sub in by_amount.get(tx["amount"], [])}
+        if not scores and len(amount_ids) == 1:
+            # amount alone is only a hint when exactly one unpaid order has it
+            scores = {next(iter(amount_ids)): 0}
+        for subid in scores:
+            if subid in amount_ids:
+                scores[subid] += 2
+        proposals.append({"tx": tx, "scores": scores})
+
+    # greedy assignment, strongest evidence first; one transaction per order
+    subs = load_submissions({sid for p in proposals for sid in p["scores"]})
+    for p in proposals:
+        if method:
+            for sid in p["scores"]:
+                if (subs[sid].payment_method or "").lower() == method:
+                    p["scores"][sid] += 1
+    taken = set()
+    for p in sorted(proposals, key=lambda p: -max(p["scores"].values(), default=0)):
+        ranked = sorted(p["scores"].items(), key=lambda kv: -kv[1])
+        best = next(((sid, score) for sid, score in ranked if sid not in taken), None)
+        p["sub"], p["confidence"] = None, "none"
+        if best:
+            sid, score = best
+            tied = len([1 for other, sc in ranked if sc == score and other not in taken]) > 1
+            if score >= 4 and not tied:
+                p["confidence"] = "high"
+            elif score >= 2:
+                p["confidence"] = "medium" if not tied else "low"
+            else:
+                p["confidence"] = "low"
+            p["sub"] = subs[sid]
+            taken.add(sid)
+    return [{"tx": p["tx"], "sub": p["sub"], "confidence": p["confidence"]} for p in proposals]
+
+@app.route("/admin/reconcile", methods=["GET", "POST"])
+@login_required
+def admin_reconcile():
+    if request.method == "GET":
+        return render_template("reconcile.html", matches=None)
+    upload = request.files.get("statement")
+    if not upload or not upload.filename:
+        flash("Please choose a statement file.", "danger")
+        return redirect(url_for("admin_reconcile"))
+    try:
+        transactions = parse_statement(read_uploaded_table(upload))
+    except Exception as e:
+        flash(f"Could not read statement: {e}", "danger")
+        return redirect(url_for("admin_reconcile"))
+    method = request.form.get("method", "").lower()
+    matches = match_transactions(transactions, method)
+    return render_template("reconcile.html", matches=matches, filename=upload.filename)
+
+@app.route("/admin/reconcile/apply", methods=["POST"])
+@login_required
+@write_gated
+def admin_reconcile_apply():
+    updates = []
+    for raw in request.form.getlist("accept"):
+        try:
+            subid, amount = (int(x) for x in raw.split(":", 1))
+        except ValueError:
+            continue
+        updates.append((subid, True, amount))
+    if not updates:
+        flash("No matches were accepted.", "danger")
+        return redirect(url_for("admin_reconcile"))
+    results, _ = apply_paid_updates(
+        updates,
+        user=session.get('username', 'unknown'),
+        action="Reconcile statement",
+        note=f"From {request.form.get('filename', 'statement')}: "
+    )
+    ok = sum(1 for r in results.values() if r["ok"])
+    flash(f"Marked {ok} order(s) as paid.", "success")
+    return redirect(url_for("admin_reconcile"))
+
+# -----------------------
+#     BULK REGISTRATION IMPORT
+# -----------------------
+# Paper/walk-in forms typed into a spreadsheet with the same columns that
+# export_excel() writes.  The sheet is parsed column-wise with pandas, each
+# row is validated with the register form's schema, priced with
+# calc_total(), checked against the same name + local phone duplicate rule
+# as register(), and written with batched executemany inserts.
+IMPORT_REQUIRED_COLUMNS = ["Boat", "Gender", "Chinese Name", "English Name", "Phone", "Payment Method"]
+IMPORT_BATCH_SIZE = 500
+ENTRY_LABEL_RE = re.compile(r"^\s*(?P<option>\S+)(?:\s*\([^)]*\))?\s*-\s*(?P<name>.*?)\s*\((?P<gender>[^)]*)\)\s*(?P<date>.*)$")
+
+def parse_choice(raw):
+    # "是 / Yes" -> "yes", "男 / Male" -> "male", "BANK" -> "bank_transfer"
+    value = str(raw).strip().lower()
+    lookup = {
+        "是": "yes", "yes": "yes", "y": "yes", "否": "no", "no": "no", "n": "no",
+        "男": "male", "male": "male", "m": "male", "女": "female", "female": "female", "f": "female",
+        "bank": "bank_transfer", "bank_transfer": "bank_transfer", "bank transfer": "bank_transfer",
+        "tng": "tng",
+    }
+    if value in lookup:
+        return lookup[value]
+    head = value.split("/")[-1].strip()
+    return lookup.get(head, lookup.get(value.split("/")[0].strip(), ""))
+
+def parse_entry_label(label):
+    # inverse of the "Entry N" cells written by export_excel()
+    m = ENTRY_LABEL_RE.match(str(label))
+    if not m:
+        return None
+    date = m.group("date")
+    calendar = "lunar" if "农历" in date else "english" if "阳历" in date else ""
+    part = lambda unit: (re.search(rf"(\d+)\s*{unit}", date) or [None, ""])[1]
+    return {
+        "option": m.group("option"),
+        "name_cn": m.group("name"),
+        "gender": parse_choice(m.group("gender")),
+        "calendar": calendar,
+        "year": part("年"),
+        "month": part("月"),
+        "day": part("日"),
+    }
+
+def validate_import(df):
+    # returns (rows ready to insert, {sheet row number: [errors]})
+    df = df.rename(columns=lambda c: str(c).strip())
+    missing = [c for c in IMPORT_REQUIRED_COLUMNS if c not in df.columns]
+    if missing:
+        raise ValueError("Missing column(s): " + ", ".join(missing))
+    entry_cols = sorted((c for c in df.columns if re.fullmatch(r"Entry \d+", c)), key=lambda c: int(c.split()[1]))
+    if not entry_cols:
+        raise ValueError("No 'Entry N' columns found.")
+    for col in ["Timestamp", "Order ID", "Paid", "Paid Amt", "Remarks"]:
+        if col not in df.columns:
+            df[col] = ""
+
+    cols = pd.DataFrame(index=df.index)
+    cols["boat"] = df["Boat"].map(parse_choice)
+    cols["gender"] = df["Gender"].map(parse_choice)
+    cols["payment_method"] = df["Payment Method"].map(parse_choice)
+    cols["name_cn"] = df["Chinese Name"].str.strip()
+    cols["name_en"] = df["English Name"].str.strip()
+    cols["phone"] = df["Phone"].str.replace(r"[^\d+]", "", regex=True)
+    cols["local"] = cols["phone"].map(extract_local_phone)
+    cols["order_id"] = df["Order ID"].str.strip().where(df["Order ID"].str.strip() != "", cols["phone"].str[-4:])
+    cols["paid"] = df["Paid"].str.strip().str.lower().isin(["yes", "y", "true", "1", "paid"])
+    cols["payment_amount"] = pd.to_numeric(df["Paid Amt"], errors="coerce").fillna(0).astype(int)
+    cols["remarks"] = df["Remarks"].str.strip()
+    cols["date"] = pd.to_datetime(df["Timestamp"], errors="coerce")
+    parsed = df[entry_cols].apply(lambda row: [parse_entry_label(v) for v in row if str(v).strip()], axis=1)
+    cols["count"] = parsed.map(len)
+
+    # the register form's schema, checked a column at a time; only rows that
+    # fail go through parse_submission_form() to get the form's messages
+    flagged = ~cols["count"].between(1, MAX_ENTRIES)
+    for key, rule in SUBMISSION_SCHEMA.items():
+        cols[key], bad = check_column(rule, cols[key])
+        flagged |= bad
+    owners = [idx for idx, es in parsed.items() for e in es if e]
+    flat = pd.DataFrame([e for es in parsed for e in es if e], columns=list(ENTRY_SCHEMA)).fillna("")
+    entry_bad = pd.Series(False, index=flat.index)
+    for key, rule in ENTRY_SCHEMA.items():
+        flat[key], bad = check_column(rule, flat[key])
+        entry_bad |= bad
+    entry_bad |= flat["calendar"].eq("") & flat[["year", "month", "day"]].ne("").any(axis=1)
+    flagged |= entry_bad.groupby(pd.Series(owners, index=flat.index, dtype=object)).any() \
+        .reindex(cols.index, fill_value=False).astype(bool)
+    entries_by_row = {}
+    for idx, entry in zip(owners, flat.to_dict("records")):
+        entries_by_row.setdefault(idx, []).append(entry)
+
+    def row_errors(idx):
+        form = {key: cols.at[idx, key] for key in SUBMISSION_SCHEMA}
+        entries = [e for e in parsed[idx] if e]
+        form["count"] = str(len(entries))
+        for i, entry in enumerate(entries, 1):
+            form.update({f"d{i}_{k}": v for k, v in entry.items()})
+        return parse_submission_form(form)[3]
+
+    # file-level checks, one boolean mask per rule
+    checks = [
+        (parsed.map(lambda es: any(e is None for e in es)), "Unreadable entry cell"),
+        (cols.duplicated(subset=["name_cn", "local"], keep="first"), "Duplicate of an earlier row in this file"),
+    ]
+    existing = {}
+    for sub in event_submissions().filter(Submission.name_cn.in_(cols["name_cn"].unique().tolist())):
+        existing[(sub.name_cn, extract_local_phone(sub.phone))] = sub
+    keys = pd.Series(list(zip(cols["name_cn"], cols["local"])), index=cols.index)
+    checks.append((keys.map(lambda k: k in existing), "Already registered (same Chinese name and phone)"))
+
+    errors = {}
+    for idx in flagged[flagged].index:
+        messages = row_errors(idx)
+        if messages:
+            errors[int(idx) + 2] = messages  # +2: header row, 1-based
+    for mask, message in checks:
+        for idx in mask[mask].index:
+            errors.setdefault(int(idx) + 2, []).append(message)
+
+    now = now_utc8()
+    rows = []
+    for idx, row in cols.iterrows():
+        if int(idx) + 2 in errors:
+            continue
+        rows.append({
+            "order_id": row["order_id"],
+            "date": row["date"].to_pydatetime() if not pd.isna(row["date"]) else now,
+            "boat": row["boat"],
+            "gender": row["gender"],
+            "name_cn": row["name_cn"],
+            "name_en": row["name_en"],
+            "phone": row["phone"],
+            "payment_method": row["payment_method"],
+            "count": int(row["count"]),
+            "total": calc_total(row["boat"], int(row["count"])),
+            "paid": bool(row["paid"]),
+            "entries": json.dumps(entries_by_row[idx]),
+            "payment_amount": int(row["payment_amount"]) if row["paid"] else 0,
+            "remarks": row["remarks"],
+            "_line": int(idx) + 2,
+        })
+    return rows, errors
+
+def insert_submissions(rows):
+    table = Submission.__table__
+    event_id = active_event_id()
+    for start in range(0, len(rows), IMPORT_BATCH_SIZE):
+        batch = [{k: v for k, v in r.items() if not k.startswith("_")} for r in rows[start:start + IMPORT_BATCH_SIZE]]
+        for row, code in zip(batch, allocate_order_codes(db.session.connection(), len(batch))):
+            row["order_code"] = code
+            row["event_id"] = event_id
+        db.session.execute(table.insert(), batch)
+    if rows:
+        # core inserts skip the ORM flush hooks
+        bump_data_version()
+        usage = Counter()
+        for r in rows:
+            usage.update(capacity_usage(r.get("boat"), r.get("entries")))
+        take_capacity(db.session.connection(), event_id, usage)
+
+@app.route("/admin/import", methods=["GET", "POST"])
+@login_required
+@write_gated
+def admin_import():
+    if request.method == "GET":
+        return render_template("import.html", report=None)
+    upload = request.files.get("sheet")
+    if not upload or not upload.filename:
+        flash("Please choose a spreadsheet.", "danger")
+        return redirect(url_for("admin_import"))
+    try:
+        df = read_uploaded_table(upload)
+        rows, errors = validate_import(df)
+    except Exception as e:
+        flash(f"Could not read spreadsheet: {e}", "danger")
+        return redirect(url_for("admin_import"))
+
+    dry_run = request.form.get("dry_run") == "1"
+    if not dry_run and rows:
+        insert_submissions(rows)
+        log_admin(
+            action="Import registrations",
+            user=session.get('username', 'unknown'),
+            detail=f"Imported {len(rows)} submissions from {upload.filename} ({len(errors)} rows rejected)",
+            commit=False
+        )
+        db.session.commit()
+
+    report = [{"line": r["_line"], "ok": True, "message": f"{r['name_cn']} / {r['phone']} – {r['count']} entries, RM {r['total']}"} for r in rows]
+    report += [{"line": line, "ok": False, "message": "; ".join(msgs)} for line, msgs in errors.items()]
+    report.sort(key=lambda r: r["line"])
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({"ok": True, "dry_run": dry_run, "imported": 0 if dry_run else len(rows), "rows": report})
+    return render_template("import.html", report=report, dry_run=dry_run,
+                           imported=0 if dry_run else len(rows), filename=upload.filename)
+
+# -----------------------
+#     EVENTS (ONE PER FESTIVAL YEAR)
+# -----------------------
+# Owners open next year's event and switch the site over; older events can
+# then be moved out of ghostfest.db into their own SQLite file, which can be
+# ATTACHed read-only whenever someone needs the history.
+EVENT_ARCHIVE_DIR = os.environ.get("EVENT_ARCHIVE_DIR", os.path.join(os.path.dirname(str(db_file)), "events"))
+
+def export_basename():
+    event = active_event()
+    return re.sub(r'[\\/:*?"<>|]+', "-", event.name if event else "Ghost Festival")
+
+def detach_event(event_id, vacuum=False):
+    # copy the event's rows into events/event-<id>.db, then drop them here;
+    # the copy commits first, so a crash in between leaves a duplicate, never a loss
+    event = db.session.get(Event, event_id)
+    if not event:
+        raise ValueError(f"No event with id {event_id}.")
+    if event.archive_file:
+        raise ValueError(f"Event {event_id} is already detached to {event.archive_file}.")
+    if event_id == active_event_id():
+        raise ValueError("Switch to another event before detaching the active one.")
+    os.makedirs(EVENT_ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(EVENT_ARCHIVE_DIR, f"event-{event_id}.db")
+    if os.path.exists(path):
+        raise ValueError(f"{path} already exists.")
+    db.session.commit()
+
+    tables = {"event": "id", "submission": "event_id", "admin_log": "event_id",
+              "outbox": "event_id", "capacity": "event_id"}
+    conn = sqlite3.connect(str(db_file), isolation_level=None, timeout=15)
+    try:
+        conn.execute("ATTACH DATABASE ? AS archive", (path,))
+        conn.execute("BEGIN")
+        for table, column in tables.items():
+            conn.execute(f"CREATE TABLE archive.{table} AS SELECT * FROM main.{table} WHERE {column} = ?",
+                         (event_id,))
+        conn.execute("COMMIT")
+        counts = {t: conn.execute(f"SELECT COUNT(*) FROM archive.{t}").fetchone()[0] for t in tables}
+
+        conn.execute("BEGIN IMMEDIATE")
+        # dismissed duplicate clusters name submission ids: drop the ones leaving with the event
+        gone = {str(r[0]) for r in conn.execute("SELECT id FROM archive.submission")}
+        row = conn.execute("SELECT payload FROM main.summary_cache WHERE key = 'duplicates.dismissed'").fetchone()
+        if row and gone:
+            kept = [k for k in json.loads(row[0]) if not gone & set(k.split(","))]
+            conn.execute("UPDATE main.summary_cache SET payload = ? WHERE key = 'duplicates.dismissed'",
+                         (json.dumps(kept),))
+        for table, column in tables.items():
+            if table != "event":
+                conn.execute(f"DELETE FROM main.{table} WHERE {column} = ?", (event_id,))
+        conn.execute("UPDATE main.event SET archive_file = ? WHERE id = ?", (path, event_id))
+        conn.execute("COMMIT")
+        conn.execute("DETACH DATABASE archive")
+        if vacuum:
+            conn.execute("VACUUM")
+    finally:
+        conn.close()
+    return path, counts
+
+@app.cli.command("detach-event", help="Move a past event's rows into their own SQLite file.")
+@click.argument("event_id", type=int)
+@click.option("--vacuum", is_flag=True, help="Reclaim the freed space in ghostfest.db afterwards.")
+def detach_event_command(event_id, vacuum):
+    try:
+        path, counts = detach_event(event_id, vacuum=vacuum)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(f"✅ Event {event_id} detached to {path}: "
+          f"{counts['submission']} submissions, {counts['admin_log']} log entries, "
+          f"{counts['outbox']} reminders")
+
+@app.route("/admin/events", methods=["GET", "POST"])
+@login_required
+def admin_events():
+    if request.method == "POST":
+        if not is_owner():
+            flash("Only the owner can manage events.", "danger")
+            return redirect(url_for("admin_events"))
+        current_user = session.get('username', 'unknown')
+        action = request.form.get("action")
+        if action == "create":
+            name = request.form.get("name", "").strip()[:64]
+            if not name:
+                flash("Event name is required.", "danger")
+                return redirect(url_for("admin_events"))
+            event = Event(name=name)
+            db.session.add(event)
+            db.session.flush()
+            recount_capacity(event.id)
+            log_admin("Create event", current_user, f"Created event {event.id}: {name}")
+            flash(f"Created {name}.", "success")
+        elif action == "activate":
+            event = db.session.get(Event, request.form.get("event_id", type=int) or 0)
+            if not event or event.archive_file:
+                flash("That event can't be activated.", "danger")
+                return redirect(url_for("admin_events"))
+            state = SysState.query.first()
+            state.active_event_id = event.id
+            # every cache keyed on the data version now reloads for the new event
+            bump_data_version(db.session.connection())
+            g.event_id = event.id
+            log_admin("Switch event", current_user, f"Active event is now {event.id}: {event.name}")
+            flash(f"{event.name} is now the active event.", "success")
+        return redirect(url_for("admin_events"))
+
+    counts = dict(db.session.query(Submission.event_id, func.count(Submission.id))
+                  .group_by(Submission.event_id).all())
+    events = Event.query.order_by(Event.id.desc()).all()
+    return render_template("events.html", events=events, counts=counts,
+                           active_id=active_event_id(), is_owner=is_owner())
+
+
+@app.route("/admin/capacity", methods=["GET", "POST"])
+@login_required
+def admin_capacity():
+    event_id = active_event_id()
+    if request.method == "POST":
+        if not is_owner():
+            flash("Only the owner can change capacity limits.", "danger")
+            return redirect(url_for("admin_capacity"))
+        current_user = session.get('username', 'unknown')
+        if request.form.get("action") == "recount":
+            recount_capacity(event_id)
+            log_admin("Recount capacity", current_user, f"Recounted capacity usage for event {event_id}")
+            flash("Usage recounted from the submissions.", "success")
+            return redirect(url_for("admin_capacity"))
+        caps = request.form.getlist("cap")
+        if len(caps) != len(capacity_keys()) or not all(c.strip().isdigit() for c in caps if c.strip()):
+            flash("Limits must be whole numbers (leave blank for no limit).", "danger")
+            return redirect(url_for("admin_capacity"))
+        recount_capacity(event_id)
+        for key, cap in zip(capacity_keys(), caps):
+            db.session.get(Capacity, (event_id, key)).cap = int(cap) if cap.strip() else None
+        log_admin("Set capacity", current_user,
+                  "; ".join(f"{capacity_label(k)}={c.strip() or 'no limit'}" for k, c in zip(capacity_keys(), caps)))
+        flash("Capacity limits saved.", "success")
+        return redirect(url_for("admin_capacity"))
+
+    rows = {c.key: c for c in Capacity.query.filter_by(event_id=event_id)}
+    return render_template("capacity.html", keys=capacity_keys(), rows=rows, label=capacity_label,
+                           event_name=export_basename(), is_owner=is_owner())
+
+
 # -----------------------
 #   ADMIN HISTORY ROUTE
 # -----------------------
 @app.route("/admin/history")
 @login_required
 def admin_history():
-    logs = AdminLog.query.order_by(AdminLog.ts.desc()).limit(200).all()
+    logs = (AdminLog.query.filter(AdminLog.event_id == active_event_id())
+            .order_by(AdminLog.ts.desc()).limit(200).all())
     return render_template("admin_history.html", logs=logs)
 
 # =======================
@@ -1161,13 +3970,129 @@ def admin_history():
 
 # (No debug_options route)
 
+# Per-worker counters (rate limits, caches, template compiles, lazy imports)
+@app.route("/admin/metrics")
+@login_required
+def admin_metrics():
+    return jsonify({"ok": True, "worker": worker_id(), "metrics": dict(METRICS)})
+
 # ←— 3) Health‑check endpoint for Render —→
+# Plain /healthz is liveness only.  /healthz?mode=ready times a read and a
+# write-lock round-trip and looks at the WAL, the disk and the background
+# queues; any "unhealthy" check answers 503 so Render stops routing to this
+# worker.  Results are cached per worker for HEALTH_CACHE_SECONDS.
+HEALTH_CACHE_SECONDS = float(os.environ.get("HEALTH_CACHE_SECONDS", 2))
+HEALTH_LOCK_TIMEOUT = float(os.environ.get("HEALTH_LOCK_TIMEOUT", 2))
+MB = 1024 * 1024
+# check: (degraded at, unhealthy at); free disk is "below", the rest "above"
+HEALTH_THRESHOLDS = {
+    "db_read_ms": (200, 2000),
+    "db_write_lock_ms": (500, HEALTH_LOCK_TIMEOUT * 1000),
+    "wal_mb": (64, 512),
+    "disk_free_mb": (500, 100),
+    "outbox_queued": (500, 5000),
+    # a stale replica only sends the heavy reads back to the primary, so
+    # it can make a worker degraded but never takes it out of rotation
+    "replica_lag_s": (REPLICA_MAX_LAG, float("inf")),
+}
+_health_state = {"at": 0.0, "report": None}
+
+def health_status(name, value):
+    degraded, unhealthy = HEALTH_THRESHOLDS[name]
+    if name == "disk_free_mb":
+        return "unhealthy" if value < unhealthy else "degraded" if value < degraded else "ok"
+    return "unhealthy" if value >= unhealthy else "degraded" if value >= degraded else "ok"
+
+def hit_ratio(hits, *misses):
+    total = METRICS[hits] + sum(METRICS[m] for m in misses)
+    return round(METRICS[hits] / total, 3) if total else None
+
+def readiness_report():
+    checks = {}
+    started = time.perf_counter()
+    try:
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql("SELECT data_version FROM sys_state LIMIT 1").scalar()
+        checks["db_read_ms"] = (time.perf_counter() - started) * 1000
+    except Exception as e:
+        checks["db_read_ms"] = {"status": "unhealthy", "error": str(e)[:200]}
+
+    # take and drop the write lock on a private connection with a short
+    # timeout: nothing is written, but a stuck writer shows up here
+    started = time.perf_counter()
+    conn = sqlite3.connect(str(db_file), timeout=HEALTH_LOCK_TIMEOUT, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("ROLLBACK")
+        checks["db_write_lock_ms"] = (time.perf_counter() - started) * 1000
+    except sqlite3.Error as e:
+        checks["db_write_lock_ms"] = {"status": "unhealthy", "error": str(e)[:200]}
+    finally:
+        conn.close()
+
+    wal = f"{db_file}-wal"
+    checks["wal_mb"] = os.path.getsize(wal) / MB if os.path.exists(wal) else 0.0
+    checks["disk_free_mb"] = shutil.disk_usage(os.path.dirname(str(db_file))).free / MB
+    try:
+        with db.engine.connect() as conn:
+            checks["outbox_queued"] = conn.exec_driver_sql(
+                "SELECT COUNT(*) FROM outbox WHERE status = 'queued'").scalar()
+    except Exception as e:
+        checks["outbox_queued"] = {"status": "degraded", "error": str(e)[:200]}
+    if REPLICA_ENABLED:
+        info = replica_info()
+        if info:
+            checks["replica_lag_s"] = replica_lag(info, current_data_version())
+        else:
+            checks["replica_lag_s"] = {"status": "degraded", "error": "No replica snapshot yet"}
+
+    for name, value in checks.items():
+        if not isinstance(value, dict):
+            checks[name] = {"value": round(value, 1), "status": health_status(name, value)}
+    statuses = {c["status"] for c in checks.values()}
+    return {
+        "status": "unhealthy" if "unhealthy" in statuses else "degraded" if "degraded" in statuses else "ok",
+        "worker": worker_id(),
+        "checks": checks,
+        "jobs": {
+            "summary_refreshing": _summary_state["refreshing"],
+            "outbox_sender_running": _outbox_state["running"],
+            "replica_sync_running": _replica_state["pid"] == os.getpid(),
+        },
+        "cache_hit_ratio": {
+            "summary": hit_ratio("summary_cache.hit", "summary_cache.stale", "summary_cache.miss"),
+            "reports": hit_ratio("reports.hit", "reports.append", "reports.rebuild"),
+            "pdf": hit_ratio("pdf.cache_hits", "pdf.cache_misses"),
+            "jinja_bytecode": hit_ratio("jinja.bytecode_hits", "jinja.bytecode_misses"),
+        },
+    }
+
 @app.route("/healthz")
 def health_check():
-    return "OK"
+    if request.args.get("mode") != "ready":
+        return "OK"
+    now = time.time()
+    report = _health_state["report"]
+    if report is None or now - _health_state["at"] > HEALTH_CACHE_SECONDS:
+        report = readiness_report()
+        _health_state.update(at=now, report=report)
+        bump_metric("healthz.checks")
+    return jsonify(report), 503 if report["status"] == "unhealthy" else 200
+
+# Under gunicorn.conf.py the Procfile runs `flask bootstrap` once before the
+# workers start; plain `python app.py` / `flask run` still bootstrap here.
+if os.environ.get("SKIP_BOOTSTRAP", "").lower() not in ("1", "true"):
+    with app.app_context():
+        create_tables()
+
+# With gunicorn's preload_app this runs once in the master, so every forked
+# worker starts with all templates compiled in memory.
+if os.environ.get("WARM_TEMPLATES", "").lower() in ("1", "true"):
+    warm_templates()
 
 # ←— main guard only starts the server —→
 if __name__ == "__main__":
+    start_replica_sync()
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=False, use_reloader=False)
 
@@ -0,0 +1,41 @@
+# Gunicorn settings for Render, loaded automatically from the project root.
+#   Procfile:  flask --app app bootstrap && gunicorn app:app
+# Every value can be overridden from the environment without a code change.
+import multiprocessing
+import os
+
+# the schema/seed step already ran via `flask bootstrap`
+os.environ.setdefault("SKIP_BOOTSTRAP", "1")
+# compile every template in the master before forking (see warm_templates)
+os.environ.setdefault("WARM_TEMPLATES", "1")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+
+# import app.py once in the master and fork workers from it (copy-on-write)
+preload_app = True
+
+# gthread: a slow export in one thread doesn't block the rest of the worker
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("WEB_CONCURRENCY", min(multiprocessing.cpu_count() * 2 + 1, 4)))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+# Excel/PDF exports can take a while on the small Render instance
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+
+# recycle workers now and then so pandas memory doesn't pile up
+max_requests = 1000
+max_requests_jitter = 100
+
+accesslog = "-"
+errorlog = "-"
+
+
+def post_fork(server, worker):
+    # never share SQLite connections the master may have opened while preloading
+    from app import app, db, start_replica_sync
+    with app.app_context():
+        db.engine.dispose(close=False)
+    # keep the read replica syncing from boot, not from the first export
+    start_replica_sync()
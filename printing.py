@@ -0,0 +1,138 @@
+# Ceremony print-outs: tablets (one per deceased name) and run sheets (one
+# numbered list per option).  Rendered in pool processes started by app.py,
+# so this module only needs fpdf -- no Flask, no database, no pandas.
+import os
+
+from fpdf import FPDF, set_global
+
+FONT = "cjk"
+GENDER_CN = {"male": "男", "female": "女"}
+
+# A4 portrait, four tablets across
+TABLETS_PER_PAGE = 4
+TABLET_GAP = 3
+MARGIN = 10
+
+
+def use_font_cache(cache_dir):
+    # parsing a CJK TTF takes seconds; fpdf pickles the metrics under cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    set_global("FPDF_CACHE_MODE", 2)
+    set_global("FPDF_CACHE_DIR", cache_dir)
+
+
+def prepare_font(font_path, cache_dir):
+    # run once in the parent so shard processes never race to write the pickle
+    use_font_cache(cache_dir)
+    pdf = FPDF()
+    pdf.add_font(FONT, "", font_path, uni=True)
+
+
+class MemberList(list):
+    # list with set-speed "in"
+    def __init__(self, items):
+        super().__init__(items)
+        self.members = set(items)
+
+    def __contains__(self, item):
+        return item in self.members
+
+
+class PrintPDF(FPDF):
+    # fpdf 1.7 writes the width table by testing every code point of the font
+    # against the list of used glyphs -- quadratic for a CJK font with
+    # thousands of names.  The subset is final by then, so index it.
+    def _putTTfontwidths(self, font, maxUni):
+        font["subset"] = MemberList(font["subset"])
+        super()._putTTfontwidths(font, maxUni)
+
+
+class RunSheet(PrintPDF):
+    COLUMNS = [("No.", 14), ("Order", 22), ("姓名 Name", 72), ("性别", 16),
+               ("日期 Date", 72), ("阳上 Sponsor", 70)]
+
+    def __init__(self, title):
+        super().__init__("L", "mm", "A4")
+        self.sheet_title = title
+
+    def header(self):
+        self.set_font(FONT, "", 14)
+        self.cell(0, 9, self.sheet_title, 0, 1, "L")
+        self.set_font(FONT, "", 10)
+        self.set_fill_color(230, 230, 230)
+        for label, width in self.COLUMNS:
+            self.cell(width, 8, label, 1, 0, "C", True)
+        self.ln()
+
+    def footer(self):
+        self.set_y(-12)
+        self.set_font(FONT, "", 8)
+        self.cell(0, 6, f"{self.page_no()} / {{nb}}", 0, 0, "R")
+
+
+def render_runsheet(job):
+    pdf = RunSheet(job["title"])
+    pdf.add_font(FONT, "", job["font"], uni=True)
+    pdf.alias_nb_pages()
+    pdf.set_auto_page_break(True, 14)
+    pdf.add_page()
+    pdf.set_font(FONT, "", 11)
+    for no, row in enumerate(job["rows"], job["start"] + 1):
+        values = [str(no), row["order_id"], row["name"], GENDER_CN.get(row["gender"], ""),
+                  row["date"], row["sponsor"]]
+        for value, (_, width) in zip(values, RunSheet.COLUMNS):
+            pdf.cell(width, 8, value, 1, 0, "C" if width < 30 else "L")
+        pdf.ln()
+    pdf.output(job["out"], "F")
+
+
+def render_tablets(job):
+    pdf = PrintPDF("P", "mm", "A4")
+    pdf.add_font(FONT, "", job["font"], uni=True)
+    pdf.set_auto_page_break(False)
+    width = (pdf.w - 2 * MARGIN - (TABLETS_PER_PAGE - 1) * TABLET_GAP) / TABLETS_PER_PAGE
+    height = pdf.h - 2 * MARGIN
+    for i, row in enumerate(job["rows"]):
+        if i % TABLETS_PER_PAGE == 0:
+            pdf.add_page()
+        x = MARGIN + (i % TABLETS_PER_PAGE) * (width + TABLET_GAP)
+        draw_tablet(pdf, x, MARGIN, width, height, row)
+    pdf.output(job["out"], "F")
+
+
+def draw_tablet(pdf, x, y, width, height, row):
+    pdf.rect(x, y, width, height)
+    pdf.rect(x + 1.5, y + 1.5, width - 3, height - 3)
+
+    pdf.set_font(FONT, "", 16)
+    pdf.set_xy(x, y + 6)
+    pdf.cell(width, 10, row["option"], 0, 0, "C")
+    pdf.line(x + 6, y + 20, x + width - 6, y + 20)
+
+    # the name runs top to bottom, one character per line, as on a real tablet
+    chars = [c for c in row["name"] if not c.isspace()] or ["　"]
+    room = height - 80
+    step = min(room / len(chars), 24)
+    pdf.set_font(FONT, "", min(step * 2.2, 40))
+    top = y + 26 + (room - step * len(chars)) / 2
+    for n, char in enumerate(chars):
+        pdf.set_xy(x, top + n * step)
+        pdf.cell(width, step, char, 0, 0, "C")
+
+    pdf.line(x + 6, y + height - 50, x + width - 6, y + height - 50)
+    pdf.set_font(FONT, "", 9)
+    lines = [f"{GENDER_CN.get(row['gender'], '')}  {row['date']}".strip(),
+             f"阳上 {row['sponsor']} 敬立", f"#{row['order_id']}"]
+    for n, text in enumerate(lines):
+        pdf.set_xy(x + 2, y + height - 46 + n * 12)
+        pdf.multi_cell(width - 4, 5, text, 0, "C")
+
+
+RENDERERS = {"tablets": render_tablets, "runsheet": render_runsheet}
+
+
+def render_shard(job):
+    # job: kind, title, font, font_cache, start, rows, out -> number of rows drawn
+    use_font_cache(job["font_cache"])
+    RENDERERS[job["kind"]](job)
+    return len(job["rows"])
@@ -0,0 +1,169 @@
+# Replays traffic captured with TRAFFIC_CAPTURE=1 against a running instance
+# and reports latency per route; with --baseline it compares two runs.
+#
+#   python replay_traffic.py traffic/*.jsonl --base-url http://localhost:5000 \
+#       --login owner:secret --speed 4 --out new.json --baseline old.json
+#
+# Hashed values are replaced by fakes derived from the hash (same length,
+# digits stay digits), so a replay sends the same requests every time.
+# Uploads (import/reconcile) can't be rebuilt and are skipped, and so are
+# login/logout: each replay thread logs in once with --login instead.
+import argparse
+import json
+import secrets
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+SKIP_ROUTES = {"/admin/login", "/admin/logout"}
+
+def load_records(paths, routes=None):
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # a line cut short by a crash or rotation
+                if r.get("files") or r.get("route") in (None, *SKIP_ROUTES):
+                    continue
+                if routes and r["route"] not in routes:
+                    continue
+                records.append(r)
+    records.sort(key=lambda r: r["t"])
+    return records
+
+
+def fake_value(key, value, nonce):
+    if not isinstance(value, dict):
+        return value
+    if key == "form_token":
+        return secrets.token_urlsafe(24)  # a replayed token would be treated as a resubmit
+    seed = int(value["h"], 16) + nonce
+    if value["digits"]:
+        return str(seed).rjust(value["len"], "1")[-value["len"]:]
+    return (value["h"] * (value["len"] // 12 + 1))[:value["len"]]
+
+
+def unmask(params, nonce):
+    return [(k, fake_value(k, v, nonce)) for k, values in params.items() for v in values]
+
+
+def percentile(sorted_ms, q):
+    if not sorted_ms:
+        return None
+    return round(sorted_ms[min(len(sorted_ms) - 1, int(q * len(sorted_ms)))], 2)
+
+
+def summarize(samples):
+    routes = {}
+    for key, items in samples.items():
+        ms = sorted(m for m, _ in items)
+        routes[key] = {
+            "n": len(ms),
+            "errors": sum(1 for _, status in items if status >= 500),
+            "mean": round(sum(ms) / len(ms), 2),
+            "p50": percentile(ms, 0.5),
+            "p90": percentile(ms, 0.9),
+            "p99": percentile(ms, 0.99),
+        }
+    return routes
+
+
+def replay(records, base_url, speed, concurrency, login, nonce):
+    local = threading.local()
+    samples, lock = {}, threading.Lock()
+
+    def client():
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            if login:
+                username, _, password = login.partition(":")
+                local.session.post(f"{base_url}/admin/login",
+                                   data={"username": username, "password": password})
+        return local.session
+
+    def send(r):
+        session = client()
+        started = time.perf_counter()
+        try:
+            resp = session.request(r["method"], base_url + r["path"], params=unmask(r["args"], nonce),
+                                    data=unmask(r["form"], nonce) or None, allow_redirects=False, timeout=60)
+            status = resp.status_code
+        except requests.RequestException:
+            status = 599
+        ms = (time.perf_counter() - started) * 1000
+        with lock:
+            samples.setdefault(f"{r['method']} {r['route']}", []).append((ms, status))
+
+    t0, start = records[0]["t"], time.time()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for r in records:
+            if speed > 0:
+                delay = start + (r["t"] - t0) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(send, r)
+    return summarize(samples)
+
+
+def compare(baseline, current, threshold, min_samples):
+    regressions = []
+    print(f"{'route':48} {'n':>5} {'p50 old':>9} {'p50 new':>9} {'p90 old':>9} {'p90 new':>9}  change")
+    for key in sorted(current):
+        new, old = current[key], baseline.get(key)
+        if not old:
+            print(f"{key:48} {new['n']:>5} {'-':>9} {new['p50']:>9} {'-':>9} {new['p90']:>9}  (new)")
+            continue
+        change = (new["p90"] - old["p90"]) / old["p90"] if old["p90"] else 0.0
+        flag = ""
+        if change > threshold and new["n"] >= min_samples:
+            flag = "  <-- regression"
+            regressions.append(key)
+        print(f"{key:48} {new['n']:>5} {old['p50']:>9} {new['p50']:>9} {old['p90']:>9} {new['p90']:>9}"
+              f"  {change:+.0%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic and compare latency between builds.")
+    parser.add_argument("files", nargs="+", help="traffic-*.jsonl files written by TRAFFIC_CAPTURE")
+    parser.add_argument("--base-url", default="http://localhost:5000")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = real time, N = N times faster, 0 = no pauses")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--login", help="username:password for the admin routes")
+    parser.add_argument("--route", action="append", help="only replay this route rule (repeatable)")
+    parser.add_argument("--seed", type=int, default=0, help="changes every fake value, e.g. to avoid duplicate checks")
+    parser.add_argument("--out", help="write the latency summary here (JSON)")
+    parser.add_argument("--baseline", help="summary from an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="p90 slowdown that counts as a regression")
+    parser.add_argument("--min-samples", type=int, default=20)
+    args = parser.parse_args()
+
+    records = load_records(args.files, set(args.route) if args.route else None)
+    if not records:
+        sys.exit("No replayable requests in those files.")
+    print(f"Replaying {len(records)} requests against {args.base_url} at {args.speed}x ...")
+    routes = replay(records, args.base_url.rstrip("/"), args.speed, args.concurrency, args.login, args.seed)
+    summary = {"base_url": args.base_url, "speed": args.speed, "requests": len(records), "routes": routes}
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["routes"]
+        regressions = compare(baseline, routes, args.threshold, args.min_samples)
+        if regressions:
+            sys.exit(f"{len(regressions)} route(s) regressed: {', '.join(regressions)}")
+    else:
+        for key, stats in sorted(routes.items()):
+            print(f"{key:48} n={stats['n']:<5} p50={stats['p50']} p90={stats['p90']} p99={stats['p99']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+// Register submissions waiting to reach the server, kept in IndexedDB.
+// Loaded by the service worker (which sends them) and by /offline (which
+// shows them).  One record per form_token:
+//   {token, fields: [[name, value], ...], created, attempts, next_try,
+//    status: "queued" | "sent" | "answered", result_url, error}
+const REGISTER_QUEUE_DB = "ghostfest-offline";
+const REGISTER_QUEUE_STORE = "submissions";
+const REGISTER_BACKOFF_MS = 2000;        // first retry, doubles per attempt
+const REGISTER_BACKOFF_MAX_MS = 5 * 60 * 1000;
+const REGISTER_ANSWER_PATH = "/offline/answer/";
+const REGISTER_ANSWER_CACHE = "ghostfest-answers";
+
+function openRegisterQueue() {
+  return new Promise((resolve, reject) => {
+    const req = indexedDB.open(REGISTER_QUEUE_DB, 1);
+    req.onupgradeneeded = () => req.result.createObjectStore(REGISTER_QUEUE_STORE, { keyPath: "token" });
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  });
+}
+
+async function registerQueueTx(mode, fn) {
+  const db = await openRegisterQueue();
+  return new Promise((resolve, reject) => {
+    const tx = db.transaction(REGISTER_QUEUE_STORE, mode);
+    const req = fn(tx.objectStore(REGISTER_QUEUE_STORE));
+    tx.oncomplete = () => { db.close(); resolve(req && req.result); };
+    tx.onerror = () => { db.close(); reject(tx.error); };
+  });
+}
+
+function listQueued() {
+  return registerQueueTx("readonly", store => store.getAll());
+}
+
+function getQueued(token) {
+  return registerQueueTx("readonly", store => store.get(token));
+}
+
+function putQueued(item) {
+  return registerQueueTx("readwrite", store => store.put(item));
+}
+
+function deleteQueued(token) {
+  return registerQueueTx("readwrite", store => store.delete(token));
+}
+
+function queuedField(item, name) {
+  const pair = item.fields.find(([k]) => k === name);
+  return pair ? pair[1] : "";
+}
+
+function backoffDelay(attempts, retryAfterSeconds) {
+  // full jitter, so phones that come back online together don't retry together
+  const ceiling = Math.min(REGISTER_BACKOFF_MAX_MS, REGISTER_BACKOFF_MS * 2 ** attempts);
+  const wait = ceiling / 2 + Math.random() * ceiling / 2;
+  return Math.max(wait, (retryAfterSeconds || 0) * 1000);
+}
+
+async function enqueueSubmission(fields) {
+  const token = (fields.find(([k]) => k === "form_token") || [])[1];
+  const existing = await getQueued(token);
+  if (existing && existing.status !== "queued") return existing;
+  const item = existing || { token, fields, created: Date.now(), attempts: 0, status: "queued" };
+  item.fields = fields;
+  item.next_try = Date.now() + backoffDelay(item.attempts);
+  await putQueued(item);
+  return item;
+}
+
+async function sendQueued(item) {
+  // the server answers a replayed form_token with the first redirect, so a
+  // re-send of a POST that did arrive cannot register twice
+  let resp;
+  try {
+    resp = await fetch("/", {
+      method: "POST",
+      body: new URLSearchParams(item.fields),
+      credentials: "same-origin",
+    });
+  } catch (err) {
+    resp = null;
+  }
+  if (!resp || resp.status === 429 || resp.status >= 500) {
+    item.attempts += 1;
+    item.next_try = Date.now() + backoffDelay(item.attempts, resp && parseInt(resp.headers.get("Retry-After")));
+    item.error = resp ? `HTTP ${resp.status}` : "offline";
+  } else if (resp.redirected) {
+    item.status = "sent";
+    item.result_url = resp.url;
+  } else {
+    // the server wants the person back (errors, duplicate check, closed):
+    // keep its page so /offline can open it
+    const url = REGISTER_ANSWER_PATH + item.token;
+    const cache = await caches.open(REGISTER_ANSWER_CACHE);
+    await cache.put(url, new Response(await resp.text(), {
+      headers: { "Content-Type": "text/html; charset=utf-8" },
+    }));
+    item.status = "answered";
+    item.result_url = url;
+  }
+  await putQueued(item);
+  return item;
+}
+
+let registerFlush = null;
+
+function flushQueue(force) {
+  // one pass at a time; unless forced, items that are not due yet wait
+  if (!registerFlush) {
+    registerFlush = (async () => {
+      const now = Date.now();
+      const due = (await listQueued()).filter(i => i.status === "queued" && (force || i.next_try <= now));
+      due.sort((a, b) => a.created - b.created);
+      const done = [];
+      for (const item of due) {
+        done.push(await sendQueued(item));
+        if (item.status === "queued") break;  // still offline: the rest would fail too
+      }
+      return done;
+    })().finally(() => { registerFlush = null; });
+  }
+  return registerFlush;
+}
@@ -0,0 +1,116 @@
+// Service worker for the registration form, served from /sw.js.
+// version {{ version }}
+importScripts("{{ url_for('static', filename='offline-queue.js') }}");
+
+const CACHE = "ghostfest-{{ version }}";
+const FORM_URL = "{{ url_for('register') }}";
+const OFFLINE_URL = "{{ url_for('offline_queue') }}";
+const PAGE_TIMEOUT_MS = 3000;    // then show the cached form
+const SUBMIT_TIMEOUT_MS = 20000; // then queue it; a late arrival is deduped by form_token
+const PRECACHE = [
+  FORM_URL,
+  OFFLINE_URL,
+  "{{ url_for('web_manifest') }}",
+  "https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css",
+  "https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js",
+  {% for url in assets %}"{{ url }}",
+  {% endfor %}
+];
+
+self.addEventListener("install", event => {
+  event.waitUntil(caches.open(CACHE).then(cache => cache.addAll(PRECACHE)).then(() => self.skipWaiting()));
+});
+
+self.addEventListener("activate", event => {
+  event.waitUntil((async () => {
+    const keep = [CACHE, REGISTER_ANSWER_CACHE];
+    for (const name of await caches.keys()) {
+      if (!keep.includes(name)) await caches.delete(name);
+    }
+    await self.clients.claim();
+    await flushAndNotify();
+  })());
+});
+
+async function flushAndNotify(force) {
+  const done = await flushQueue(force);
+  if (done.length) {
+    for (const client of await self.clients.matchAll()) client.postMessage({ type: "queue-changed" });
+  }
+  return (await listQueued()).filter(i => i.status === "queued").length;
+}
+
+function withTimeout(promise, ms) {
+  return new Promise((resolve, reject) => {
+    const timer = setTimeout(() => reject(new Error("timeout")), ms);
+    promise.then(r => { clearTimeout(timer); resolve(r); }, e => { clearTimeout(timer); reject(e); });
+  });
+}
+
+async function formPage(request) {
+  // fresh page when the network answers quickly, otherwise the cached one;
+  // the page makes its own form_token, so a cached copy is safe to reuse
+  const cache = await caches.open(CACHE);
+  const network = fetch(request).then(resp => {
+    if (resp.ok) cache.put(FORM_URL, resp.clone());
+    return resp;
+  });
+  try {
+    return await withTimeout(network, PAGE_TIMEOUT_MS);
+  } catch (err) {
+    const cached = await cache.match(FORM_URL);
+    return cached || network;
+  }
+}
+
+async function submitForm(request) {
+  const fields = [...(await request.clone().formData()).entries()];
+  const token = (fields.find(([k]) => k === "form_token") || [])[1];
+  try {
+    // a navigation can't be given an AbortSignal; a late answer is simply dropped
+    const resp = await withTimeout(fetch(request), SUBMIT_TIMEOUT_MS);
+    if (!token || (resp.status !== 429 && resp.status < 500)) return resp;
+  } catch (err) {
+    if (!token) throw err;
+  }
+  await enqueueSubmission(fields);
+  if (self.registration.sync) {
+    try { await self.registration.sync.register("register-queue"); } catch (err) { /* /offline retries instead */ }
+  }
+  return Response.redirect(`${OFFLINE_URL}?token=${encodeURIComponent(token)}`, 303);
+}
+
+async function cachedAnswer(request) {
+  const cache = await caches.open(REGISTER_ANSWER_CACHE);
+  return (await cache.match(request)) || Response.redirect(FORM_URL, 303);
+}
+
+self.addEventListener("fetch", event => {
+  const request = event.request;
+  const url = new URL(request.url);
+  const sameOrigin = url.origin === self.location.origin;
+  if (sameOrigin && url.pathname === FORM_URL && request.method === "POST") {
+    event.respondWith(submitForm(request));
+  } else if (request.method !== "GET") {
+    return;
+  } else if (sameOrigin && url.pathname === FORM_URL && request.mode === "navigate") {
+    event.respondWith(formPage(request));
+  } else if (sameOrigin && url.pathname.startsWith(REGISTER_ANSWER_PATH)) {
+    event.respondWith(cachedAnswer(request));
+  } else if (PRECACHE.includes(sameOrigin ? url.pathname : url.href)) {
+    event.respondWith(caches.match(request, { ignoreSearch: true }).then(hit => hit || fetch(request)));
+  }
+  if (request.mode === "navigate") event.waitUntil(flushAndNotify());
+});
+
+self.addEventListener("sync", event => {
+  // the browser fires this when the connection is back: try everything now,
+  // and fail the event while anything is left so it schedules another go
+  if (event.tag === "register-queue") {
+    event.waitUntil(flushAndNotify(true).then(left => { if (left) throw new Error(`${left} still queued`); }));
+  }
+});
+
+self.addEventListener("message", event => {
+  if (event.data && event.data.type === "flush") event.waitUntil(flushAndNotify(event.data.force));
+});
@@ -0,0 +1,64 @@
+import itertools
+import os
+import tempfile
+
+import pytest
+
+# a throwaway database (and rate-limit/replica files next to it) for the run
+os.environ["DB_FILE"] = os.path.join(tempfile.mkdtemp(prefix="ghostfest-test-"), "ghostfest.db")
+os.environ["SKIP_BOOTSTRAP"] = "1"
+os.environ["REPLICA"] = "0"
+
+import app as ghostfest  # noqa: E402
+
+_ips = itertools.count(1)
+_phones = itertools.count(10000001)
+
+
+@pytest.fixture(scope="session")
+def app():
+    with ghostfest.app.app_context():
+        ghostfest.create_tables()
+    return ghostfest
+
+
+def new_client():
+    # every client gets its own address, so its own rate-limit buckets
+    n = next(_ips)
+    c = ghostfest.app.test_client()
+    c.environ_base["REMOTE_ADDR"] = f"10.0.{n // 250}.{n % 250 + 1}"
+    return c
+
+
+@pytest.fixture
+def client(app):
+    return new_client()
+
+
+@pytest.fixture
+def admin_client(app):
+    c = new_client()
+    with c.session_transaction() as s:
+        s["role"] = "owner"
+        s["username"] = "owner"
+    return c
+
+
+def register_form(**overrides):
+    form = {
+        "boat": "no", "your_gender": "male", "name_cn": "测试", "name_en": "Test",
+        "country_code": "+60", "phone": f"1{next(_phones)}", "count": "1", "payment_method": "tng",
+        "d1_option": "祖先", "d1_name_cn": "先人", "d1_gender": "female",
+        "d1_calendar": "lunar", "d1_year": "1950", "d1_month": "3", "d1_day": "8",
+        "form_token": ghostfest.new_form_token(),
+    }
+    form.update(overrides)
+    return form
+
+
+@pytest.fixture
+def register(app):
+    # POST the register form from a fresh address; returns the response
+    def post(**overrides):
+        return new_client().post("/", data=register_form(**overrides))
+    return post
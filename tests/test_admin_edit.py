@@ -0,0 +1,24 @@
+from test_register import order_code
+
+
+def submission_id(app, code):
+    with app.app.app_context():
+        return app.event_submissions().filter_by(order_code=code).one().id
+
+
+def test_edit_modal_load_does_not_log_entries(app, register, admin_client, capsys):
+    sub_id = submission_id(app, order_code(register(name_cn="日志", d1_name_cn="不可见")))
+    resp = admin_client.get(f"/admin/edit/{sub_id}")
+    assert resp.status_code == 200
+    assert resp.get_json()["entries"][0]["name_cn"] == "不可见"
+    out = capsys.readouterr()
+    assert "不可见" not in out.out + out.err
+
+
+def test_edit_with_schema_errors_answers_400_with_the_messages(app, register, admin_client):
+    sub_id = submission_id(app, order_code(register(name_cn="改错")))
+    resp = admin_client.post(f"/admin/edit/{sub_id}", data={"name_en": "E" * 40, "boat": "maybe"})
+    assert resp.status_code == 400
+    body = resp.get_json()
+    assert body["ok"] is False
+    assert body["error"].split("; ") == ["Boat is not a valid choice", "English name is too long"]
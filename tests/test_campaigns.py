@@ -0,0 +1,37 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def outbox(app):
+    # one queued reminder in the active event and one in another event
+    def queue():
+        with app.app.app_context():
+            rows = [app.Outbox(event_id=event_id, campaign="test", phone="60123", body="hi",
+                               status="queued", created=time.time())
+                    for event_id in (app.active_event_id(), -1)]
+            app.db.session.add_all(rows)
+            app.db.session.commit()
+            return [row.id for row in rows]
+    return queue
+
+
+def statuses(app, ids):
+    with app.app.app_context():
+        return [app.db.session.get(app.Outbox, i).status for i in ids]
+
+
+def test_cancel_only_touches_active_event(app, admin_client, outbox):
+    ids = outbox()
+    resp = admin_client.post("/admin/campaigns", data={"action": "cancel"})
+    assert resp.status_code == 302
+    assert statuses(app, ids) == ["cancelled", "queued"]
+
+
+def test_sender_only_drains_active_event(app, outbox, monkeypatch):
+    monkeypatch.setattr(app, "OUTBOX_RATE_PER_MIN", 60000)
+    ids = outbox()
+    app._outbox_state["running"] = True
+    app._drain_outbox()
+    assert statuses(app, ids) == ["sent", "queued"]
@@ -0,0 +1,38 @@
+import json
+import sqlite3
+import time
+
+from test_register import order_code
+
+
+def test_detach_takes_the_events_outbox_capacity_and_dismissals(app, register, admin_client):
+    with app.app.app_context():
+        source_event = app.active_event_id()
+    admin_client.post("/admin/events", data={"action": "create", "name": "Detach me"})
+    with app.app.app_context():
+        old_event = app.Event.query.filter_by(name="Detach me").one().id
+    admin_client.post("/admin/events", data={"action": "activate", "event_id": old_event})
+    try:
+        code = order_code(register(name_cn="离开"))
+        with app.app.app_context():
+            sub_id = app.event_submissions().filter_by(order_code=code).one().id
+            app.db.session.add(app.Outbox(event_id=old_event, campaign="test", phone="60123",
+                                          body="hi", status="queued", created=time.time()))
+            app.db.session.merge(app.SummaryCache(key="duplicates.dismissed",
+                                                  payload=json.dumps([f"{sub_id},{sub_id + 1}", "1,2"])))
+            app.db.session.commit()
+    finally:
+        admin_client.post("/admin/events", data={"action": "activate", "event_id": source_event})
+
+    with app.app.app_context():
+        path, counts = app.detach_event(old_event)
+        assert counts["outbox"] == 1 and counts["capacity"] > 0
+        assert app.Outbox.query.filter_by(event_id=old_event).count() == 0
+        assert app.Capacity.query.filter_by(event_id=old_event).count() == 0
+        dismissed, _ = app.load_cached_payload("duplicates.dismissed", [])
+        assert dismissed == ["1,2"]
+    archive = sqlite3.connect(path)
+    try:
+        assert archive.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 1
+    finally:
+        archive.close()
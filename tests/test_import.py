@@ -0,0 +1,71 @@
+import io
+import json
+
+import pandas as pd
+
+from test_register import order_code
+
+
+def test_export_then_import_into_a_new_event_round_trips(app, register, admin_client):
+    codes = [
+        order_code(register(name_cn="往返一", boat="yes", count="2",
+                            d2_option="狗狗", d2_name_cn="小黑", d2_gender="male", d2_calendar="not_sure")),
+        order_code(register(name_cn="往返二", payment_method="bank_transfer")),
+    ]
+    with app.app.app_context():
+        source_event = app.active_event_id()
+        before = {s.name_cn: s for s in app.event_submissions().filter(app.Submission.order_code.in_(codes))}
+        before = {name: (s.boat, s.gender, s.phone, s.payment_method, s.count, s.total, json.loads(s.entries))
+                  for name, s in before.items()}
+    sheet = admin_client.get("/admin/export/excel")
+    assert sheet.status_code == 200
+
+    admin_client.post("/admin/events", data={"action": "create", "name": "Round trip"})
+    with app.app.app_context():
+        target_event = app.Event.query.filter_by(name="Round trip").one().id
+    admin_client.post("/admin/events", data={"action": "activate", "event_id": target_event})
+    try:
+        resp = admin_client.post("/admin/import", content_type="multipart/form-data",
+                                 headers={"Accept": "application/json"},
+                                 data={"sheet": (io.BytesIO(sheet.data), "export.xlsx")})
+        assert resp.status_code == 200
+        report = resp.get_json()
+        assert [r for r in report["rows"] if not r["ok"]] == []
+        with app.app.app_context():
+            assert app.active_event_id() == target_event
+            after = {s.name_cn: (s.boat, s.gender, s.phone, s.payment_method, s.count, s.total,
+                                 json.loads(s.entries))
+                     for s in app.event_submissions().filter(app.Submission.name_cn.in_(list(before)))}
+        assert after == before
+    finally:
+        admin_client.post("/admin/events", data={"action": "activate", "event_id": source_event})
+
+
+def test_import_applies_the_register_form_rules(app):
+    good = {"Boat": "No", "Gender": "男 / Male", "Chinese Name": "规则", "English Name": "Rules",
+            "Phone": "+60123450000", "Payment Method": "TNG",
+            "Entry 1": "祖先 (Ancestor) - 许美月 (女) 1990年 1月 2日（农历）"}
+    rows = [
+        good,
+        dict(good, **{"Chinese Name": "长" * 30, "Phone": "+60123450001"}),
+        dict(good, **{"Chinese Name": "号码", "Phone": "+6" + "1" * 30}),
+        dict(good, **{"Chinese Name": "年份", "Phone": "+60123450003",
+                      "Entry 1": "祖先 - 许 (女) 19900年 1月 2日（农历）"}),
+        dict(good, **{"Chinese Name": "不详", "Phone": "+60123450004", "Entry 1": "祖先 - 许 (女) 1990年"}),
+        dict(good, **{"Chinese Name": "选项", "Phone": "+60123450005", "Entry 1": "猫 - 许 (女) "}),
+        dict(good, **{"Chinese Name": "", "Phone": "+60123450006", "Boat": "maybe"}),
+        dict(good, **{"Chinese Name": "没有", "Phone": "+60123450007", "Entry 1": ""}),
+    ]
+    df = pd.DataFrame(rows).fillna("")
+    with app.app.test_request_context():
+        valid, errors = app.validate_import(df)
+    assert [r["name_cn"] for r in valid] == ["规则"]
+    assert errors == {
+        3: ["Chinese name is too long"],
+        4: ["Phone is too long"],
+        5: ["Entry 1: Year has an invalid format"],
+        6: ["Entry 1: leave the date empty when not sure"],
+        7: ["Entry 1: Option is not a valid choice"],
+        8: ["Boat is required", "Chinese name is required"],
+        9: [f"Count must be between 1 and {app.MAX_ENTRIES}"],
+    }
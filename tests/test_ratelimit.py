@@ -0,0 +1,26 @@
+def test_review_lookups_are_rate_limited(app, client):
+    per_min, burst = app.RATE_LIMITS["review"]
+    with app.app.app_context():
+        codes = [app.random_order_code() for _ in range(int(burst) + 1)]
+    statuses = [client.get(f"/review?code={code}").status_code for code in codes]
+    assert statuses[:-1] == [302] * int(burst)
+    assert statuses[-1] == 429
+
+
+def test_review_limit_is_its_own_bucket(app, client):
+    _, burst = app.RATE_LIMITS["review"]
+    with app.app.app_context():
+        code = app.random_order_code()
+    for _ in range(int(burst) + 1):
+        client.get(f"/review?code={code}")
+    assert client.post("/check", data={"order_id": "0000"}).status_code == 200
+
+
+def test_spoofed_forwarded_for_does_not_pick_the_bucket(app, client):
+    # the caller rotates the left-most entries; the proxy appends the real address
+    _, burst = app.RATE_LIMITS["review"]
+    with app.app.app_context():
+        code = app.random_order_code()
+    statuses = [client.get(f"/review?code={code}", headers={"X-Forwarded-For": f"192.0.2.{i}, 198.51.100.7"}).status_code
+                for i in range(int(burst) + 1)]
+    assert statuses[-1] == 429
@@ -0,0 +1,35 @@
+import io
+import re
+
+from test_register import order_code
+
+
+def test_order_code_candidates_normalise_crockford(app):
+    code = app.random_order_code()
+    messy = code[:3].lower().replace("0", "o").replace("1", "l") + "-" + code[3:].lower()
+    assert code in app.order_code_candidates(f"DuitNow ref {messy} thanks")
+    # a wrong check character is not a code
+    wrong = code[:5] + ("0" if code[5] != "0" else "1")
+    assert app.order_code_candidates(f"ref {wrong}") == set()
+
+
+def test_statement_reference_with_order_code_matches(app, register, admin_client):
+    code = order_code(register(name_cn="对账", payment_method="bank_transfer"))
+    with app.app.app_context():
+        sub = app.event_submissions().filter_by(order_code=code).one()
+        sub_id, total = sub.id, sub.total
+    statement = f"Date,Description,Amount\n2025-08-01,IBG {code[:3].lower()}-{code[3:].lower()} GHOST FEST,{total}\n"
+    resp = admin_client.post("/admin/reconcile", content_type="multipart/form-data",
+                             data={"statement": (io.BytesIO(statement.encode()), "statement.csv")})
+    assert resp.status_code == 200
+    html = resp.get_data(as_text=True)
+    assert re.search(rf'value="{sub_id}:{total}(\.0)?"\s+checked', html)
+    assert 'class="conf-high"' in html
+
+
+def test_statement_description_skips_amount_and_balance_columns(app):
+    df = app.pd.DataFrame({"Date": ["2025-08-01"], "Description": ["IBG GHOST FEST"],
+                           "Reference": ["ABC-123"], "Amount": ["50.00"], "Balance": ["60123456789"]})
+    [line] = app.parse_statement(df)
+    assert line["description"] == "IBG GHOST FEST ABC-123"
+    assert app.phone_candidates(line["description"]) == set()
@@ -0,0 +1,72 @@
+from urllib.parse import parse_qs, urlparse
+
+from conftest import register_form
+
+
+def order_code(resp):
+    return parse_qs(urlparse(resp.location).query)["code"][0]
+
+
+def test_order_codes_are_random_unique_and_valid(app):
+    with app.app.app_context():
+        codes = app.allocate_order_codes(app.db.session.connection(), 5000)
+        app.db.session.rollback()
+    assert len(set(codes)) == 5000
+    assert all(app.normalize_order_code(c) == c for c in codes)
+
+
+def test_order_codes_skip_codes_already_taken(app, register, monkeypatch):
+    taken = order_code(register())
+    fresh = app.random_order_code()
+    draws = iter([taken, fresh])
+    monkeypatch.setattr(app, "random_order_code", lambda: next(draws))
+    with app.app.app_context():
+        codes = app.allocate_order_codes(app.db.session.connection(), 1)
+        app.db.session.rollback()
+    assert codes == [fresh]
+
+
+def test_register_then_review_by_code(app, register, client):
+    resp = register(name_cn="查看")
+    assert resp.status_code == 302
+    code = order_code(resp)
+    page = client.get(f"/review?code={code.lower()}")
+    assert page.status_code == 200
+    assert code in page.get_data(as_text=True)
+    assert f"RM {app.calc_total('no', 1)}" in page.get_data(as_text=True)
+
+
+def test_review_with_unknown_code_goes_back_to_the_form(app, client):
+    with app.app.app_context():
+        code = app.random_order_code()
+    resp = client.get(f"/review?code={code}")
+    assert resp.status_code == 302
+    assert urlparse(resp.location).path == "/"
+
+
+def test_register_replay_returns_the_first_order(app, client):
+    form = register_form(name_cn="重放")
+    first = client.post("/", data=form)
+    second = client.post("/", data=form)
+    assert first.status_code == second.status_code == 302
+    assert second.location == first.location
+    with app.app.app_context():
+        assert app.event_submissions().filter_by(name_cn="重放").count() == 1
+
+
+def test_capacity_rejects_an_order_over_the_limit(app, register):
+    with app.app.app_context():
+        row = app.db.session.get(app.Capacity, (app.active_event_id(), "option:狗狗"))
+        row.cap = row.used + 1
+        app.db.session.commit()
+    try:
+        ok = register(name_cn="名额一", d1_option="狗狗")
+        full = register(name_cn="名额二", d1_option="狗狗")
+        assert ok.status_code == 302
+        assert full.status_code == 409
+        with app.app.app_context():
+            assert app.event_submissions().filter_by(name_cn="名额二").count() == 0
+    finally:
+        with app.app.app_context():
+            app.db.session.get(app.Capacity, (app.active_event_id(), "option:狗狗")).cap = None
+            app.db.session.commit()